@@ -0,0 +1,306 @@
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from dataclasses import asdict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from msq_maker.core import MSQ, BaseOptionalProducerArgs, MoseqReportsConfig, PluginRegistry
+from msq_maker.model import get_model_config
+from msq_maker.profiling import ProducerProfiler
+from msq_maker.spool import DiskSpool
+from msq_maker.synth import SynthDataset, SynthOptions, generate_dataset
+
+
+# Producers which shell out to other packages' command line tools, excluded unless explicitly requested.
+SUBPROCESS_PRODUCERS = ["spinograms", "syllable_clips"]
+
+# Modules the command line interface must not import at startup, only once a producer needs them.
+HEAVY_MODULES = ["moseq2_viz", "cv2", "sklearn", "h5py", "matplotlib"]
+
+# Timings below this many seconds are considered noise when looking for regressions.
+MIN_REGRESSION_SECONDS = 0.05
+
+# Memory increases below this many bytes are considered noise when looking for regressions.
+MIN_REGRESSION_BYTES = 32 * 2**20
+
+Measurement = Dict[str, float]
+BenchmarkResults = Dict[str, Any]
+
+
+def prepare_dataset(work_dir: str, sessions: int, frames: int, seed: int = 0) -> SynthDataset:
+    """Generate (or reuse) a synthetic dataset for a benchmark size.
+
+    Args:
+        work_dir (str): directory holding the benchmark datasets.
+        sessions (int): number of sessions of the dataset.
+        frames (int): number of frames per session.
+        seed (int): random seed.
+
+    Returns:
+        SynthDataset: paths of the dataset.
+    """
+    options = SynthOptions(sessions=sessions, frames=frames, seed=seed)
+    out_dir = os.path.join(work_dir, f"synth-{sessions}x{frames}-{seed}")
+    marker = os.path.join(out_dir, "options.json")
+    if os.path.exists(marker):
+        with open(marker, "r") as f:
+            if json.load(f) == asdict(options):
+                logging.info(f"Reusing synthetic dataset at {out_dir}")
+                return SynthDataset(
+                    index=os.path.join(out_dir, "moseq2-index.yaml"),
+                    model=os.path.join(out_dir, "model.p"),
+                    pca=os.path.join(out_dir, "_pca", "pca_scores.h5"),
+                    raw_data_path=os.path.join(out_dir, "raw"),
+                    uuids=[],
+                )
+
+    dataset = generate_dataset(out_dir, options)
+    with open(marker, "w") as f:
+        json.dump(asdict(options), f)
+    return dataset
+
+
+def make_config(dataset: SynthDataset, out_dir: str) -> MoseqReportsConfig:
+    """Build a report configuration for a synthetic dataset, writing outputs to `out_dir`."""
+    config = MoseqReportsConfig()
+    config.msq.name = "benchmark"
+    config.msq.out_dir = out_dir
+    config.msq.tmp_dir = os.path.join(out_dir, "tmp")
+    config.msq.cache_dir = ""  # measure the actual computations
+    config.msq.spool_backend = "disk"  # measure against the same storage on every machine
+    config.model = get_model_config(
+        model_file=dataset.model,
+        index_file=dataset.index,
+        manifest_file=None,
+        manifest_uuid_col="UUID",
+        manifest_session_id_col="Session_ID",
+        raw_dir=dataset.raw_data_path,
+        groups=None,
+    )
+    return config
+
+
+def _measure(profiler: ProducerProfiler, name: str, func: Callable[[], Any]) -> Measurement:
+    try:
+        with profiler.profile(name):
+            func()
+    except Exception:
+        logging.exception(f"Benchmark \"{name}\" failed")
+    record = profiler.records[-1]
+    return {
+        "wall_time": record["wall_time"],
+        "cpu_time": record["cpu_user"] + record["cpu_system"] + record["cpu_children"],
+        "peak_rss": record["peak_rss"],
+        # benchmarks share a process whose RSS rarely shrinks, so each is measured from its own starting RSS
+        "peak_rss_increase": record["peak_rss_increase"],
+        "ok": record["status"] == "ok",
+    }
+
+
+def eager_imports() -> List[str]:
+    """List the modules of `HEAVY_MODULES` imported by merely loading the command line interface."""
+    code = f"import sys, msq_maker.cli; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    proc = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return proc.stdout.split()
+
+
+def benchmark_startup(repeat: int = 3) -> Dict[str, Any]:
+    """Benchmark the startup time of the command line interface, as the best of `repeat` runs of `msq-maker list-producers`.
+
+    The startup fails (`ok` is False) if loading the command line interface imports any of `HEAVY_MODULES`, listed in `eager_imports`.
+    """
+    times = []
+    ok = True
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ok = subprocess.run([sys.executable, "-m", "msq_maker.cli", "list-producers"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0 and ok
+        times.append(time.perf_counter() - start)
+    eager = eager_imports()
+    return {"wall_time": min(times), "cpu_time": 0.0, "peak_rss": 0, "peak_rss_increase": 0, "ok": ok and len(eager) == 0, "eager_imports": eager}
+
+
+def benchmark_helpers(config: MoseqReportsConfig, profiler: ProducerProfiler) -> Dict[str, Measurement]:
+    """Benchmark the hot helper functions used by producers."""
+    from moseq2_viz.model.util import parse_model_results
+
+    from msq_maker.monkey_patch.make_crowd_matrix import make_crowd_matrix_d2_compat
+    from msq_maker.producers.entropy import entropy, entropy_rate, transition_entropy
+    from msq_maker.util import get_syllable_id_mapping, load_index, syllableMatricesToLongForm
+
+    results: Dict[str, Measurement] = {}
+    model = parse_model_results(config.model.model, sort_labels_by_usage=False)
+    labels = [np.asarray(lbl) for lbl in model["labels"]]
+    _, sorted_index = load_index(config.model.index)
+
+    results["label_map"] = _measure(profiler, "label_map", lambda: get_syllable_id_mapping(config.model.model))
+    label_map = get_syllable_id_mapping(config.model.model)
+
+    results["entropy"] = _measure(profiler, "entropy", lambda: entropy(labels, truncate_syllable=config.model.max_syl))
+    results["entropy_rate"] = _measure(profiler, "entropy_rate", lambda: entropy_rate(labels, truncate_syllable=config.model.max_syl, normalize="bigram"))
+    results["transition_entropy"] = _measure(profiler, "transition_entropy", lambda: transition_entropy(labels, truncate_syllable=config.model.max_syl))
+
+    num_states = max(int(np.max(lbl)) for lbl in labels) + 1
+    mats = {"raw": np.random.default_rng(0).random((num_states, num_states))}
+    results["long_form"] = _measure(profiler, "long_form", lambda: syllableMatricesToLongForm(mats, label_map))
+
+    # crowd matrix compositing, on instances of the most used syllable of the first session
+    first_uuid = model["keys"][0]
+    seq = labels[0]
+    starts = np.concatenate([[0], np.where(seq[1:] != seq[:-1])[0] + 1])
+    ends = np.concatenate([starts[1:], [len(seq)]])
+    values, counts = np.unique(seq[starts][seq[starts] >= 0], return_counts=True)
+    top = values[np.argmax(counts)]
+    h5_path = sorted_index["files"][first_uuid]["path"][0]
+    slices = [((s, e), first_uuid, h5_path) for s, e, v in zip(starts, ends, seq[starts]) if v == top]
+    results["crowd_matrix"] = _measure(profiler, "crowd_matrix", lambda: make_crowd_matrix_d2_compat(slices, nexamples=20, raw_size=SynthOptions.raw_size))
+
+    return results
+
+
+def benchmark_producers(config: MoseqReportsConfig, profiler: ProducerProfiler, include_subprocess: bool = False) -> Dict[str, Measurement]:
+    """Benchmark every registered producer, and the bundling of their outputs."""
+    results: Dict[str, Measurement] = {}
+    msq = MSQ(config.msq)
+    msq.prepare()
+
+    for producer_name in PluginRegistry.registered():
+        if producer_name in SUBPROCESS_PRODUCERS and not include_subprocess:
+            continue
+        producer_config = config.producers.get(producer_name)
+        if isinstance(producer_config, BaseOptionalProducerArgs):
+            producer_config.enabled = True
+        producer_class = PluginRegistry.get(producer_name)
+        logging.info(f"Benchmarking producer \"{producer_name}\"...")
+        results[f"producer:{producer_name}"] = _measure(profiler, producer_name, lambda: producer_class(config).run(msq))
+
+    results["bundle"] = _measure(profiler, "bundle", msq.bundle)
+    msq.post()
+    return results
+
+
+def run_benchmarks(work_dir: str, sizes: List[int], frames: int, include_subprocess: bool = False, seed: int = 0) -> BenchmarkResults:
+    """Run the benchmark suite at several dataset sizes.
+
+    Args:
+        work_dir (str): directory for synthetic datasets and report outputs.
+        sizes (List[int]): dataset sizes, in number of sessions.
+        frames (int): number of frames per session.
+        include_subprocess (bool): also benchmark producers running other packages' command line tools.
+        seed (int): random seed of the synthetic datasets.
+
+    Returns:
+        BenchmarkResults: measurements keyed by dataset size and benchmark name.
+    """
+    results: BenchmarkResults = {
+        "meta": {"frames": frames, "seed": seed, "python": platform.python_version(), "machine": platform.machine()},
+        "startup": benchmark_startup(),
+        "sizes": {},
+    }
+    for size in sizes:
+        logging.info(f"Benchmarking with {size} sessions of {frames} frames...")
+        dataset = prepare_dataset(work_dir, size, frames, seed=seed)
+        out_dir = os.path.join(work_dir, f"report-{size}")
+        os.makedirs(out_dir, exist_ok=True)
+        config = make_config(dataset, out_dir)
+        profiler = ProducerProfiler(DiskSpool(config.msq.tmp_dir))
+
+        size_results: Dict[str, Measurement] = {}
+        size_results.update(benchmark_helpers(config, profiler))
+        size_results.update(benchmark_producers(config, profiler, include_subprocess=include_subprocess))
+        results["sizes"][str(size)] = size_results
+    return results
+
+
+def scaling_exponents(results: BenchmarkResults) -> Dict[str, float]:
+    """Estimate how each benchmark scales with dataset size, as the log-log slope of time against size.
+
+    An exponent of 1 means linear scaling, 2 quadratic, etc. Only available with at least two sizes.
+    """
+    sizes = sorted(int(s) for s in results["sizes"].keys())
+    exponents: Dict[str, float] = {}
+    if len(sizes) < 2:
+        return exponents
+    small, large = results["sizes"][str(sizes[0])], results["sizes"][str(sizes[-1])]
+    for name in small.keys():
+        if name in large and small[name]["wall_time"] > 0 and large[name]["wall_time"] > 0:
+            exponents[name] = math.log(large[name]["wall_time"] / small[name]["wall_time"]) / math.log(sizes[-1] / sizes[0])
+    return exponents
+
+
+def find_regressions(results: BenchmarkResults, baseline: BenchmarkResults, threshold: float) -> List[str]:
+    """Compare results to a baseline, reporting benchmarks which failed, or are slower (or use more memory) than allowed.
+
+    Memory is compared on the increase of RSS over the start of each benchmark, so that benchmarks do not inherit the
+    peak of those which ran before them in the same process.
+
+    Args:
+        results (BenchmarkResults): new measurements.
+        baseline (BenchmarkResults): baseline measurements.
+        threshold (float): allowed relative increase, ex. 0.25 for 25%.
+
+    Returns:
+        List[str]: human readable descriptions of each regression.
+    """
+    regressions = []
+    if len(results.get("startup", {}).get("eager_imports", [])) > 0:
+        regressions.append(f"startup: eagerly imports {', '.join(results['startup']['eager_imports'])}")
+    if "startup" in results and not results["startup"]["ok"] and len(results["startup"].get("eager_imports", [])) == 0:
+        regressions.append("startup: `msq-maker list-producers` failed")
+    if "startup" in results and "startup" in baseline:
+        new, base = results["startup"]["wall_time"], baseline["startup"]["wall_time"]
+        if new > MIN_REGRESSION_SECONDS and new > base * (1 + threshold):
+            regressions.append(f"startup: wall time {base:.3f}s -> {new:.3f}s")
+    for size, measurements in results["sizes"].items():
+        base_measurements = baseline.get("sizes", {}).get(size, {})
+        for name, m in measurements.items():
+            base = base_measurements.get(name)
+            if not m["ok"]:
+                regressions.append(f"{name} @ {size} sessions: failed" + (" (passed in the baseline)" if base is not None and base.get("ok", True) else ""))
+                continue
+            if base is None or not base.get("ok", True):
+                continue
+            if m["wall_time"] > MIN_REGRESSION_SECONDS and m["wall_time"] > base["wall_time"] * (1 + threshold):
+                regressions.append(f"{name} @ {size} sessions: wall time {base['wall_time']:.3f}s -> {m['wall_time']:.3f}s")
+            # baselines recorded before `peak_rss_increase` existed only have the process-wide peak, which is not comparable
+            if "peak_rss_increase" not in base:
+                continue
+            new_rss, base_rss = m["peak_rss_increase"], base["peak_rss_increase"]
+            if new_rss - base_rss > MIN_REGRESSION_BYTES and new_rss > base_rss * (1 + threshold):
+                regressions.append(f"{name} @ {size} sessions: peak rss increase {base_rss / 2**20:.1f} MiB -> {new_rss / 2**20:.1f} MiB")
+    return regressions
+
+
+def format_results(results: BenchmarkResults) -> str:
+    """Format results as a table of wall times, one column per dataset size, with scaling exponents."""
+    sizes = sorted(results["sizes"].keys(), key=int)
+    names: List[str] = []
+    for size in sizes:
+        names.extend(n for n in results["sizes"][size].keys() if n not in names)
+    exponents = scaling_exponents(results)
+
+    header = ["benchmark"] + [f"{s} sessions (s)" for s in sizes] + (["scaling"] if exponents else [])
+    rows = [header]
+    for name in names:
+        row = [name]
+        for size in sizes:
+            m: Optional[Measurement] = results["sizes"][size].get(name)
+            row.append("-" if m is None else f"{m['wall_time']:.3f}" + ("" if m["ok"] else " (failed)"))
+        if exponents:
+            row.append(f"n^{exponents[name]:.2f}" if name in exponents else "-")
+        rows.append(row)
+
+    widths = [max(len(r[i]) for r in rows) for i in range(len(header))]
+    lines = ["  ".join(cell.ljust(w) for cell, w in zip(row, widths)) for row in rows]
+    lines.insert(1, "  ".join("-" * w for w in widths))
+    if "startup" in results:
+        lines.append(f"cli startup: {results['startup']['wall_time']:.3f}s")
+        if len(results["startup"].get("eager_imports", [])) > 0:
+            lines.append(f"cli startup eagerly imports: {', '.join(results['startup']['eager_imports'])}")
+    return "\n".join(lines)
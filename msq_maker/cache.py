@@ -0,0 +1,267 @@
+from concurrent.futures import Future
+import contextlib
+import copy
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+import joblib
+import numpy as np
+
+
+FileIdentity = Tuple[str, int, int]
+
+
+def file_identity(path: str) -> FileIdentity:
+    """Get a cheap identity for a file, based on its absolute path, modification time and size.
+
+    Args:
+        path (str): path to the file.
+
+    Returns:
+        FileIdentity: tuple of (absolute path, mtime in nanoseconds, size in bytes).
+    """
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+_file_hashes: Dict[FileIdentity, str] = {}
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """Compute the SHA-256 of a file's contents.
+
+    Hashes are remembered for the lifetime of the process, keyed by `file_identity()`, so repeated calls for
+    an unchanged file are free.
+
+    Args:
+        path (str): path to the file to hash.
+        chunk_size (int): number of bytes to read at a time.
+
+    Returns:
+        str: hex digest of the file contents.
+    """
+    ident = file_identity(path)
+    if ident not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        _file_hashes[ident] = digest.hexdigest()
+    return _file_hashes[ident]
+
+
+def hash_object(obj: Any) -> str:
+    """Compute a stable SHA-256 of a JSON serializable object, such as a cache key specification.
+
+    Args:
+        obj (Any): object to hash. Dictionary keys are sorted, so insertion order does not matter.
+
+    Returns:
+        str: hex digest of the object.
+    """
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class NpyCache:
+    """Content-addressed store of numpy arrays, saved as `*.npy` files under a root directory."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path_for(self, key: str) -> str:
+        """Get the path where the array for `key` is stored."""
+        return os.path.join(self.root, key[:2], f"{key}.npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Load the array stored for `key`, or None if the key is not in the cache."""
+        path = self.path_for(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            logging.warning(f"Ignoring unreadable cache entry {path}")
+            return None
+
+    def put(self, key: str, value: np.ndarray) -> None:
+        """Store an array for `key`, replacing any existing entry atomically."""
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npy.tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.asarray(value), allow_pickle=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+class ObjectCache:
+    """Content-addressed store of arbitrary python objects (ex. per-session partial results), saved with joblib under a root directory."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path_for(self, key: str) -> str:
+        """Get the path where the object for `key` is stored."""
+        return os.path.join(self.root, key[:2], f"{key}.joblib")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Load the object stored for `key`, or `default` if the key is not in the cache."""
+        path = self.path_for(key)
+        if not os.path.exists(path):
+            return default
+        try:
+            return joblib.load(path)
+        except Exception:
+            logging.warning(f"Ignoring unreadable cache entry {path}")
+            return default
+
+    def put(self, key: str, value: Any) -> None:
+        """Store an object for `key`, replacing any existing entry atomically."""
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".joblib.tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                joblib.dump(value, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+T = TypeVar("T")
+
+
+class _ComputeOnce:
+    """Table of results, each computed once even when several threads ask for it at the same time."""
+
+    def __init__(self) -> None:
+        self.results: Dict[Any, Tuple[Any, Any]] = {}
+        self.pending: Dict[Any, Tuple[Any, "Future[Any]"]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: Any, version: Any, func: Callable[[], T], keep: Callable[[], bool] = lambda: True) -> Tuple[T, bool]:
+        """Get the result for `key`, computing it with `func` unless available for the same `version`, or being computed by another thread.
+
+        Args:
+            key (Any): hashable key of the result.
+            version (Any): version of the inputs, results of other versions are replaced.
+            func (Callable[[], T]): the computation.
+            keep (Callable[[], bool]): called once computed, to decide if the result is kept.
+
+        Returns:
+            Tuple[T, bool]: the result, and whether it was reused (or computed by another thread).
+        """
+        with self.lock:
+            entry = self.results.get(key)
+            if entry is not None and entry[0] == version:
+                return entry[1], True
+            pending = self.pending.get(key)
+            if pending is not None and pending[0] == version:
+                future = pending[1]
+                owner = False
+            else:
+                future = Future()
+                self.pending[key] = (version, future)
+                owner = True
+
+        if not owner:
+            return future.result(), True
+
+        try:
+            result = func()
+        except BaseException as e:
+            with self.lock:
+                self.pending.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.pending.pop(key, None)
+            if keep():
+                self.results[key] = (version, result)
+        future.set_result(result)
+        return result, False
+
+
+_shared: Optional[_ComputeOnce] = None
+
+
+@contextlib.contextmanager
+def shared_memo() -> Iterator[None]:
+    """Context manager sharing the results of `memoized()` computations among everything run in the block.
+
+    Used when building several reports from the same model and index, so that parsing and group independent
+    computations are only done once. Outside of this context, `memoized()` computations always run.
+    """
+    global _shared
+    previous = _shared
+    _shared = _ComputeOnce()
+    try:
+        yield
+    finally:
+        _shared = previous
+
+
+def memoized(namespace: str, key: Any, func: Callable[[], T]) -> T:
+    """Run a computation, or reuse its result if it already ran with the same key within `shared_memo()`.
+
+    Each caller gets its own deep copy of the result, so callers are free to modify it. Callers asking for a
+    result which another thread is computing wait for it.
+
+    Args:
+        namespace (str): name of the computation.
+        key (Any): JSON serializable specification of everything the result depends on, ex. `file_identity()` of inputs.
+        func (Callable[[], T]): the computation.
+
+    Returns:
+        T: result of the computation.
+    """
+    shared = _shared
+    if shared is None:
+        return func()
+    result, reused = shared.get(f"{namespace}:{hash_object(key)}", None, func)
+    if reused:
+        logging.debug(f"Reusing shared result of {namespace}")
+    return copy.deepcopy(result)
+
+
+_file_memo = _ComputeOnce()
+def memoized_file(namespace: str, path: str, func: Callable[[], T], latest_only: bool = False) -> T:
+    """Run a computation derived from a file once per process, and again only when the file changes.
+
+    Unlike `memoized()`, results are kept for the lifetime of the process and are shared: callers must not modify them.
+    Results are keyed by the `file_identity()` of the file, and are only kept if the file did not change while computing them.
+    Callers asking for a result which another thread is computing (ex. see `msq_maker.prefetch`) wait for it.
+
+    Args:
+        namespace (str): name of the computation.
+        path (str): the file the computation depends on.
+        func (Callable[[], T]): the computation.
+        latest_only (bool): only keep the result for the latest file used with this namespace, to bound memory usage of large results.
+
+    Returns:
+        T: result of the computation.
+    """
+    ident = file_identity(path)
+
+    def unchanged() -> bool:
+        if file_identity(path) == ident:
+            return True
+        logging.warning(f"\"{path}\" changed while being read, its {namespace} result is not remembered.")
+        return False
+
+    # results computed from a previous version of the file (or another file, with `latest_only`) are replaced
+    if latest_only:
+        result, _ = _file_memo.get(namespace, ident, func, keep=unchanged)
+    else:
+        result, _ = _file_memo.get((namespace, ident[0]), ident, func, keep=unchanged)
+    return result
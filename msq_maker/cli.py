@@ -1,18 +1,32 @@
 import logging
-from msq_maker.util import add_file_logging, setup_logging
+from msq_maker.util import add_file_logging, remove_file_logging, setup_logging
 setup_logging()
 
-import msq_maker.monkey_patch  # noqa: F401, to ensure monkey patching is applied
-
-
+import contextlib
+import json
 import os
-from typing import List
+import shutil
+from typing import Dict, List, Optional, Tuple
 import click
 
-from msq_maker.core import BaseOptionalProducerArgs, MSQConfig, ModelConfig, MoseqReportsConfig, PluginRegistry, MSQ
+from msq_maker.benchmark import find_regressions, format_results, run_benchmarks
+from msq_maker.cache import shared_memo
+from msq_maker.core import BaseOptionalProducerArgs, MSQConfig, ModelConfig, MoseqReportsConfig, PluginRegistry, MSQ, Shard
+from msq_maker.journal import RunJournal, producer_config_hash
+from msq_maker.merge import find_shard_spools, merge_spools, write_shard_info
+from msq_maker.plan import choose_spool_backend, plan_run
+from msq_maker.preflight import run_preflight
 from msq_maker.model import get_model_config
+from msq_maker.prefetch import Prefetcher
+from msq_maker.profiling import ProducerProfiler
+from msq_maker.rawdata import SCAN_THREADS, STREAM_FILES, index_raw_data
+from msq_maker.spool import DiskSpool, open_spool
+from msq_maker.supervisor import BackgroundProducers
+from msq_maker.synth import SynthOptions, generate_dataset
+from msq_maker.tracing import span, start_tracing, stop_tracing
+from msq_maker.update import PreviousReport, ReportUpdate, write_provenance
 
-import msq_maker.producers # noqa: F401, to ensure producers are registered
+import msq_maker.producers # noqa: F401, to ensure producers are declared
 
 
 @click.group()
@@ -99,9 +113,7 @@ def list_producers():
 
     print("Available producers:")
     for producer_name in PluginRegistry.registered():
-        producer = PluginRegistry.get(producer_name)
-
-        print(f" - {producer_name} ({'Optional' if producer.is_optional() else 'Required'})")
+        print(f" - {producer_name} ({'Optional' if PluginRegistry.is_optional(producer_name) else 'Required'})")
 
 
 @cli.command(name="explain-config", short_help="Generates a report using the specified producer.")
@@ -113,58 +125,449 @@ def explain_config(producer: str):
     elif producer == "msq":
         explanation = MSQConfig.document(name="MSQ")
     else:
-        producer_class = PluginRegistry.get(producer)
-        if producer_class is None:
+        if producer not in PluginRegistry.specs:
             logging.warning(f"Producer {producer} not found.")
             return
 
-        explanation = producer_class.get_args_type().document(name=producer)
+        explanation = PluginRegistry.get_args_type(producer).document(name=producer)
 
     print(explanation)
 
 
 @cli.command(name="make-report", short_help="Generates a report using the specified producer.")
 @click.option("--config-file", "-c", type=click.Path(exists=True), default="msq-config.toml", required=True, help="Path to the configuration file.")
-def make_report(config_file: str):
-    config = MoseqReportsConfig.read_config(config_file)
-    msq = MSQ(config.msq)
+@click.option("--profile", is_flag=True, help="Record wall time, CPU time, peak memory and bytes written for each producer in `timings.json` and the log.")
+@click.option("--trace", type=click.Path(dir_okay=False), default=None, help="Write a Chrome trace-event (Perfetto compatible) file of the run to this path.")
+@click.option("--resume", is_flag=True, help="Resume an interrupted run, skipping producers which completed according to the run journal in the spool.")
+@click.option("--shard", type=str, default=None, help="Only generate shard I of N (written `I/N`, ex. `0/4`) into a partial spool, to be combined with `merge-report`. Per-session producers process the sessions of the shard, other producers only run for shard 0.")
+@click.option("--update", type=click.Path(exists=True, dir_okay=False), default=None, help="Update this existing report: only process sessions which are new or changed since it was generated, and reuse its other outputs.")
+@click.option("--skip-preflight", is_flag=True, help="Do not check that the inputs of the enabled producers are usable before starting.")
+def make_report(config_file: str, profile: bool, trace: str, resume: bool, shard: str, update: str, skip_preflight: bool):
+    if trace is not None:
+        start_tracing(os.path.abspath(trace))
+
+    try:
+        config = MoseqReportsConfig.read_config(config_file)
+        if shard is not None and update is not None:
+            raise click.BadParameter("cannot be combined with --shard, update the merged report instead.", param_hint="--update")
+        if shard is not None:
+            try:
+                config.shard = Shard.parse(shard)
+            except ValueError as e:
+                raise click.BadParameter(str(e), param_hint="--shard")
+            config.msq.tmp_dir = config.shard.spool_path(config.msq.tmp_dir)
+        if not skip_preflight:
+            _preflight(config)
+        errors = _make_report(config, profile, resume, update=update)
+    finally:
+        if trace is not None:
+            stop_tracing()
+
+    if len(errors) > 0:
+        logging.warning("Errors occurred in the following producers during report generation:")
+        for error in errors:
+            logging.warning(f" - {error}")
+
+
+@cli.command(name="make-reports", short_help="Generates several reports, sharing the work they have in common.")
+@click.argument("config_files", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--profile", is_flag=True, help="Record wall time, CPU time, peak memory and bytes written for each producer in `timings.json` and the log of each report.")
+@click.option("--trace", type=click.Path(dir_okay=False), default=None, help="Write a Chrome trace-event (Perfetto compatible) file of the whole run to this path.")
+@click.option("--resume", is_flag=True, help="Resume interrupted runs, skipping producers which completed according to the run journal in each report's spool.")
+@click.option("--skip-preflight", is_flag=True, help="Do not check that the inputs of the enabled producers of each report are usable before starting.")
+def make_reports(config_files: List[str], profile: bool, trace: str, resume: bool, skip_preflight: bool):
+    """Generates a report for each of the given configuration files.
+
+    Reports using the same model and index are generated together: parsing the model and index, and the
+    computations which do not depend on groups (ex. behavioral distances, label map, per-session usages,
+    transitions and entropies) are done once, and only group filtering and bundling is done for each report.
+    """
+    if trace is not None:
+        start_tracing(os.path.abspath(trace))
+
+    try:
+        batches: Dict[Tuple[str, str], List[Tuple[str, MoseqReportsConfig]]] = {}
+        spools: Dict[str, str] = {}
+        for config_file in config_files:
+            config = MoseqReportsConfig.read_config(config_file)
+            spool = os.path.abspath(config.msq.tmp_dir)
+            if spool in spools:
+                raise click.ClickException(f"\"{config_file}\" and \"{spools[spool]}\" share the temporary directory \"{spool}\", each report needs its own.")
+            spools[spool] = config_file
+            key = (os.path.abspath(config.model.model), os.path.abspath(config.model.index))
+            batches.setdefault(key, []).append((config_file, config))
+
+        if not skip_preflight:
+            for batch in batches.values():
+                for config_file, config in batch:
+                    logging.info(f"Checking the inputs of \"{config_file}\"...")
+                    _preflight(config)
+
+        failed: Dict[str, List[str]] = {}
+        for (model, index), batch in batches.items():
+            logging.info(f"Generating {len(batch)} report(s) from model \"{model}\" and index \"{index}\"...")
+            # results are only kept for the reports of a batch, to bound memory usage
+            with shared_memo():
+                for config_file, config in batch:
+                    logging.info(f"Generating report for \"{config_file}\"...")
+                    errors = _make_report(config, profile, resume)
+                    if len(errors) > 0:
+                        failed[config_file] = errors
+    finally:
+        if trace is not None:
+            stop_tracing()
+
+    for config_file, errors in failed.items():
+        logging.warning(f"Errors occurred in the following producers during report generation for \"{config_file}\":")
+        for error in errors:
+            logging.warning(f" - {error}")
+
+
+def _preflight(config: MoseqReportsConfig) -> None:
+    """Check the inputs of a run before it starts, exiting if producers would fail (see `msq_maker.preflight`)."""
+    report = run_preflight(config)
+    report.log()
+    if not report.ok:
+        raise click.ClickException("Inputs failed the preflight checks, fix the problems above (or pass --skip-preflight to run anyway).")
+
+
+def _make_report(config: MoseqReportsConfig, profile: bool, resume: bool, update: Optional[str] = None) -> List[str]:
+    """Generate a report, returning the names of producers which failed.
+
+    If `update` is the path of an existing report, only new and changed sessions are processed, see `ReportUpdate`.
+    """
+    msq = MSQ(config.msq, spool=open_spool(config.msq.tmp_dir, choose_spool_backend(config)))
     msq.prepare()
+    logging.info(f"Spooling the report to \"{msq.spool}\".")
+
+    journal = RunJournal.for_spool(msq.spool)
+    if resume and not journal.exists():
+        logging.warning(f"No run journal found in \"{journal.store}\", starting a new run.")
+        resume = False
+    if not resume:
+        journal.reset()
+
     msq.write_unstructured("msq_config.json", config.to_dict())
     msq.manifest["msq_config"] = "msq_config.json"
 
-    add_file_logging(os.path.join(config.msq.out_dir, f"{config.msq.name}.msq-maker.log"))
+    log_handler = add_file_logging(os.path.join(config.msq.out_dir, f"{config.msq.name}.msq-maker.log"))
 
-    errors = []
-    for producer_name, producer_config in config.producers.items():
-        producer_class = PluginRegistry.get(producer_name)
+    prefetcher = Prefetcher(config) if config.msq.prefetch else None
+    if prefetcher is not None:
+        prefetcher.start()
 
-        if producer_class is None:
-            logging.warning(f"Producer \"{producer_name}\" not found.")
-            continue
+    profiler = ProducerProfiler(msq.spool) if profile else None
 
-        if isinstance(producer_config, BaseOptionalProducerArgs) and producer_config.enabled is False:
-            logging.info(f"Skipping producer \"{producer_name}\" since it is disabled in the config.")
-            continue
+    previous = PreviousReport(update) if update is not None else None
+    errors = []
+    try:
+        report_update = ReportUpdate(previous, config.model) if previous is not None else None
 
-        logging.info(f"Running producer \"{producer_name}\"...")
-        try:
-            producer_instance = producer_class(config)
-            producer_instance.run(msq)
-        except:
-            errors.append(producer_name)
-            logging.exception(f"Error generating {producer_name}, but continuing onward.")
-        logging.info(f"Finished running {producer_name}.")
+        # profiles of producers running at the same time would include each other
+        background = BackgroundProducers(msq, journal) if config.msq.overlap_subprocesses and profiler is None else None
+
+        for producer_name, producer_config in config.producers.items():
+            producer_class = PluginRegistry.get(producer_name)
+
+            if producer_class is None:
+                logging.warning(f"Producer \"{producer_name}\" not found.")
+                continue
+
+            if isinstance(producer_config, BaseOptionalProducerArgs) and producer_config.enabled is False:
+                logging.info(f"Skipping producer \"{producer_name}\" since it is disabled in the config.")
+                continue
+
+            if config.shard is not None and config.shard.index != 0 and not producer_class.per_session:
+                logging.info(f"Skipping producer \"{producer_name}\" since it does not process sessions independently, it runs with shard 0/{config.shard.count}.")
+                continue
+
+            config_hash = producer_config_hash(config.model, producer_config)
+            if resume:
+                entry = journal.resumable(producer_name, config_hash)
+                if entry is not None:
+                    msq.manifest.update(entry["manifest"])
+                    logging.info(f"Skipping producer \"{producer_name}\" since it completed in a previous run.")
+                    continue
+
+            action = report_update.action(producer_name, producer_class, config_hash) if report_update is not None else "run"
+            if action == "run" and background is not None:
+                producer_instance = producer_class(config)
+                if producer_instance.runs_subprocess():
+                    background.submit(producer_name, config_hash, producer_instance)
+                    continue
+
+            logging.info(f"Running producer \"{producer_name}\"..." if action == "run" else f"Updating producer \"{producer_name}\" ({action})...")
+            try:
+                with journal.record(producer_name, config_hash, msq), \
+                     profiler.profile(producer_name) if profiler is not None else contextlib.nullcontext(), \
+                     span(producer_name, "producer"):
+                    if action == "copy":
+                        report_update.copy(producer_name, msq)
+                    elif action == "splice":
+                        report_update.splice(producer_name, producer_class(config), msq)
+                    else:
+                        producer_instance = producer_class(config)
+                        producer_instance.run(msq)
+            except:
+                errors.append(producer_name)
+                logging.exception(f"Error generating {producer_name}, but continuing onward.")
+            logging.info(f"Finished running {producer_name}.")
+
+        if background is not None:
+            errors.extend(background.finish())
+    finally:
+        if previous is not None:
+            # the existing report may be overwritten when bundling
+            previous.close()
+    if prefetcher is not None:
+        prefetcher.shutdown()
+
+    if profiler is not None:
+        profiler.log_summary()
+        msq.write_unstructured("timings.json", profiler.to_dict())
+        msq.manifest["timings"] = "timings.json"
+
+    if config.shard is not None:
+        write_shard_info(msq, config.shard)
+        logging.info(f"Partial spool of shard {config.shard} generated at {msq.spool}, combine all shards with `msq-maker merge-report`.")
+        remove_file_logging(log_handler)
+        return errors
+
+    try:
+        write_provenance(msq, config.model, [journal])
+    except Exception:
+        logging.exception("Could not record the provenance of the report, it will not be possible to update it.")
 
     logging.info("Bundling report...")
-    msq.bundle()
+    with span("bundle", "io"):
+        msq.bundle()
     logging.info(f"Report generated at {msq.report_path}.")
     msq.post()
     logging.info("Report generation complete.")
+    remove_file_logging(log_handler)
+    return errors
 
-    if len(errors) > 0:
-        logging.warning("Errors occurred in the following producers during report generation:")
-        for error in errors:
-            logging.warning(f" - {error}")
+
+@cli.command(name="preflight", short_help="Checks that the inputs of a report are usable, without generating it.")
+@click.option("--config-file", "-c", type=click.Path(exists=True), default="msq-config.toml", required=True, help="Path to the configuration file.")
+def preflight(config_file: str):
+    """Checks that the model, index, extractions and raw data needed by the enabled producers are usable, as `make-report` does before starting.
+
+    Exits with a non-zero status if any producer would fail.
+    """
+    _preflight(MoseqReportsConfig.read_config(config_file))
+
+
+@cli.command(name="plan", short_help="Estimates the runtime, memory and disk space a report needs before generating it.")
+@click.option("--config-file", "-c", type=click.Path(exists=True), default="msq-config.toml", required=True, help="Path to the configuration file.")
+@click.option("--calibration", type=click.Path(exists=True, dir_okay=False), default=None, help="Results of `msq-maker benchmark` on this machine, to rescale the estimates.")
+@click.option("--memory", type=float, default=None, help="Memory the run may use, in GiB. Defaults to the memory currently available.")
+@click.option("--output", "-o", type=click.Path(dir_okay=False), default=None, help="Path where the estimates are saved as JSON.")
+def plan(config_file: str, calibration: str, memory: float, output: str):
+    """Estimates the runtime, peak memory, spool disk use and report size of each enabled producer, from the index and model labels.
+
+    Exits with a non-zero status if the run does not fit the CPU cores, memory or free disk space of the temporary and output directories.
+    """
+    config = MoseqReportsConfig.read_config(config_file)
+    calibration_results = None
+    if calibration is not None:
+        with open(calibration, "r") as f:
+            calibration_results = json.load(f)
+
+    run_plan = plan_run(config, calibration=calibration_results, memory_budget=int(memory * 2**30) if memory is not None else None)
+    stats = run_plan.stats
+    logging.info(f"{stats.sessions} session(s), {stats.frames} frames, {stats.instances} syllable instances, {stats.num_syllables} syllables, "
+                 f"{stats.raw_size[0]}x{stats.raw_size[1]} frames, {stats.workers} worker(s).")
+    for line in run_plan.summary_table().splitlines():
+        logging.info(line)
+    if run_plan.calibration is None:
+        logging.info("Estimates are uncalibrated, pass `--calibration` with the results of `msq-maker benchmark` on this machine to refine them.")
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(run_plan.to_dict(), f, indent=2)
+        logging.info(f"Saved the estimates to {output}.")
+
+    if len(run_plan.problems) > 0:
+        logging.error(f"The run is unlikely to complete, {len(run_plan.problems)} problem(s) found:")
+        for problem in run_plan.problems:
+            logging.error(f" - {problem}")
+        raise SystemExit(1)
+
+
+@cli.command(name="merge-report", short_help="Combines the partial spools of a sharded run into one report.")
+@click.option("--config-file", "-c", type=click.Path(exists=True), default="msq-config.toml", required=True, help="Path to the configuration file.")
+@click.argument("spools", nargs=-1, type=click.Path(exists=True, file_okay=False))
+def merge_report(config_file: str, spools: List[str]):
+    """Combines the partial spools written by `make-report --shard` into one report.
+
+    If no SPOOLS are given, the partial spools next to the temporary directory of the configuration are used.
+    """
+    config = MoseqReportsConfig.read_config(config_file)
+    spool_paths = list(spools) if len(spools) > 0 else find_shard_spools(config.msq.tmp_dir)
+    if len(spool_paths) == 0:
+        raise click.ClickException(f"No partial spools found next to \"{config.msq.tmp_dir}\".")
+
+    msq = MSQ(config.msq)
+    msq.prepare()
+    try:
+        merge_spools(spool_paths, msq)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    msq.write_unstructured("msq_config.json", config.to_dict())
+    msq.manifest["msq_config"] = "msq_config.json"
+    try:
+        write_provenance(msq, config.model, [RunJournal(DiskSpool(spool)) for spool in spool_paths])
+    except Exception:
+        logging.exception("Could not record the provenance of the report, it will not be possible to update it.")
+
+    logging.info("Bundling report...")
+    with span("bundle", "io"):
+        msq.bundle()
+    logging.info(f"Report generated at {msq.report_path}.")
+    msq.post()
+    if config.msq.cleanup:
+        for spool in spool_paths:
+            shutil.rmtree(spool, ignore_errors=True)
+
+
+@cli.command(name="bundle", short_help="Bundles the producers which completed so far into a partial report.")
+@click.option("--config-file", "-c", type=click.Path(exists=True), default="msq-config.toml", required=True, help="Path to the configuration file.")
+@click.option("--output", "-o", type=click.Path(dir_okay=False), default=None, help="Path of the partial report. Defaults to `<name>.partial.<ext>` in the output directory.")
+def bundle(config_file: str, output: str):
+    """Bundles the outputs of producers which completed, according to the run journal in the spool, into a partial report.
+
+    Useful to look at the results of a run which is still going, or which was interrupted.
+    """
+    config = MoseqReportsConfig.read_config(config_file)
+    msq = MSQ(config.msq)
+    journal = RunJournal.for_spool(msq.spool)
+    if not journal.exists():
+        raise click.ClickException(f"No run journal found in \"{journal.store}\".")
+
+    completed = journal.completed()
+    members = ["msq_config.json"]
+    msq.manifest["msq_config"] = "msq_config.json"
+    for producer_name in config.producers.keys():
+        entry = completed.get(producer_name)
+        if entry is None:
+            logging.info(f"Producer \"{producer_name}\" has not completed, it is not included.")
+            continue
+        msq.manifest.update(entry["manifest"])
+        members.extend(entry["outputs"])
+
+    if output is None:
+        output = os.path.join(config.msq.out_dir, f"{config.msq.name}.partial.{config.msq.ext}")
+    with span("bundle", "io"):
+        msq.bundle(members=members, report_path=output)
+    logging.info(f"Partial report with {len(completed)} producer(s) generated at {output}.")
+
+
+@cli.command(name="index-raw", short_help="Indexes the raw session directories, so syllable clips find them quickly.")
+@click.option("--config-file", "-c", type=click.Path(exists=True), default="msq-config.toml", required=True, help="Path to the configuration file.")
+@click.option("--threads", type=int, default=SCAN_THREADS, help="Number of threads scanning the raw data directory.")
+def index_raw(config_file: str, threads: int):
+    """Scans the raw data directory of the configuration once, recording each session directory and its stream files.
+
+    The raw data index is saved in the cache directory. Syllable clips then locate the raw sessions of the index from it,
+    instead of searching the raw data directory on every run. Re-run after adding raw data.
+    """
+    config = MoseqReportsConfig.read_config(config_file)
+    if not config.model.raw_data_path:
+        raise click.ClickException("No raw data directory in the [model] section of the configuration.")
+    if not config.msq.cache_dir:
+        raise click.ClickException("Caching is disabled, set `cache_dir` in the [msq] section of the configuration.")
+
+    path, table = index_raw_data(config.model, config.msq.cache_dir, threads=threads)
+    logging.info(f"Found {len(table)} session directories in \"{config.model.raw_data_path}\", {(table['uuid'] != '').sum()} of them in the index.")
+    for stream in STREAM_FILES.keys():
+        logging.info(f"  - {stream} stream: {(table[stream] != '').sum()} session(s)")
+    logging.info(f"Saved the raw data index to {path}.")
+
+
+@cli.command(name="synth", short_help="Generates a synthetic moseq dataset for testing and load testing.")
+@click.argument("out_dir", type=click.Path(file_okay=False))
+@click.option("--sessions", type=int, default=SynthOptions.sessions, help="Number of sessions (extractions) to generate.")
+@click.option("--frames", type=int, default=SynthOptions.frames, help="Number of frames per session.")
+@click.option("--syllables", type=int, default=SynthOptions.syllables, help="Number of syllables with nonzero usage.")
+@click.option("--max-states", type=int, default=SynthOptions.max_states, help="Value of the `max_states` model training parameter.")
+@click.option("--groups", type=int, default=SynthOptions.groups, help="Number of groups the sessions are split into.")
+@click.option("--frame-size", type=int, default=SynthOptions.frame_size, help="Width and height of the cropped depth frames.")
+@click.option("--npcs", type=int, default=SynthOptions.npcs, help="Number of principal components.")
+@click.option("--mean-duration", type=float, default=SynthOptions.mean_duration, help="Mean syllable duration, in frames.")
+@click.option("--detectron", is_flag=True, help="Mark extractions as produced by moseq2-detectron-extract.")
+@click.option("--raw", is_flag=True, help="Also write raw session directories (depth stream only), needed by syllable clips.")
+@click.option("--seed", type=int, default=SynthOptions.seed, help="Random seed.")
+def synth(out_dir: str, sessions: int, frames: int, syllables: int, max_states: int, groups: int, frame_size: int, npcs: int, mean_duration: float, detectron: bool, raw: bool, seed: int):
+    """Generates a synthetic moseq dataset (index, model, extractions and PCA scores) and a matching configuration file."""
+    options = SynthOptions(
+        sessions=sessions,
+        frames=frames,
+        syllables=syllables,
+        max_states=max_states,
+        groups=groups,
+        frame_size=frame_size,
+        npcs=npcs,
+        mean_duration=mean_duration,
+        detectron=detectron,
+        raw=raw,
+        seed=seed,
+    )
+    dataset = generate_dataset(out_dir, options)
+
+    config = MoseqReportsConfig()
+    config.msq.name = "synth"
+    config.msq.out_dir = os.path.abspath(out_dir)
+    config.msq.tmp_dir = os.path.join(config.msq.out_dir, "tmp")
+    config.model = get_model_config(
+        model_file=dataset.model,
+        index_file=dataset.index,
+        manifest_file=None,
+        manifest_uuid_col="UUID",
+        manifest_session_id_col="Session_ID",
+        raw_dir=dataset.raw_data_path,
+        groups=None,
+    )
+    config_file = os.path.join(config.msq.out_dir, "msq-config.toml")
+    config.write_config(config_file)
+    logging.info(f'Generated synthetic dataset with {sessions} sessions in "{config.msq.out_dir}", configuration at "{config_file}".')
+
+
+@cli.command(name="benchmark", short_help="Benchmarks producers and helpers on synthetic datasets of several sizes.")
+@click.option("--work-dir", type=click.Path(file_okay=False), default="msq-benchmark", help="Directory for synthetic datasets and report outputs. Datasets are reused across runs.")
+@click.option("--sizes", type=str, default="4,16", help="Comma separated dataset sizes, in number of sessions.")
+@click.option("--frames", type=int, default=SynthOptions.frames, help="Number of frames per session.")
+@click.option("--include-subprocess", is_flag=True, help="Also benchmark producers which run other packages' command line tools (spinograms, syllable clips).")
+@click.option("--output", "-o", type=click.Path(dir_okay=False), default="benchmark.json", help="Path where the results are saved, usable as a baseline for later runs.")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), default=None, help="Results of a previous run to compare against.")
+@click.option("--threshold", type=float, default=0.25, help="Allowed relative increase of time or peak memory over the baseline, ex. 0.25 for 25%.")
+def benchmark(work_dir: str, sizes: str, frames: int, include_subprocess: bool, output: str, baseline: str, threshold: float):
+    """Benchmarks each registered producer and the hot helper functions, recording time and peak memory.
+
+    Exits with a non-zero status if a baseline is given and any benchmark regressed beyond the threshold.
+    """
+    results = run_benchmarks(
+        os.path.abspath(work_dir),
+        [int(s) for s in sizes.split(",") if s.strip() != ""],
+        frames,
+        include_subprocess=include_subprocess,
+    )
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for line in format_results(results).splitlines():
+        logging.info(line)
+    logging.info(f"Saved benchmark results to {output}.")
+
+    if baseline is not None:
+        with open(baseline, "r") as f:
+            regressions = find_regressions(results, json.load(f), threshold)
+        if len(regressions) > 0:
+            logging.error(f"{len(regressions)} benchmark(s) regressed by more than {threshold:.0%}:")
+            for regression in regressions:
+                logging.error(f" - {regression}")
+            raise SystemExit(1)
+        logging.info(f"No regressions beyond {threshold:.0%} compared to {baseline}.")
 
 
 if __name__ == "__main__":
@@ -1,14 +1,21 @@
 from abc import ABC, ABCMeta, abstractmethod
 from dataclasses import MISSING, Field, dataclass, field, asdict
+import fnmatch
+import hashlib
+import importlib
 import json
+import logging
 import os
-import shutil
-from typing import Any, Dict, Generic, List, Optional, Type, TypeVar, cast
+from typing import IO, Any, Callable, ContextManager, Dict, Generic, Iterable, List, Optional, Set, Type, TypeVar, Union, cast
 import zipfile
 
 import pandas as pd
+from scipy import sparse
 import toml
+from typing_extensions import Literal
 
+from msq_maker.spool import Spool, SpoolBackend, open_spool
+from msq_maker.tracing import span
 from msq_maker.util import get_groups_index
 
 
@@ -114,6 +121,11 @@ class MSQConfig(SelfDocumentingMixin):
     tmp_dir: str = field(default=os.path.join(os.getcwd(), "tmp"), metadata={"doc": "Temporary directory for intermediate files"})
     ext: str = field(default="msq", metadata={"doc": "File extension for the final output file"})
     cleanup: bool = field(default=True, metadata={"doc": "Whether to clean up the temporary directory after the report is generated. If set to False, the temporary files will be kept for debugging purposes."})
+    cache_dir: str = field(default=os.path.join(os.path.expanduser("~"), ".cache", "msq-maker"), metadata={"doc": "Directory where expensive intermediate results (ex. behavioral distances) are cached between runs. Set to an empty string to disable caching."})
+    processes: Union[int, Literal["auto"]] = field(default="auto", metadata={"doc": "Number of processes used to compute the per-session results of producers such as usage, transitions, entropy and scalars. If \"auto\", will use the number of available CPU cores (taking into account CPU affinity on systems that support it)."})
+    overlap_subprocesses: bool = field(default=True, metadata={"doc": "Whether producers which run external commands as subprocesses (ex. spinograms and syllable clips, see their `in_process` option) run in the background while other producers run, instead of one after the other. Ignored when profiling."})
+    prefetch: bool = field(default=True, metadata={"doc": "Whether to load the model, index, manifest and session metadata concurrently in background threads when a run starts, instead of one at a time when producers first need them."})
+    spool_backend: SpoolBackend = field(default="disk", metadata={"doc": "Where the contents of the report are stored until they are bundled: \"disk\" (`tmp_dir`), \"tmpfs\" (a RAM backed filesystem, moving to `tmp_dir` if it fills up), \"memory\" (the memory of the msq-maker process, runs cannot be resumed), or \"auto\" to use tmpfs when the estimated size of the report fits in free memory (see `msq-maker plan`), and the disk otherwise. Tmpfs is never picked unless \"auto\" or \"tmpfs\" is set."})
 
 
 @dataclass
@@ -125,11 +137,48 @@ class BaseOptionalProducerArgs(BaseProducerArgs):
     enabled: bool = field(default=True, metadata={"doc": "Enable or disable this producer."})
 
 
+@dataclass(frozen=True)
+class Shard:
+    """A deterministic subset of the sessions, used to split report generation across processes or nodes.
+
+    Sessions are assigned to shards by a hash of their uuid, so the assignment does not depend on which
+    sessions a producer looks at (ex. the model's training list or the index), nor on their order.
+    """
+    index: int
+    count: int
+
+    def __post_init__(self) -> None:
+        if self.count < 1 or not 0 <= self.index < self.count:
+            raise ValueError(f"Invalid shard {self.index}/{self.count}, expected 0 <= index < count.")
+
+    @classmethod
+    def parse(cls, spec: str) -> "Shard":
+        """Parse a shard specification of the form `index/count`, ex. `0/4`."""
+        try:
+            index, count = spec.split("/")
+            return cls(int(index), int(count))
+        except ValueError:
+            raise ValueError(f"Invalid shard \"{spec}\", expected the form `index/count`, ex. `0/4`.")
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    def owns(self, uuid: str) -> bool:
+        """Check if a session belongs to this shard."""
+        return int(hashlib.sha256(uuid.encode("utf-8")).hexdigest(), 16) % self.count == self.index
+
+    def spool_path(self, tmp_dir: str) -> str:
+        """Get the partial spool of this shard, next to the temporary directory of the full report."""
+        return f"{os.path.normpath(tmp_dir)}.shard-{self.index}-of-{self.count}"
+
+
 class MoseqReportsConfig:
     def __init__(self) -> None:
         self.msq: MSQConfig = MSQConfig()
         self.model: ModelConfig = ModelConfig()
         self.producers: Dict[str, BaseProducerArgs] = PluginRegistry.gather_configs()
+        # shard being generated, if any. This is set for a run (see `make-report --shard`), and is not part of the configuration file
+        self.shard: Optional[Shard] = None
 
     def to_dict(self) -> Dict[str, BaseProducerArgs]:
         configs = {"msq": self.msq, "model": self.model, **self.producers}
@@ -152,16 +201,26 @@ class MoseqReportsConfig:
         for k, v in config.items():
             producer_name = k.split(".")[1] if "." in k else k
             if producer_name not in ["msq", "model"]:
-                klass = PluginRegistry.registry.get(producer_name)
-                if klass is None:
+                if producer_name not in PluginRegistry.specs:
                     raise ValueError(f"Producer {producer_name} not found in registry.")
-                msr_config.producers[producer_name] = klass.get_args_type()(**v)
+                msr_config.producers[producer_name] = PluginRegistry.get_args_type(producer_name)(**v)
         return msr_config
 
 
+# Name of the run journal (see `msq_maker.journal.RunJournal`), relative to the spool. It is never bundled.
+JOURNAL_NAME = ".msq-maker-journal.jsonl"
+
+
 class MSQ:
-    def __init__(self, config: MSQConfig):
+    """A report being generated: its manifest, and its contents stored in a spool until they are bundled.
+
+    Producers write to the report only through this class (ex. `write_dataframe()`, `open()`, or `directory()` for tools
+    writing files themselves), so that the spool can be on disk, on tmpfs or in memory (see `msq_maker.spool`).
+    """
+
+    def __init__(self, config: MSQConfig, spool: Optional[Spool] = None):
         self.config = config
+        self.spool: Spool = spool if spool is not None else open_spool(config.tmp_dir, config.spool_backend)
         self.manifest: Dict[str, Any] = {}
 
     @property
@@ -170,50 +229,121 @@ class MSQ:
         return os.path.join(self.config.out_dir, f"{self.config.name}.{self.config.ext}")
 
     @property
-    def spool_path(self) -> str:
-        return self.config.tmp_dir
+    def spool_path(self) -> Optional[str]:
+        """Directory of the spool, None for spools held in memory."""
+        return self.spool.path
 
     def prepare(self):
         # Prepare the MSQ report generation process
         pass
 
-    def bundle(self):
+    def bundle(self, members: Optional[Iterable[str]] = None, report_path: Optional[str] = None):
+        """Write the manifest and bundle the spool into the report file.
+
+        Args:
+            members (Iterable[str]|None): if given, only bundle these files (paths relative to the spool) and the manifest.
+            report_path (str|None): destination of the bundle, defaults to `report_path`.
+        """
         self._write_manifest()
+        selected = None if members is None else set(os.path.normpath(m) for m in members) | {"manifest.json"}
         # Finalize the MSQ report generation process
-        zip = zipfile.ZipFile(self.report_path, "w", zipfile.ZIP_DEFLATED)
+        zip = zipfile.ZipFile(report_path or self.report_path, "w", zipfile.ZIP_DEFLATED)
 
-        for root, _, files in os.walk(self.spool_path):
-            for file in files:
-                arcname = os.path.join(os.path.relpath(root, self.spool_path), file)
-                zip.write(os.path.join(root, file), arcname=arcname)
+        for name in sorted(self.spool.snapshot().keys()):
+            rel = os.path.normpath(name)
+            if rel == JOURNAL_NAME or (selected is not None and rel not in selected):
+                continue
+            self.spool.write_to_zip(zip, name, rel)
         zip.close()
 
     def post(self):
         # Clean up the temporary directory if configured to do so
         if self.config.cleanup:
-            try:
-                shutil.rmtree(self.spool_path)
-                print(f"Directory '{self.spool_path}' and its contents removed successfully.")
-            except OSError as e:
-                print(f"Error: {e.filename} - {e.strerror}.")
+            self.spool.clear()
+            print(f"Spool '{self.spool}' and its contents removed successfully.")
+
+    def exists(self, name: str) -> bool:
+        """Check if a file exists in the spool."""
+        return self.spool.exists(name)
+
+    def glob(self, pattern: str) -> List[str]:
+        """List the files of the spool matching a shell-style pattern, ex. "crowd_movies/*.mp4"."""
+        return sorted(name for name in self.spool.snapshot().keys() if fnmatch.fnmatch(name, pattern))
 
-    def write_dataframe(self, name: str, data: pd.DataFrame):
+    def open(self, name: str, mode: str = "r") -> ContextManager[IO]:
+        """Open a file of the spool, as a context manager, see `msq_maker.spool.Spool.open()`."""
+        return self.spool.open(name, mode)
+
+    def directory(self, name: str = "") -> ContextManager[str]:
+        """Get a directory on disk whose contents end up under `name` in the spool, for tools writing files themselves.
+
+        Files are only guaranteed to be in the spool once the context exits, see `msq_maker.spool.Spool.directory()`.
+        """
+        return self.spool.directory(name)
+
+    def write_bytes(self, name: str, data: bytes):
+        """Write raw contents to the spool."""
+        self.spool.write_bytes(name, data)
+
+    def write_dataframe(self, name: str, data: pd.DataFrame, orient: str = "split"):
         # Write the data to a DataFrame
-        dest = os.path.join(self.spool_path, name)
-        os.makedirs(os.path.dirname(dest), exist_ok=True)
-        data.to_json(dest, orient="split")
+        with span("write_dataframe", "io", path=name, rows=len(data)), self.spool.open(name, "w") as f:
+            data.to_json(f, orient=orient)
 
     def write_unstructured(self, name: str, data: Any):
         # Write unstructured data to a file
-        dest = os.path.join(self.spool_path, name)
-        os.makedirs(os.path.dirname(dest), exist_ok=True)
-        with open(dest, "w") as f:
+        with span("write_unstructured", "io", path=name), self.spool.open(name, "w") as f:
             json.dump(data, f, indent=4)
 
+    def write_sparse(self, name: str, matrices: Dict[str, sparse.spmatrix], **attrs: Any):
+        """Write a collection of sparse matrices, storing only their nonzero entries.
+
+        Matrices are written in COO layout (parallel `row`, `col` and `data` lists) and must all share the same shape.
+
+        Args:
+            name (str): destination, relative to the spool.
+            matrices (Dict[str, sparse.spmatrix]): matrices to write, keyed by name (ex. uuid or group).
+            **attrs: additional JSON serializable attributes to store alongside the matrices.
+        """
+        shapes = set(m.shape for m in matrices.values())
+        if len(shapes) > 1:
+            raise ValueError(f"All matrices must share the same shape, but got {shapes}")
+
+        payload: Dict[str, Any] = {
+            "format": "coo",
+            "shape": list(shapes.pop()) if len(shapes) > 0 else [0, 0],
+            **attrs,
+            "matrices": {},
+        }
+        for key, mat in matrices.items():
+            coo = mat.tocoo()
+            payload["matrices"][key] = {"row": coo.row.tolist(), "col": coo.col.tolist(), "data": coo.data.tolist()}
+        self.write_unstructured(name, payload)
+
+    def read_sparse(self, name: str) -> Dict[str, sparse.coo_matrix]:
+        """Read back a collection of sparse matrices written by `write_sparse()`.
+
+        Args:
+            name (str): source, relative to the spool.
+
+        Returns:
+            Dict[str, sparse.coo_matrix]: matrices keyed by name.
+        """
+        with self.spool.open(name, "r") as f:
+            payload = json.load(f)
+
+        if payload.get("format") != "coo":
+            raise ValueError(f"Unsupported sparse format \"{payload.get('format')}\" in {name}")
+
+        shape = tuple(payload["shape"])
+        return {
+            key: sparse.coo_matrix((m["data"], (m["row"], m["col"])), shape=shape)
+            for key, m in payload["matrices"].items()
+        }
+
     def _write_manifest(self):
         # Write the manifest file
-        manifest_path = os.path.join(self.spool_path, "manifest.json")
-        with open(manifest_path, "w") as f:
+        with self.spool.open("manifest.json", "w") as f:
             json.dump(self.manifest, f, indent=4)
 
 
@@ -222,6 +352,13 @@ class MSQ:
 TProducerArgs = TypeVar("TProducerArgs", bound=BaseProducerArgs)
 
 class BaseProducer(ABC, Generic[TProducerArgs], metaclass=ABCMeta):
+    # Whether the outputs of the producer are computed independently for each session. Such producers only
+    # process the sessions of the current shard, others only run for the first shard (see `Shard`).
+    per_session: bool = False
+
+    # Sessions to process when updating an existing report (see `msq_maker.update`), None to process all sessions.
+    only_sessions: Optional[Set[str]] = None
+
     def __init__(self, configuration: MoseqReportsConfig):
         self.config = configuration
         self.mconfig: ModelConfig = configuration.model
@@ -243,37 +380,130 @@ class BaseProducer(ABC, Generic[TProducerArgs], metaclass=ABCMeta):
     def run(self, msq: MSQ) -> None:
         pass
 
+    def prefetch(self) -> List[Callable[[], Any]]:
+        """Loads of inputs the producer needs, started in background threads when a run starts (see `msq_maker.prefetch`).
+
+        Loads should go through memoized loaders (ex. `msq_maker.util.get_roi_size()`), so that `run()` reuses their results.
+        """
+        return []
+
+    def required_datasets(self) -> List[str]:
+        """Datasets the producer reads from the extraction of every session, checked before a run starts (see `msq_maker.preflight`)."""
+        return []
+
+    def preflight(self) -> List[str]:
+        """Check the inputs the producer needs besides the datasets of the extractions, before a run starts (see `msq_maker.preflight`).
+
+        Checks should be quick, and only report what would make `run()` fail.
+
+        Returns:
+            List[str]: human readable descriptions of each problem.
+        """
+        return []
+
+    def runs_subprocess(self) -> bool:
+        """Whether `run()` mostly waits on a subprocess, in which case it can overlap with other producers (see `MSQConfig.overlap_subprocesses`).
+
+        Such producers must only write to the report through `msq`, and must not depend on the outputs of other producers.
+        """
+        return False
+
+    def in_shard(self, uuid: str) -> bool:
+        """Check if a session is to be processed: it belongs to the shard being generated and, when updating
+        a report, is among `only_sessions`. Always true when neither sharding nor updating."""
+        if self.only_sessions is not None and uuid not in self.only_sessions:
+            return False
+        return self.config.shard is None or self.config.shard.owns(uuid)
+
+    def shard_key(self) -> Optional[str]:
+        """Identify the shard being generated, for use in keys of results computed on the sessions of the shard."""
+        return None if self.config.shard is None else str(self.config.shard)
+
+
+@dataclass(frozen=True)
+class ProducerSpec:
+    """Lightweight description of a producer, allowing to list and configure producers without importing them.
+
+    Attributes:
+        name (str): name of the producer.
+        module (str): module defining (and registering) the producer and its configuration.
+        class_name (str): name of the producer class within `module`.
+        config_name (str): name of the configuration class within `module`.
+        optional (bool): whether the producer can be disabled, i.e. its configuration derives from `BaseOptionalProducerArgs`.
+    """
+    name: str
+    module: str
+    class_name: str
+    config_name: str
+    optional: bool = True
+
 
 class PluginRegistryMetaclass(type):
 
     def __len__(self):
-        return len(self.registry)
+        return len(self.specs)
 
 
 class PluginRegistry(metaclass=PluginRegistryMetaclass):
+    """Registry of producers.
+
+    Producers are declared with `declare()`, and their module is only imported when the producer (or its
+    configuration) is first needed, keeping heavy dependencies out of commands which only list producers.
+    Importing a module registering a producer with `register()` also declares it.
+    """
     registry: Dict[str, Type[BaseProducer]] = {}
+    specs: Dict[str, ProducerSpec] = {}
+
+    @classmethod
+    def declare(cls, name: str, module: str, class_name: str, config_name: str, optional: bool = True) -> None:
+        """Declare a producer, to be imported from `module` when first needed."""
+        cls.specs[name] = ProducerSpec(name=name, module=module, class_name=class_name, config_name=config_name, optional=optional)
 
     @classmethod
     def registered(cls) -> List[str]:
         """Get a list of all registered plugin names."""
-        return list(cls.registry.keys())
+        return list(cls.specs.keys())
 
     @classmethod
     def registered_optional(cls) -> List[str]:
         """Get a list of all registered optional plugin names."""
-        return [name for name, klass in cls.registry.items() if klass.is_optional()]
+        return [name for name, spec in cls.specs.items() if spec.optional]
 
     @classmethod
-    def get(cls, plugin_name: str) -> Type[BaseProducer]:
-        """Get a registered plugin class by its name."""
+    def is_optional(cls, plugin_name: str) -> bool:
+        """Check if a registered plugin is optional, without importing it."""
+        return cls.specs[plugin_name].optional
+
+    @classmethod
+    def get(cls, plugin_name: str) -> Optional[Type[BaseProducer]]:
+        """Get a registered plugin class by its name, importing it if needed. Returns None for unknown plugins."""
+        if plugin_name not in cls.registry:
+            spec = cls.specs.get(plugin_name)
+            if spec is None:
+                return None
+            with span("load_producer", "startup", producer=plugin_name):
+                importlib.import_module(spec.module)
+            if plugin_name not in cls.registry:
+                raise ImportError(f"Module \"{spec.module}\" does not register producer \"{plugin_name}\".")
         return cls.registry[plugin_name]
 
+    @classmethod
+    def get_args_type(cls, plugin_name: str) -> Type[BaseProducerArgs]:
+        """Get the configuration class of a registered plugin by its name."""
+        spec = cls.specs[plugin_name]
+        return getattr(importlib.import_module(spec.module), spec.config_name)
+
     @classmethod
     def register(cls, plugin_name: str):
         """Decorator to register a plugin class."""
 
         def inner_wrapper(wrapped_class: Type[BaseProducer]) -> Type[BaseProducer]:
             cls.registry[plugin_name] = wrapped_class
+            spec = cls.specs.get(plugin_name)
+            if spec is None:
+                cls.declare(plugin_name, wrapped_class.__module__, wrapped_class.__name__, wrapped_class.get_args_type().__name__, wrapped_class.is_optional())
+            elif spec.optional != wrapped_class.is_optional():
+                logging.warning(f"Producer \"{plugin_name}\" is declared {'optional' if spec.optional else 'required'}, but its configuration says otherwise.")
             return wrapped_class
 
         return inner_wrapper
@@ -289,6 +519,4 @@ class PluginRegistry(metaclass=PluginRegistryMetaclass):
     @classmethod
     def gather_configs(cls) -> Dict[str, BaseProducerArgs]:
         """Gather the configuration for all registered plugins."""
-        return {name: producer.get_args_type()() for name, producer in cls.registry.items()}
-
-
+        return {name: cls.get_args_type(name)() for name in cls.specs.keys()}
@@ -0,0 +1,247 @@
+"""Dynamic Time Warping engine used for the `ar[dtw]` and `pca[dtw]` behavioral distances.
+
+The distances match `dtaidistance.dtw_ndim.distance_matrix()`, which `moseq2_viz` uses: the dependent (multi-dimensional)
+DTW distance, i.e. the square root of the minimal sum of squared euclidean distances along a warping path.
+
+Instead of running the dynamic program pair by pair in pure python, pairs are processed in batches, and every batch
+sweeps the cost matrix one anti-diagonal at a time, so each python-level step is a numpy operation across all pairs
+of the batch. Batches are spread over a process pool.
+
+Results are equivalent to `dtaidistance` up to floating point rounding (we accumulate in float64, relative
+differences are below 1e-9 in practice; we document a tolerance of `rtol=1e-6`). Two options trade exactness for speed:
+ - `window` restricts warping to a Sakoe-Chiba band (|i - j| < window), with the same semantics as `dtaidistance`.
+   Distances are then greater than or equal to the unconstrained distances.
+ - `max_dist` reports any distance larger than `max_dist` as `inf`. Pairs whose LB_Keogh lower bound exceeds
+   `max_dist` are skipped entirely, and the remaining pairs are abandoned early as soon as no warping path can
+   finish below `max_dist`.
+"""
+import contextlib
+import logging
+from typing import Iterator, List, Optional, Tuple
+
+from joblib import Parallel, delayed
+import numpy as np
+
+from msq_maker.tracing import span
+
+# soft limit on the memory used by the cost tensor of a single batch
+_BATCH_BYTES = 64 * 1024 * 1024
+
+
+def _as_series_array(series) -> np.ndarray:
+    """Coerce `series` to a float64 array of shape (num_series, length, ndim)."""
+    arr = np.asarray(series, dtype="float64")
+    if arr.ndim == 2:
+        arr = arr[:, :, None]
+    if arr.ndim != 3:
+        raise ValueError(f"Expected series of equal length with shape (num_series, length[, ndim]), but got shape {arr.shape}")
+    return arr
+
+
+def _envelope(series: np.ndarray, window: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Compute the lower and upper LB_Keogh envelopes of each series, for a band of half-width `window - 1`."""
+    length = series.shape[1]
+    lower = np.empty_like(series)
+    upper = np.empty_like(series)
+    for i in range(length):
+        lo = max(0, i - window + 1)
+        hi = min(length, i + window)
+        lower[:, i] = series[:, lo:hi].min(axis=1)
+        upper[:, i] = series[:, lo:hi].max(axis=1)
+    return lower, upper
+
+
+def lb_keogh(query: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    """LB_Keogh lower bound of the squared DTW cost between queries and candidates, given the candidates' envelopes.
+
+    Every element of a query is matched at least once, to an element of the candidate inside the band, so the squared
+    distance of each query element to the candidate envelope is a lower bound of its contribution to the DTW cost.
+
+    Args:
+        query (np.ndarray): queries, of shape (num_pairs, length, ndim).
+        lower (np.ndarray): lower envelopes of the candidates, same shape as `query`.
+        upper (np.ndarray): upper envelopes of the candidates, same shape as `query`.
+
+    Returns:
+        np.ndarray: lower bound of the squared DTW cost for each pair, of shape (num_pairs,).
+    """
+    above = np.clip(query - upper, 0, None)
+    below = np.clip(lower - query, 0, None)
+    return np.sum(above ** 2 + below ** 2, axis=(1, 2))
+
+
+def dtw_batch(a: np.ndarray, b: np.ndarray, window: Optional[int] = None, max_dist: Optional[float] = None) -> np.ndarray:
+    """Compute the DTW distance between the series of `a` and the series of `b`, pairwise.
+
+    Args:
+        a (np.ndarray): series of shape (num_pairs, length, ndim).
+        b (np.ndarray): series of shape (num_pairs, length, ndim).
+        window (int|None): Sakoe-Chiba band, only cells with |i - j| < window are considered. None for no constraint.
+        max_dist (float|None): distances above this value are returned as `inf`, allowing to abandon pairs early.
+
+    Returns:
+        np.ndarray: DTW distances of shape (num_pairs,).
+    """
+    num_pairs, length, _ = a.shape
+    if window is None or window > length:
+        window = length
+    max_cost = np.inf if max_dist is None else max_dist ** 2
+
+    # squared euclidean distances between every element of a and every element of b, shape (num_pairs, length, length)
+    cost = np.einsum("pid,pid->pi", a, a)[:, :, None] + np.einsum("pjd,pjd->pj", b, b)[:, None, :] - 2 * np.einsum("pid,pjd->pij", a, b)
+    np.clip(cost, 0, None, out=cost)
+
+    # accumulated cost, with a border of inf so that the recurrence needs no special cases
+    acc = np.full((num_pairs, length + 1, length + 1), np.inf)
+    acc[:, 0, 0] = 0
+
+    active = np.arange(num_pairs)
+    result = np.full(num_pairs, np.inf)
+    prev_min = np.zeros(num_pairs)
+    for k in range(2, 2 * length + 1):
+        # cells (i, j) of the k-th anti-diagonal, in 1-based accumulated cost coordinates, restricted to the band
+        i = np.arange(max(1, k - length), min(length, k - 1) + 1)
+        j = k - i
+        in_band = np.abs(i - j) < window
+        i, j = i[in_band], j[in_band]
+        if len(i) == 0:
+            continue
+
+        best = np.minimum(np.minimum(acc[:, i - 1, j], acc[:, i, j - 1]), acc[:, i - 1, j - 1])
+        values = cost[:, i - 1, j - 1] + best
+        acc[:, i, j] = values
+
+        if max_dist is not None:
+            # every warping path crosses anti-diagonal k or k - 1, so their minimum lower-bounds the final cost
+            cur_min = values.min(axis=1)
+            keep = np.minimum(cur_min, prev_min) <= max_cost
+            if not keep.all():
+                # abandon pairs which can no longer finish below max_dist
+                active, acc, cost, cur_min = active[keep], acc[keep], cost[keep], cur_min[keep]
+                if len(active) == 0:
+                    break
+            prev_min = cur_min
+
+    final = acc[:, length, length]
+    final[final > max_cost] = np.inf
+    result[active] = np.sqrt(final)
+    return result
+
+
+def _dtw_pairs(series: np.ndarray, rows: np.ndarray, cols: np.ndarray, window: Optional[int], max_dist: Optional[float]) -> np.ndarray:
+    """Compute DTW distances for the pairs (rows[k], cols[k]) of `series`, batching to bound memory use."""
+    length = series.shape[1]
+    batch_size = max(1, _BATCH_BYTES // (3 * 8 * (length + 1) ** 2))
+
+    out = np.empty(len(rows))
+    for start in range(0, len(rows), batch_size):
+        stop = start + batch_size
+        with span("dtw_batch", "dtw", pairs=len(rows[start:stop]), length=length):
+            out[start:stop] = dtw_batch(series[rows[start:stop]], series[cols[start:stop]], window=window, max_dist=max_dist)
+    return out
+
+
+def _chunks(num_items: int, num_chunks: int) -> Iterator[slice]:
+    bounds = np.linspace(0, num_items, num_chunks + 1).astype(int)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if stop > start:
+            yield slice(start, stop)
+
+
+def distance_matrix(series, window: Optional[int] = None, max_dist: Optional[float] = None, processes: int = 1) -> np.ndarray:
+    """Compute the symmetric DTW distance matrix between all series.
+
+    Args:
+        series (array-like): series of equal length, of shape (num_series, length, ndim) or (num_series, length).
+        window (int|None): Sakoe-Chiba band, only cells with |i - j| < window are considered. None for no constraint.
+        max_dist (float|None): distances above this value are returned as `inf`. Enables LB_Keogh pruning and early
+            abandoning of pairs.
+        processes (int): number of processes to spread pairs over. Use -1 for all available cores.
+
+    Returns:
+        np.ndarray: distance matrix of shape (num_series, num_series), with zeros on the diagonal.
+    """
+    arr = _as_series_array(series)
+    num_series, length, _ = arr.shape
+    rows, cols = np.triu_indices(num_series, k=1)
+
+    dists = np.full(len(rows), np.inf)
+    todo = np.arange(len(rows))
+    if max_dist is not None and len(rows) > 0:
+        lower, upper = _envelope(arr, length if window is None else window)
+        bound = np.maximum(
+            lb_keogh(arr[rows], lower[cols], upper[cols]),
+            lb_keogh(arr[cols], lower[rows], upper[rows]),
+        )
+        todo = todo[bound <= max_dist ** 2]
+        logging.debug(f"LB_Keogh pruned {len(rows) - len(todo)} of {len(rows)} pairs")
+
+    if len(todo) > 0:
+        if processes == 1:
+            dists[todo] = _dtw_pairs(arr, rows[todo], cols[todo], window, max_dist)
+        else:
+            num_chunks = 4 * (processes if processes > 0 else 8)
+            slices: List[slice] = list(_chunks(len(todo), num_chunks))
+            parts = Parallel(n_jobs=processes)(
+                delayed(_dtw_pairs)(arr, rows[todo[s]], cols[todo[s]], window, max_dist) for s in slices
+            )
+            for s, part in zip(slices, parts):
+                dists[todo[s]] = part
+
+    out = np.zeros((num_series, num_series))
+    out[rows, cols] = dists
+    out[cols, rows] = dists
+    return out
+
+
+class _DtwNdimShim:
+    """Stand-in for the `dtaidistance.dtw_ndim` module, routing distance matrices to this engine."""
+
+    def __init__(self, original, window: Optional[int], max_dist: Optional[float], processes: int):
+        self._original = original
+        self._window = window
+        self._max_dist = max_dist
+        self._processes = processes
+
+    def distance_matrix(self, s, window=None, max_dist=None, parallel=False, **kwargs):
+        try:
+            arr = _as_series_array(s)
+        except ValueError:
+            # series of unequal length, defer to the original implementation
+            return self._original.distance_matrix(s, window=window, max_dist=max_dist, parallel=parallel, **kwargs)
+        return distance_matrix(
+            arr,
+            window=window if window is not None else self._window,
+            max_dist=max_dist if max_dist is not None else self._max_dist,
+            processes=self._processes if parallel else 1,
+        )
+
+    def distance_matrix_fast(self, s, window=None, max_dist=None, parallel=True, **kwargs):
+        return self.distance_matrix(s, window=window, max_dist=max_dist, parallel=parallel, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._original, name)
+
+
+@contextlib.contextmanager
+def patch_moseq2_viz_dtw(window: Optional[int] = None, max_dist: Optional[float] = None, processes: int = -1):
+    """Context manager routing the DTW distance matrices computed by `moseq2_viz.model.dist` to this engine.
+
+    Args:
+        window (int|None): default Sakoe-Chiba band to use when `moseq2_viz` does not specify one.
+        max_dist (float|None): default `max_dist` to use when `moseq2_viz` does not specify one (it never does), see `distance_matrix()`.
+        processes (int): number of processes to use when `moseq2_viz` requests a parallel computation.
+    """
+    import moseq2_viz.model.dist as mv_dist
+
+    original = getattr(mv_dist, "dtw_ndim", None)
+    if original is None:
+        logging.warning("moseq2_viz.model.dist does not use dtaidistance.dtw_ndim, falling back to the moseq2_viz DTW implementation.")
+        yield
+        return
+
+    mv_dist.dtw_ndim = _DtwNdimShim(original, window=window, max_dist=max_dist, processes=processes)
+    try:
+        yield
+    finally:
+        mv_dist.dtw_ndim = original
@@ -0,0 +1,151 @@
+import contextlib
+import copy
+import json
+import logging
+import time
+from dataclasses import asdict
+from typing import Any, Dict, Iterator, List, Optional
+
+from msq_maker.cache import hash_object
+from msq_maker.core import JOURNAL_NAME, MSQ, BaseProducerArgs, ModelConfig
+from msq_maker.spool import DiskSpool, Spool, SpoolSnapshot, TmpfsSpool
+
+
+def snapshot_spool(spool: Spool) -> SpoolSnapshot:
+    """List the files of a spool, with their identity (ex. modification time and size), leaving out the run journal.
+
+    Returns:
+        SpoolSnapshot: identity of each file, keyed by path relative to the spool.
+    """
+    return {name: ident for name, ident in spool.snapshot().items() if name != JOURNAL_NAME}
+
+
+def producer_config_hash(model: ModelConfig, producer_config: BaseProducerArgs) -> str:
+    """Hash the configuration a producer's outputs depend on: the model configuration and the producer's own arguments."""
+    return hash_object({"model": asdict(model), "producer": asdict(producer_config)})
+
+
+class RunJournal:
+    """Append-only journal, stored in the spool, recording the outcome of each producer of a `make-report` run.
+
+    Each line is a JSON object with the producer name, its status ("completed" or "failed"), the hash of its
+    configuration, the spool files it wrote and the manifest entries it added. Lines are flushed to the spool as
+    soon as they are written, so on disk the journal survives the run being killed (ex. node preemption, out of memory).
+
+    Args:
+        spool (Spool): spool of the run, holding the outputs of producers.
+        store (Spool|None): where the journal itself is stored, defaults to `spool`.
+    """
+
+    def __init__(self, spool: Spool, store: Optional[Spool] = None):
+        self.spool = spool
+        self.store = store if store is not None else spool
+
+    @classmethod
+    def for_spool(cls, spool: Spool) -> "RunJournal":
+        """Open the journal of a run spooling to `spool`.
+
+        The journal of a tmpfs spool is kept in its fallback directory on disk (`tmp_dir`), so that it outlives the
+        tmpfs (ex. a reboot) and does not take space there.
+        """
+        if isinstance(spool, TmpfsSpool):
+            return cls(spool, store=DiskSpool(spool.fallback))
+        return cls(spool)
+
+    def exists(self) -> bool:
+        """Check if a journal was stored, ex. by an interrupted run."""
+        return self.store.exists(JOURNAL_NAME)
+
+    def reset(self) -> None:
+        """Start a new, empty journal."""
+        self.store.write_bytes(JOURNAL_NAME, b"")
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """Read all entries of the journal, in order. Entries truncated by an interrupted write are ignored."""
+        if not self.exists():
+            return []
+        entries = []
+        for line in self.store.read_bytes(JOURNAL_NAME).decode("utf-8").splitlines():
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        return entries
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        """Durably append an entry to the journal."""
+        self.store.append_bytes(JOURNAL_NAME, (json.dumps(entry, default=str) + "\n").encode("utf-8"), durable=True)
+
+    def completed(self) -> Dict[str, Dict[str, Any]]:
+        """Get the latest entry of each producer which completed and whose outputs are all still in the spool.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: journal entries keyed by producer name.
+        """
+        latest: Dict[str, Dict[str, Any]] = {}
+        for entry in self.entries():
+            latest[entry["producer"]] = entry
+
+        completed = {}
+        for name, entry in latest.items():
+            if entry["status"] != "completed":
+                continue
+            missing = [o for o in entry["outputs"] if not self.spool.exists(o)]
+            if len(missing) > 0:
+                logging.warning(f"Producer \"{name}\" completed in a previous run, but {len(missing)} of its outputs are missing from the spool.")
+                continue
+            completed[name] = entry
+        return completed
+
+    def resumable(self, name: str, config_hash: str) -> Optional[Dict[str, Any]]:
+        """Get the entry of a producer which can be skipped on resume, if any.
+
+        Args:
+            name (str): producer name.
+            config_hash (str): hash of the producer's current configuration, see `producer_config_hash()`.
+
+        Returns:
+            Dict[str, Any]|None: the journal entry, or None if the producer must run again.
+        """
+        entry = self.completed().get(name)
+        if entry is None:
+            return None
+        if entry["config_hash"] != config_hash:
+            logging.info(f"Configuration of producer \"{name}\" changed since it completed, it will run again.")
+            return None
+        return entry
+
+    @contextlib.contextmanager
+    def record(self, name: str, config_hash: str, msq: MSQ) -> Iterator[None]:
+        """Context manager recording the outcome of the producer run it wraps.
+
+        The outputs of the producer are the spool files created or modified while it ran, and its manifest
+        fragment the manifest entries added or changed.
+
+        Args:
+            name (str): producer name.
+            config_hash (str): hash of the producer's configuration, see `producer_config_hash()`.
+            msq (MSQ): report the producer writes to.
+        """
+        before_files = snapshot_spool(msq.spool)
+        before_manifest = copy.deepcopy(msq.manifest)
+        start = time.time()
+        status = "completed"
+        try:
+            yield
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            after_files = snapshot_spool(msq.spool)
+            outputs = sorted(f for f, ident in after_files.items() if before_files.get(f) != ident)
+            fragment = {k: v for k, v in msq.manifest.items() if k not in before_manifest or before_manifest[k] != v}
+            self.append({
+                "producer": name,
+                "status": status,
+                "config_hash": config_hash,
+                "outputs": outputs,
+                "manifest": fragment,
+                "start": start,
+                "end": time.time(),
+            })
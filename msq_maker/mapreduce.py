@@ -0,0 +1,186 @@
+import hashlib
+import logging
+import os
+from abc import abstractmethod
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional
+
+from joblib import Parallel, delayed
+import numpy as np
+from typing_extensions import Literal
+
+from msq_maker.cache import ObjectCache, file_identity, hash_object, memoized
+from msq_maker.core import MSQ, BaseProducer, PluginRegistry, TProducerArgs
+from msq_maker.tracing import span
+from msq_maker.util import LabelMap, get_cpu_count, get_max_states, get_syllable_id_mapping, load_index, load_model
+
+
+@dataclass
+class SessionContext:
+    """Everything a `MapReduceProducer` knows about a session when mapping it."""
+    uuid: str
+    group: str
+    index_entry: Dict[str, Any]
+    labels: Optional[np.ndarray]
+    max_states: int
+
+    @property
+    def h5_path(self) -> str:
+        """Path to the extraction of the session."""
+        return self.index_entry["path"][0]
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        """Acquisition metadata of the session, from the index."""
+        return self.index_entry.get("metadata", {})
+
+
+class _Missing:
+    pass
+
+
+# sentinel for partial results missing from the cache, since None is a valid partial result
+_MISSING = _Missing()
+
+
+def labels_digest(labels: Optional[np.ndarray]) -> Optional[str]:
+    """Hash the labels of a session, None for sessions without labels."""
+    if labels is None:
+        return None
+    arr = np.ascontiguousarray(labels)
+    return hashlib.sha256(str(arr.dtype).encode("utf-8") + arr.tobytes()).hexdigest()
+
+
+def hash_label_map(label_map: LabelMap) -> str:
+    """Hash a label map, see `get_syllable_id_mapping()`."""
+    return hash_object({str(k): v for k, v in label_map.items()})
+
+
+def _map_one(producer: "MapReduceProducer", ctx: SessionContext) -> Any:
+    with span("map_session", "producer", producer=PluginRegistry.get_plugin_name(type(producer)), uuid=ctx.uuid):
+        return producer.map_session(ctx)
+
+
+class MapReduceProducer(BaseProducer[TProducerArgs]):
+    """Base class for producers whose outputs are combined from independent per-session results.
+
+    Subclasses implement `map_session()`, computing a partial result from a single session, and `reduce()`,
+    combining the partial results of all sessions into outputs of the report. Sessions are mapped across
+    processes (see `MSQConfig.processes`), and partial results are cached (see `MSQConfig.cache_dir`), keyed
+    by the identity of the session's extraction, its labels, the label map and the producer configuration.
+
+    Partial results should preferably be expressed with raw syllable IDs, and leave group filtering to `reduce()`.
+    """
+    per_session = True
+
+    # Which sessions are mapped: sessions of the model (which always have labels), or sessions of the index.
+    session_source: Literal["model", "index"] = "model"
+
+    # Whether partial results are worth caching to disk. Disable when mapping a session is cheaper than loading its result.
+    cache_partials: bool = True
+
+    # Bump when the partial results of `map_session()` change, to invalidate previously cached partial results.
+    partial_version: int = 1
+
+    @abstractmethod
+    def map_session(self, ctx: SessionContext) -> Any:
+        """Compute the partial result of a single session.
+
+        Runs in worker processes, so it should only depend on `ctx`, the configuration and `self.label_map`.
+        """
+        ...
+
+    @abstractmethod
+    def reduce(self, partials: Dict[str, Any], msq: MSQ) -> None:
+        """Combine the partial results of all sessions, keyed by uuid in session order, and write them to the report."""
+        ...
+
+    @property
+    def label_map(self) -> LabelMap:
+        """Label map of the model, available in `map_session()` and `reduce()`."""
+        return self._label_map
+
+    def context(self, uuid: str) -> SessionContext:
+        """Get the context of a mapped session, ex. to know its group in `reduce()`."""
+        return self._contexts[uuid]
+
+    def run(self, msq: MSQ) -> None:
+        self._label_map = get_syllable_id_mapping(self.mconfig.model)
+        contexts = self.sessions()
+        partials = self.map_sessions(contexts)
+        # only kept once mapping is done, since the producer is sent to worker processes
+        self._contexts = {ctx.uuid: ctx for ctx in contexts}
+        self.reduce(partials, msq)
+
+    def sessions(self) -> List[SessionContext]:
+        """Get the sessions of the current shard, see `session_source`."""
+        _, sorted_index = load_index(self.mconfig.index)
+        model = load_model(self.mconfig.model, sort_labels_by_usage=False)
+        max_states = get_max_states(model)
+        labels = dict(zip(model["keys"], model["labels"]))
+
+        uuids = list(model["keys"]) if self.session_source == "model" else list(sorted_index["files"].keys())
+        return [
+            SessionContext(
+                uuid=uuid,
+                group=sorted_index["files"][uuid]["group"],
+                index_entry=sorted_index["files"][uuid],
+                labels=None if uuid not in labels else np.asarray(labels[uuid]),
+                max_states=max_states,
+            )
+            for uuid in uuids
+            if self.in_shard(uuid)
+        ]
+
+    def map_sessions(self, contexts: List[SessionContext]) -> Dict[str, Any]:
+        """Get the partial result of each session, from the cache or by mapping sessions across processes."""
+        name = PluginRegistry.get_plugin_name(type(self))
+        label_map_hash = hash_label_map(self.label_map)
+        keys = [self._partial_key(name, ctx, label_map_hash) for ctx in contexts]
+        # within `shared_memo()`, reports sharing sessions and configuration also share partial results
+        return memoized(f"partials:{name}", keys, lambda: self._map_sessions(name, contexts, keys))
+
+    def _map_sessions(self, name: str, contexts: List[SessionContext], keys: List[str]) -> Dict[str, Any]:
+        cache = self._get_partial_cache(name)
+        partials: Dict[str, Any] = {}
+        missing = []
+        for ctx, key in zip(contexts, keys):
+            cached = cache.get(key, default=_MISSING) if cache is not None else _MISSING
+            if cached is _MISSING:
+                missing.append((ctx, key))
+            else:
+                partials[ctx.uuid] = cached
+        logging.info(f"Mapping {len(missing)} session(s) for \"{name}\", {len(contexts) - len(missing)} cached.")
+
+        processes = self.config.msq.processes if self.config.msq.processes != "auto" else get_cpu_count()
+        if processes == 1 or len(missing) <= 1:
+            results = [_map_one(self, ctx) for ctx, _ in missing]
+        else:
+            results = Parallel(n_jobs=min(processes, len(missing)))(delayed(_map_one)(self, ctx) for ctx, _ in missing)
+
+        for (ctx, key), result in zip(missing, results):
+            partials[ctx.uuid] = result
+            if cache is not None:
+                cache.put(key, result)
+
+        # keep the session order
+        return {ctx.uuid: partials[ctx.uuid] for ctx in contexts}
+
+    def _get_partial_cache(self, name: str) -> Optional[ObjectCache]:
+        if not self.cache_partials or not self.config.msq.cache_dir:
+            return None
+        return ObjectCache(os.path.join(self.config.msq.cache_dir, "partials", name))
+
+    def _partial_key(self, name: str, ctx: SessionContext, label_map_hash: str) -> str:
+        producer_config = {k: v for k, v in asdict(self.pconfig).items() if k != "enabled"}
+        return hash_object({
+            "producer": name,
+            "version": self.partial_version,
+            "uuid": ctx.uuid,
+            "h5": file_identity(ctx.h5_path),
+            "labels": labels_digest(ctx.labels),
+            "max_states": ctx.max_states,
+            "label_map": label_map_hash,
+            "max_syl": self.mconfig.max_syl,
+            "config": producer_config,
+        })
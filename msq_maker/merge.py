@@ -0,0 +1,167 @@
+import glob
+import json
+import logging
+import os
+from typing import Any, Dict, List
+
+from msq_maker.core import JOURNAL_NAME, MSQ, Shard
+
+
+# Name of the file, relative to a partial spool, describing the shard it holds.
+SHARD_INFO_NAME = "shard.json"
+
+# Files of partial spools which are not report contents.
+_SPOOL_BOOKKEEPING = {JOURNAL_NAME, SHARD_INFO_NAME, "manifest.json", "msq_config.json"}
+
+
+def write_shard_info(msq: MSQ, shard: Shard) -> None:
+    """Finish a partial spool: write its manifest and the description of the shard it holds."""
+    msq._write_manifest()
+    msq.write_unstructured(SHARD_INFO_NAME, {"index": shard.index, "count": shard.count})
+
+
+def find_shard_spools(tmp_dir: str) -> List[str]:
+    """Find the partial spools of the shards of a report, see `Shard.spool_path()`."""
+    return sorted(p for p in glob.glob(f"{os.path.normpath(tmp_dir)}.shard-*-of-*") if os.path.isdir(p))
+
+
+def _read_shard_infos(spool_paths: List[str]) -> Dict[int, str]:
+    shards: Dict[int, str] = {}
+    counts = set()
+    for path in spool_paths:
+        info_path = os.path.join(path, SHARD_INFO_NAME)
+        if not os.path.exists(info_path):
+            raise ValueError(f"\"{path}\" is not a finished partial spool, it has no {SHARD_INFO_NAME}.")
+        with open(info_path, "r") as f:
+            info = json.load(f)
+        if info["index"] in shards:
+            raise ValueError(f"\"{path}\" and \"{shards[info['index']]}\" both hold shard {info['index']}.")
+        shards[info["index"]] = path
+        counts.add(info["count"])
+
+    if len(counts) != 1:
+        raise ValueError(f"Partial spools come from runs with different numbers of shards: {sorted(counts)}.")
+    count = counts.pop()
+    missing = sorted(set(range(count)) - set(shards.keys()))
+    if len(missing) > 0:
+        raise ValueError(f"Missing partial spools for shard(s) {', '.join(f'{i}/{count}' for i in missing)}.")
+    return shards
+
+
+def is_split_dataframe(obj: Any) -> bool:
+    """Check if a JSON payload is a dataframe written by `MSQ.write_dataframe()`, with orient="split"."""
+    return isinstance(obj, dict) and set(obj.keys()) == {"columns", "index", "data"}
+
+
+def is_sparse_payload(obj: Any) -> bool:
+    """Check if a JSON payload is a collection of sparse matrices written by `MSQ.write_sparse()`."""
+    return isinstance(obj, dict) and obj.get("format") == "coo" and "matrices" in obj
+
+
+def concat_split_dataframes(frames: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Concatenate dataframes serialized with orient="split", aligning their columns.
+
+    Rows keep their values exactly as serialized, and are renumbered from zero.
+    """
+    columns: List[Any] = []
+    for frame in frames:
+        columns.extend(c for c in frame["columns"] if c not in columns)
+
+    data = []
+    for frame in frames:
+        if frame["columns"] == columns:
+            data.extend(frame["data"])
+        else:
+            positions = {c: i for i, c in enumerate(frame["columns"])}
+            data.extend([row[positions[c]] if c in positions else None for c in columns] for row in frame["data"])
+    return {"columns": columns, "index": list(range(len(data))), "data": data}
+
+
+def merge_sparse(payloads: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merge sparse matrix collections written by `MSQ.write_sparse()`.
+
+    Matrices present in several collections (ex. per group counts) are summed, dictionary attributes
+    (ex. the group of each session) are combined, and other attributes are taken from the first collection.
+    """
+    merged: Dict[str, Any] = {k: v for k, v in payloads[0].items() if k != "matrices"}
+    merged["matrices"] = {}
+    for payload in payloads:
+        if payload["shape"] != merged["shape"] and len(payload["matrices"]) > 0:
+            if len(merged["matrices"]) > 0:
+                raise ValueError(f"Cannot merge sparse matrices of shapes {merged['shape']} and {payload['shape']}.")
+            merged["shape"] = payload["shape"]
+        for k, v in payload.items():
+            if isinstance(v, dict) and k != "matrices":
+                combined = dict(merged.get(k, {}))
+                for kk, vv in v.items():
+                    combined.setdefault(kk, vv)
+                merged[k] = combined
+        for key, mat in payload["matrices"].items():
+            if key in merged["matrices"]:
+                # concatenated entries with repeated coordinates are summed when read back as COO
+                for part in ["row", "col", "data"]:
+                    merged["matrices"][key][part] = merged["matrices"][key][part] + mat[part]
+            else:
+                merged["matrices"][key] = {part: list(mat[part]) for part in ["row", "col", "data"]}
+    return merged
+
+
+def merge_manifests(manifests: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merge manifests, combining nested dictionaries (ex. one scalars file per syllable) and keeping the first value otherwise."""
+    merged: Dict[str, Any] = {}
+    for manifest in manifests:
+        for k, v in manifest.items():
+            if k not in merged:
+                merged[k] = v
+            elif isinstance(merged[k], dict) and isinstance(v, dict):
+                merged[k] = merge_manifests([merged[k], v])
+    return merged
+
+
+def merge_spools(spool_paths: List[str], msq: MSQ) -> None:
+    """Merge the partial spools of all shards of a report into the spool of `msq`.
+
+    Files written by a single shard are copied. Dataframes written by several shards are concatenated,
+    sparse matrices combined, and for other files the copy of the lowest shard is kept.
+
+    Args:
+        spool_paths (List[str]): partial spools, one per shard.
+        msq (MSQ): report receiving the merged contents. Its manifest is updated with the merged manifests.
+    """
+    shards = _read_shard_infos(spool_paths)
+    ordered = [shards[i] for i in sorted(shards.keys())]
+    logging.info(f"Merging {len(ordered)} partial spools into \"{msq.spool}\"...")
+
+    sources: Dict[str, List[str]] = {}
+    for spool in ordered:
+        for root, _, files in os.walk(spool):
+            for file in files:
+                rel = os.path.relpath(os.path.join(root, file), spool)
+                if rel not in _SPOOL_BOOKKEEPING:
+                    sources.setdefault(rel, []).append(spool)
+
+    for rel, spools in sorted(sources.items()):
+        if len(spools) == 1 or not rel.endswith(".json"):
+            msq.spool.add_file(rel, os.path.join(spools[0], rel))
+            continue
+
+        payloads = []
+        for spool in spools:
+            with open(os.path.join(spool, rel), "r") as f:
+                payloads.append(json.load(f))
+
+        if all(is_split_dataframe(p) for p in payloads):
+            merged = concat_split_dataframes(payloads)
+        elif all(is_sparse_payload(p) for p in payloads):
+            merged = merge_sparse(payloads)
+        else:
+            msq.spool.add_file(rel, os.path.join(spools[0], rel))
+            continue
+        with msq.open(rel, "w") as f:
+            json.dump(merged, f)
+
+    manifests = []
+    for spool in ordered:
+        with open(os.path.join(spool, "manifest.json"), "r") as f:
+            manifests.append(json.load(f))
+    msq.manifest.update(merge_manifests(manifests))
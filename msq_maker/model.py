@@ -1,12 +1,15 @@
 import logging
 import os
-from typing import List, Optional
-from moseq2_viz.model.util import parse_model_results
-from moseq2_viz.util import parse_index
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import List, Mapping, Optional, Tuple
+import numpy as np
 import pandas as pd
 
+from msq_maker.cache import hash_object, memoized_file
 from msq_maker.core import ModelConfig
-from msq_maker.util import get_groups_index, get_max_syllable
+from msq_maker.tracing import span
+from msq_maker.util import get_groups_index, get_max_syllable, load_model
 
 def parse_manifest(manifest_file: str) -> pd.DataFrame:
     """Parses the manifest file into a DataFrame.
@@ -34,6 +37,108 @@ def parse_manifest(manifest_file: str) -> pd.DataFrame:
     return df
 
 
+def load_manifest(manifest_file: str) -> pd.DataFrame:
+    """Parse a manifest with `parse_manifest()`.
+
+    The latest manifest is parsed once per process, and again only when the file changes (see `msq_maker.cache.memoized_file()`).
+
+    Args:
+        manifest_file (str): The path to the manifest file.
+
+    Returns:
+        pd.DataFrame: a copy of the parsed manifest DataFrame.
+    """
+    def parse() -> pd.DataFrame:
+        with span("parse_manifest", "io", path=manifest_file):
+            return parse_manifest(manifest_file)
+    return memoized_file("manifest", manifest_file, parse, latest_only=True).copy()
+
+
+@dataclass(frozen=True)
+class ManifestInfo:
+    """Session IDs from a manifest, see `get_manifest()`.
+
+    Attributes:
+        path (str): absolute path to the manifest.
+        uuid_column (str): column of the manifest holding the uuids of the extractions.
+        session_id_column (str): column of the manifest holding the session IDs.
+        uuid_to_session_id (Mapping[str, str]): session ID of each uuid listed in the manifest.
+    """
+    path: str
+    uuid_column: str
+    session_id_column: str
+    uuid_to_session_id: Mapping[str, str]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Get the manifest projected to its uuid and session ID columns."""
+        return pd.DataFrame({
+            self.uuid_column: list(self.uuid_to_session_id.keys()),
+            self.session_id_column: list(self.uuid_to_session_id.values()),
+        })
+
+
+def _manifest_sidecar_path(cache_dir: str, manifest_file: str, uuid_column: str, session_id_column: str) -> str:
+    key = hash_object({"path": os.path.abspath(manifest_file), "columns": [uuid_column, session_id_column]})
+    return os.path.join(cache_dir, "manifests", f"{key[:16]}.npz")
+
+
+def _project_manifest(manifest_file: str, uuid_column: str, session_id_column: str) -> Tuple[np.ndarray, np.ndarray]:
+    manifest = load_manifest(manifest_file)
+    for column in [uuid_column, session_id_column]:
+        if column not in manifest.columns:
+            raise ValueError(f"Manifest \"{manifest_file}\" does not contain the column \"{column}\".")
+    listed = manifest.dropna(subset=[uuid_column, session_id_column])
+    return listed[uuid_column].astype(str).to_numpy(dtype=str), listed[session_id_column].astype(str).to_numpy(dtype=str)
+
+
+def get_manifest(manifest_file: str, uuid_column: str, session_id_column: str, cache_dir: str = "") -> ManifestInfo:
+    """Get the session ID of each uuid listed in a manifest.
+
+    Manifests are projected to their uuid and session ID columns, and the projection is saved as a sidecar in
+    `<cache_dir>/manifests`, so the manifest itself (slow to parse for large spreadsheets) is only parsed again
+    when it changes. Within a process, the result is kept until the manifest changes (see `msq_maker.cache.memoized_file()`).
+
+    Args:
+        manifest_file (str): path to the manifest.
+        uuid_column (str): column holding the uuids of the extractions.
+        session_id_column (str): column holding the session IDs.
+        cache_dir (str): directory of the sidecar, if empty the projection is not saved.
+
+    Raises:
+        ValueError: if the manifest lacks one of the columns.
+    """
+    def build() -> ManifestInfo:
+        stat = os.stat(manifest_file)
+        identity = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+        sidecar = _manifest_sidecar_path(cache_dir, manifest_file, uuid_column, session_id_column) if cache_dir else None
+
+        columns = None
+        if sidecar is not None and os.path.exists(sidecar):
+            try:
+                with np.load(sidecar, allow_pickle=False) as data:
+                    if np.array_equal(data["identity"], identity):
+                        columns = (data["uuid"], data["session_id"])
+            except (OSError, ValueError, KeyError):
+                logging.debug(f"Ignoring unreadable manifest sidecar \"{sidecar}\".")
+
+        if columns is None:
+            columns = _project_manifest(manifest_file, uuid_column, session_id_column)
+            if sidecar is not None:
+                os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+                tmp_path = f"{sidecar}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.savez(f, identity=identity, uuid=columns[0], session_id=columns[1])
+                os.replace(tmp_path, sidecar)
+
+        return ManifestInfo(
+            path=os.path.abspath(manifest_file),
+            uuid_column=uuid_column,
+            session_id_column=session_id_column,
+            uuid_to_session_id=MappingProxyType(dict(zip(columns[0].tolist(), columns[1].tolist()))),
+        )
+    return memoized_file(f"manifest_info:{hash_object([uuid_column, session_id_column])}", manifest_file, build, latest_only=True)
+
+
 def get_model_config(model_file: Optional[str], index_file: Optional[str], manifest_file: Optional[str], manifest_uuid_col: str, manifest_session_id_col: str, raw_dir: Optional[str], groups: Optional[List[str]]) -> ModelConfig:
     """Retrieves the model configuration for a given model name.
 
@@ -48,7 +153,7 @@ def get_model_config(model_file: Optional[str], index_file: Optional[str], manif
 
     if model_file is not None:
         config.model = os.path.abspath(model_file)
-        model = parse_model_results(config.model, sort_labels_by_usage=True)
+        model = load_model(config.model, sort_labels_by_usage=True)
         config.max_syl = get_max_syllable(model)
     else:
         logging.warning("No model file provided, you are responsible for setting the following fields in the [model] section of the configuration:")
@@ -58,7 +163,6 @@ def get_model_config(model_file: Optional[str], index_file: Optional[str], manif
 
     if index_file is not None:
         config.index = os.path.abspath(index_file)
-        index, _ = parse_index(config.index)
         available_groups = get_groups_index(config.index)
         if groups is not None and len(groups) > 0:
             logging.info("Groups were supplied")
@@ -92,7 +196,7 @@ def get_model_config(model_file: Optional[str], index_file: Optional[str], manif
         config.manifest_path = os.path.abspath(manifest_file)
         config.manifest_uuid_column = manifest_uuid_col
         config.manifest_session_id_column = manifest_session_id_col
-        manifest = parse_manifest(manifest_file)
+        manifest = load_manifest(manifest_file)
         if config.manifest_uuid_column not in manifest.columns:
             logging.warning(f"Manifest does not contain the column \"{config.manifest_uuid_column}\", which should contain the UUIDs of the recordings. You are responsible for setting the correct column in the [model] section of the configuration.")
         if config.manifest_session_id_column not in manifest.columns:
@@ -1,2 +1,17 @@
-from . import make_crowd_matrix
-from . import retrieve_pcs_from_slices
+import sys
+from typing import Any, Callable
+
+
+def patch_function(module: Any, name: str, replacement: Callable) -> None:
+    """Replace a function of `moseq2_viz` in the module defining it, and in every loaded module which imported it
+    (ex. with `from ... import`), so that modules imported before the patch do not keep calling the original.
+    """
+    original = getattr(module, name)
+    for loaded in list(sys.modules.values()):
+        if loaded is not None and getattr(loaded, "__dict__", {}).get(name) is original:
+            setattr(loaded, name, replacement)
+    setattr(module, name, replacement)
+
+
+from . import make_crowd_matrix  # noqa: E402
+from . import retrieve_pcs_from_slices  # noqa: E402
@@ -5,6 +5,8 @@ import h5py
 import moseq2_viz.viz
 import numpy as np
 
+from msq_maker.monkey_patch import patch_function
+
 def is_detectron_extraction(h5: h5py.File) -> bool:
     """Check if the extraction metadata indicates a Detectron2 extraction.
 
@@ -238,4 +240,4 @@ def make_crowd_matrix_d2_compat(slices, nexamples=50, pad=30, raw_size=(512, 424
 
 
 # Monkey patch the make_crowd_matrix function in moseq2_viz.viz to enable compatibility with Detectron2 extractions
-moseq2_viz.viz.make_crowd_matrix = make_crowd_matrix_d2_compat
+patch_function(moseq2_viz.viz, "make_crowd_matrix", make_crowd_matrix_d2_compat)
@@ -1,51 +1,127 @@
-import moseq2_viz
+import hashlib
+from typing import Dict
+
+import moseq2_viz.model.util
 import numpy as np
-from sklearn.cluster import KMeans
-from cytoolz import compose
-from cytoolz.curried import get
-from moseq2_viz.model.util import _gen_to_arr
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from typing_extensions import Literal
 
+from msq_maker.monkey_patch import patch_function
+from msq_maker.tracing import traced
 
-def retrieve_pcs_from_slices_fixed(slices, pca_scores, max_dur=60, min_dur=3,
-                             max_samples=100, npcs=10, subsampling=None,
-                             remove_offset=False, **kwargs):
+
+# An instance table holds one row per syllable instance, as parallel arrays:
+#  - "syllable": syllable label of the instance
+#  - "start", "end": frame span of the instance, end exclusive
+#  - "uuid": session the instance belongs to
+InstanceTable = Dict[str, np.ndarray]
+
+
+def instance_table_from_slices(slices) -> InstanceTable:
+    """Build an instance table from syllable slices, as produced by `moseq2_viz.model.util.syllable_slices()`.
+
+    Args:
+        slices (iterable): tuples of ((start, end), uuid, h5 path) for instances of a single syllable.
+
+    Returns:
+        InstanceTable: table of the instances, with syllable set to -1 since it is not known from the slices.
     """
-    Subsample Principal components from syllable slices
+    slices = list(slices)
+    return {
+        "syllable": np.full(len(slices), -1, dtype="int64"),
+        "start": np.array([s[0][0] for s in slices], dtype="int64"),
+        "end": np.array([s[0][1] for s in slices], dtype="int64"),
+        "uuid": np.array([s[1] for s in slices], dtype=object),
+    }
+
+
+def select_instances(table: InstanceTable, mask: np.ndarray) -> InstanceTable:
+    """Select rows of an instance table with a boolean mask or an index array."""
+    return {k: v[mask] for k, v in table.items()}
+
+
+def instance_rng(table: InstanceTable, seed: int = 0) -> np.random.Generator:
+    """Get a random generator seeded from `seed` and the contents of an instance table.
+
+    The generator does not depend on any global state, nor on the order in which syllables are processed,
+    so sampling gives the same results from run to run.
 
     Args:
-    slices (np.ndarray): syllable slices or subarrays
-    pca_scores (np.ndarray): PC scores for respective session.
-    max_dur (int): maximum syllable length.
-    min_dur (int): minimum syllable length.
-    max_samples (int): maximum number of samples to retrieve.
-    npcs (int): number of pcs to use.
-    subsampling (int): number of syllable subsamples (defined through KMeans clustering).
-    remove_offset (bool): indicate whether to remove initial offset from each PC score.
-    kwargs (dict): used to capture certain arguments in other parts of the codebase.
+        table (InstanceTable): instances to be sampled.
+        seed (int): base random seed.
 
     Returns:
-    syllable_matrix (np.ndarray): 3D matrix of subsampled PC projected syllable slices.
+        np.random.Generator: generator dedicated to this set of instances.
     """
-    # pad using zeros, get dtw distances...
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(table["start"], dtype="int64").tobytes())
+    digest.update(np.ascontiguousarray(table["end"], dtype="int64").tobytes())
+    digest.update("\0".join(str(u) for u in table["uuid"]).encode("utf-8"))
+    entropy = [int.from_bytes(digest.digest()[i:i + 4], "little") for i in range(0, 16, 4)]
+    return np.random.default_rng(np.random.SeedSequence([seed, *entropy]))
+
+
+def gather_pc_windows(table: InstanceTable, pca_scores: Dict[str, np.ndarray], max_dur: int, npcs: int) -> np.ndarray:
+    """Gather the PC scores of each instance into a zero padded (num_instances, max_dur, npcs) array.
+
+    Windows are gathered with one fancy-indexing operation per session, rather than one copy per instance.
+
+    Args:
+        table (InstanceTable): instances to gather, each at most `max_dur` frames long.
+        pca_scores (Dict[str, np.ndarray]): PC scores keyed by session uuid.
+        max_dur (int): length of the output windows.
+        npcs (int): number of PCs to keep.
+
+    Returns:
+        np.ndarray: array of PC windows, as float32.
+    """
+    out = np.zeros((len(table["start"]), max_dur, npcs), "float32")
+    offsets = np.arange(max_dur)
+    for uuid in np.unique(table["uuid"]):
+        rows = np.where(table["uuid"] == uuid)[0]
+        scores = pca_scores[uuid]
+        frames = table["start"][rows, None] + offsets[None, :]
+        valid = (offsets[None, :] < (table["end"][rows] - table["start"][rows])[:, None]) & (frames < len(scores))
+        windows = scores[np.clip(frames, 0, len(scores) - 1), :npcs]
+        windows[~valid] = 0
+        out[rows, :, :windows.shape[2]] = windows
+    return out
+
+
+@traced("sample_pc_trajectories", "pca")
+def sample_pc_trajectories(table: InstanceTable, pca_scores: Dict[str, np.ndarray], max_dur=60, min_dur=3,
+                           max_samples=100, npcs=10, subsampling=None, remove_offset=False, seed=0,
+                           clustering: Literal["kmeans", "minibatch"] = "kmeans", max_iter=300) -> np.ndarray:
+    """Subsample PC trajectories for the instances of a single syllable.
+
+    Args:
+        table (InstanceTable): instances of a single syllable.
+        pca_scores (Dict[str, np.ndarray]): PC scores keyed by session uuid.
+        max_dur (int): maximum syllable length (exclusive).
+        min_dur (int): minimum syllable length (exclusive).
+        max_samples (int): number of samples to draw, with replacement. If None, a single sample is drawn.
+        npcs (int): number of pcs to use.
+        subsampling (int): number of syllable subsamples (defined through clustering).
+        remove_offset (bool): indicate whether to remove initial offset from each PC score.
+        seed (int): base random seed, combined with the instances to seed sampling and clustering.
+        clustering (str): "kmeans" for full KMeans, or "minibatch" for the cheaper MiniBatchKMeans.
+        max_iter (int): maximum number of clustering iterations.
+
+    Returns:
+        np.ndarray: 3D matrix of subsampled PC projected syllable instances.
+    """
+    durs = table["end"] - table["start"]
+    table = select_instances(table, (durs < max_dur) & (durs > min_dur))
+    rng = instance_rng(table, seed)
 
-    # make function to filter syll durations
-    filter_dur = compose(lambda dur: (dur < max_dur) & (dur > min_dur),
-                         lambda inds: inds[1] - inds[0],
-                         get(0))
-    filtered_slices = _gen_to_arr(filter(filter_dur, slices))
     # select random samples
-    if(len(filtered_slices) > 0):
-        inds = np.random.randint(0, len(filtered_slices), size=max_samples)
-        if not hasattr(inds, 'shape'):
-            inds = [inds]
-        use_slices = filtered_slices[inds]
+    if len(table["start"]) > 0:
+        inds = rng.integers(0, len(table["start"]), size=1 if max_samples is None else max_samples)
+        table = select_instances(table, inds)
     else:
-        use_slices = []
-
-    syllable_matrix = np.zeros((len(use_slices), max_dur, npcs), 'float32')
+        table = select_instances(table, np.array([], dtype="int64"))
 
-    for i, (idx, uuid, _) in enumerate(use_slices):
-        syllable_matrix[i, :idx[1]-idx[0], :] = pca_scores[uuid][idx[0]:idx[1], :npcs]
+    syllable_matrix = gather_pc_windows(table, pca_scores, max_dur, npcs)
 
     if remove_offset:
         syllable_matrix = syllable_matrix - syllable_matrix[:, 0, :][:, None, :]
@@ -53,7 +129,11 @@ def retrieve_pcs_from_slices_fixed(slices, pca_scores, max_dur=60, min_dur=3,
     # get cluster averages - really good at selecting for different durations of a syllable
     if subsampling is not None and subsampling > 0:
         try:
-            km = KMeans(subsampling)
+            random_state = int(rng.integers(0, 2**31 - 1))
+            if clustering == "minibatch":
+                km = MiniBatchKMeans(subsampling, max_iter=max_iter, random_state=random_state)
+            else:
+                km = KMeans(subsampling, max_iter=max_iter, random_state=random_state)
             syllable_matrix = syllable_matrix.reshape(syllable_matrix.shape[0], max_dur * npcs)
             syllable_matrix = syllable_matrix[np.all(~np.isnan(syllable_matrix), axis=1), :]
             km.fit(syllable_matrix)
@@ -63,6 +143,44 @@ def retrieve_pcs_from_slices_fixed(slices, pca_scores, max_dur=60, min_dur=3,
 
     return syllable_matrix
 
+
+def retrieve_pcs_from_slices_fixed(slices, pca_scores, max_dur=60, min_dur=3,
+                             max_samples=100, npcs=10, subsampling=None,
+                             remove_offset=False, seed=0, clustering="kmeans", max_iter=300, **kwargs):
+    """
+    Subsample Principal components from syllable slices
+
+    Args:
+    slices (np.ndarray): syllable slices or subarrays
+    pca_scores (np.ndarray): PC scores for respective session.
+    max_dur (int): maximum syllable length.
+    min_dur (int): minimum syllable length.
+    max_samples (int): maximum number of samples to retrieve.
+    npcs (int): number of pcs to use.
+    subsampling (int): number of syllable subsamples (defined through KMeans clustering).
+    remove_offset (bool): indicate whether to remove initial offset from each PC score.
+    seed (int): base random seed. Sampling uses a generator seeded from this seed and the slices, never the global RNG.
+    clustering (str): "kmeans" or "minibatch", the clustering used for subsampling.
+    max_iter (int): maximum number of clustering iterations.
+    kwargs (dict): used to capture certain arguments in other parts of the codebase.
+
+    Returns:
+    syllable_matrix (np.ndarray): 3D matrix of subsampled PC projected syllable slices.
+    """
+    return sample_pc_trajectories(
+        instance_table_from_slices(slices),
+        pca_scores,
+        max_dur=max_dur,
+        min_dur=min_dur,
+        max_samples=max_samples,
+        npcs=npcs,
+        subsampling=subsampling,
+        remove_offset=remove_offset,
+        seed=seed,
+        clustering=clustering,
+        max_iter=max_iter,
+    )
+
 # Monkey patch the retrieve_pcs_from_slices function in moseq2_viz.model.util
 # see https://github.com/dattalab/moseq2-viz/issues/130 for why this is necessary
-moseq2_viz.model.util.retrieve_pcs_from_slices = retrieve_pcs_from_slices_fixed
+patch_function(moseq2_viz.model.util, "retrieve_pcs_from_slices", retrieve_pcs_from_slices_fixed)
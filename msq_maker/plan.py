@@ -0,0 +1,503 @@
+import logging
+import os
+import shutil
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import psutil
+
+from msq_maker.core import BaseOptionalProducerArgs, MoseqReportsConfig, PluginRegistry
+from msq_maker.profiling import format_bytes
+from msq_maker.spool import TMPFS_ROOT, SpoolBackend, existing_spool_backend, has_tmpfs, tmpfs_capacity
+from msq_maker.synth import SynthOptions
+from msq_maker.util import get_cpu_count, get_index, get_max_states, get_roi_size, load_model
+
+
+# Rough cost coefficients, measured on typical workstations. `msq-maker benchmark` results passed as a calibration
+# (see `calibrate()`) rescale them to the machine at hand.
+
+# Frame rate of moseq sessions.
+DEFAULT_FPS = 30.0
+# Resident memory of a process which imported msq-maker, pandas and moseq2_viz, and of a worker process.
+BASE_RSS = 400 * 2**20
+WORKER_RSS = 200 * 2**20
+# Memory held by the parsed model, per frame of labels (labels and their copies).
+MODEL_BYTES_PER_FRAME = 32
+# Size of a JSON encoded number in a dataframe (`orient="split"`) and of a long-form row of syllable statistics.
+JSON_BYTES_PER_VALUE = 18
+LONG_FORM_ROW_BYTES = 160
+# Ratio of the size of bundled (deflated) JSON to its size in the spool.
+JSON_COMPRESSION = 0.25
+# Scalars kept per frame (columns in mm and other units, `_px` columns are dropped).
+SCALAR_COLUMNS = 24
+# Seconds to compute the per-session results of a frame of labels, and to read and convert a frame of scalars.
+LABEL_SECONDS_PER_FRAME = 2e-7
+SCALAR_SECONDS_PER_FRAME = 4e-6
+# Seconds of DTW for a pair of syllables, per distance using DTW.
+DTW_SECONDS_PER_PAIR = 2e-3
+# Seconds to read, crop and composite an example frame of a crowd movie, and bytes per pixel of encoded movies.
+CROWD_SECONDS_PER_FRAME = 2e-3
+MOVIE_BYTES_PER_PIXEL = 0.02
+# Seconds to render an example of a spinogram, and its size as JSON.
+SPINOGRAM_SECONDS_PER_EXAMPLE = 0.05
+SPINOGRAM_BYTES_PER_EXAMPLE = 20 * 2**10
+# Seconds to locate a raw session, seek and start decoding a clip, to decode and encode a frame, and resident memory of a clip worker.
+CLIP_SECONDS_OVERHEAD = 1.0
+CLIP_SECONDS_PER_FRAME = 3e-3
+CLIP_WORKER_RSS = 300 * 2**20
+
+
+@dataclass
+class RunStats:
+    """Measurable quantities which drive the cost of a run.
+
+    Attributes:
+        sessions (int): number of sessions in the report.
+        frames (int): total number of frames of the sessions.
+        max_session_frames (int): number of frames of the longest session.
+        instances (int): number of syllable instances (runs of consecutive identical labels) of the sessions.
+        num_syllables (int): number of syllables in the report, those used by the sessions up to `max_syl`.
+        max_states (int): `max_states` parameter of the model.
+        raw_size (Tuple[int, int]): width and height of the raw depth frames (arena), in pixels.
+        workers (int): number of worker processes of per-session producers.
+        fps (float): frame rate of the sessions.
+    """
+    sessions: int
+    frames: int
+    max_session_frames: int
+    instances: int
+    num_syllables: int
+    max_states: int
+    raw_size: Tuple[int, int]
+    workers: int
+    fps: float = DEFAULT_FPS
+
+    @property
+    def mean_duration(self) -> float:
+        """Mean duration of a syllable instance, in frames."""
+        return self.frames / self.instances if self.instances > 0 else 0.0
+
+
+@dataclass
+class ProducerEstimate:
+    """Estimated cost of a producer, see `estimate_producers()`.
+
+    Attributes:
+        producer (str): name of the producer.
+        runtime (float): wall time, in seconds.
+        peak_memory (int): peak resident memory of the run while the producer runs, workers and subprocesses included, in bytes.
+        spool_bytes (int): size of the outputs written to the spool, in bytes.
+        bundle_bytes (int): size of the outputs within the bundled report, in bytes.
+        notes (List[str]): assumptions behind the estimate.
+    """
+    producer: str
+    runtime: float = 0.0
+    peak_memory: int = BASE_RSS
+    spool_bytes: int = 0
+    bundle_bytes: int = 0
+    notes: List[str] = field(default_factory=list)
+
+
+@dataclass
+class RunPlan:
+    """Estimated cost of a run, and the problems found checking it against the resources available."""
+    stats: RunStats
+    estimates: List[ProducerEstimate]
+    problems: List[str] = field(default_factory=list)
+    calibration: Optional[str] = None
+
+    @property
+    def runtime(self) -> float:
+        return sum(e.runtime for e in self.estimates)
+
+    @property
+    def peak_memory(self) -> int:
+        return max((e.peak_memory for e in self.estimates), default=BASE_RSS)
+
+    @property
+    def spool_bytes(self) -> int:
+        return sum(e.spool_bytes for e in self.estimates)
+
+    @property
+    def bundle_bytes(self) -> int:
+        return sum(e.bundle_bytes for e in self.estimates)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "stats": asdict(self.stats),
+            "producers": [asdict(e) for e in self.estimates],
+            "total": {"runtime": self.runtime, "peak_memory": self.peak_memory, "spool_bytes": self.spool_bytes, "bundle_bytes": self.bundle_bytes},
+            "problems": self.problems,
+            "calibration": self.calibration,
+        }
+
+    def summary_table(self) -> str:
+        """Format the estimates as a human readable table."""
+        header = ["producer", "runtime", "peak memory", "spool", "bundle"]
+        rows = [header]
+        for e in self.estimates + [ProducerEstimate("total", self.runtime, self.peak_memory, self.spool_bytes, self.bundle_bytes)]:
+            rows.append([e.producer, format_duration(e.runtime), format_bytes(e.peak_memory), format_bytes(e.spool_bytes), format_bytes(e.bundle_bytes)])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        lines = ["  ".join(cell.ljust(w) for cell, w in zip(row, widths)) for row in rows]
+        lines.insert(1, "  ".join("-" * w for w in widths))
+        lines.insert(len(lines) - 1, lines[1])
+        return "\n".join(lines)
+
+
+def format_duration(seconds: float) -> str:
+    """Format a duration in human readable units."""
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f}min"
+    return f"{seconds / 3600:.1f}h"
+
+
+def _resolve_processes(processes: Any) -> int:
+    return get_cpu_count() if processes == "auto" else max(int(processes), 1)
+
+
+def gather_stats(config: MoseqReportsConfig) -> RunStats:
+    """Measure the sessions, frames and syllable instances a run processes, from its index and model labels."""
+    mconfig = config.model
+    index = get_index(mconfig.index)
+    uuids = [u for u, g in index.uuid_to_group.items() if not mconfig.groups or g in mconfig.groups]
+    model = load_model(mconfig.model, sort_labels_by_usage=False)
+    labels = dict(zip(model["keys"], model["labels"]))
+
+    lengths = []
+    instances = 0
+    used = set()
+    for uuid in uuids:
+        seq = np.asarray(labels.get(uuid, []))
+        seq = seq[seq >= 0]  # padding of the first frames
+        lengths.append(len(seq))
+        instances += int(np.count_nonzero(seq[1:] != seq[:-1])) + (1 if len(seq) > 0 else 0)
+        used.update(np.unique(seq).tolist())
+
+    raw_size = SynthOptions.raw_size
+    crowd_movies = config.producers.get("crowd_movies")
+    if crowd_movies is not None and getattr(crowd_movies, "raw_size", "auto") != "auto":
+        raw_size = tuple(crowd_movies.raw_size)
+    elif len(uuids) > 0:
+        try:
+            raw_size = get_roi_size(index.uuid_to_h5[uuids[0]])
+        except (OSError, KeyError, ValueError):
+            logging.warning(f"Could not read the arena size of session \"{uuids[0]}\", assuming {raw_size[0]}x{raw_size[1]} frames.")
+
+    return RunStats(
+        sessions=len(uuids),
+        frames=int(sum(lengths)),
+        max_session_frames=max(lengths, default=0),
+        instances=instances,
+        num_syllables=min(mconfig.max_syl, len(used)),
+        max_states=get_max_states(model),
+        raw_size=(int(raw_size[0]), int(raw_size[1])),
+        workers=_resolve_processes(config.msq.processes),
+    )
+
+
+CostModel = Callable[[RunStats, Any], ProducerEstimate]
+_COST_MODELS: Dict[str, CostModel] = {}
+
+
+def cost_model(name: str) -> Callable[[CostModel], CostModel]:
+    """Register the cost model of a producer, a function estimating its cost from the run statistics and its configuration."""
+    def register(func: CostModel) -> CostModel:
+        _COST_MODELS[name] = func
+        return func
+    return register
+
+
+def _model_rss(stats: RunStats) -> int:
+    return BASE_RSS + stats.frames * MODEL_BYTES_PER_FRAME
+
+
+def _json_estimate(stats: RunStats, runtime: float, data_bytes: int, spool_bytes: int, workers: int = 0, worker_bytes: int = 0) -> ProducerEstimate:
+    return ProducerEstimate(
+        producer="",
+        runtime=runtime,
+        peak_memory=int(_model_rss(stats) + data_bytes + workers * (WORKER_RSS + worker_bytes)),
+        spool_bytes=int(spool_bytes),
+        bundle_bytes=int(spool_bytes * JSON_COMPRESSION),
+    )
+
+
+def _map_runtime(stats: RunStats, seconds_per_frame: float) -> float:
+    # sessions are spread over workers, the longest session bounds the time when there are few sessions
+    return max(stats.frames * seconds_per_frame / stats.workers, stats.max_session_frames * seconds_per_frame)
+
+
+@cost_model("label_map")
+@cost_model("groups")
+@cost_model("sample_manifest")
+def _small_outputs(stats: RunStats, pconfig: Any) -> ProducerEstimate:
+    spool = stats.sessions * 500 + stats.max_states * 200
+    return _json_estimate(stats, 0.5, 0, spool)
+
+
+@cost_model("usage")
+@cost_model("entropy")
+def _per_syllable_statistics(stats: RunStats, pconfig: Any) -> ProducerEstimate:
+    rows = stats.sessions * stats.num_syllables * 2
+    return _json_estimate(stats, _map_runtime(stats, LABEL_SECONDS_PER_FRAME), rows * LONG_FORM_ROW_BYTES, rows * LONG_FORM_ROW_BYTES,
+                          workers=stats.workers)
+
+
+@cost_model("transitions")
+def _transitions(stats: RunStats, pconfig: Any) -> ProducerEstimate:
+    if getattr(pconfig, "sparse", False):
+        # observed transitions only, bounded by the number of instances
+        entries = min(stats.instances, stats.sessions * stats.num_syllables ** 2)
+        spool = entries * 3 * JSON_BYTES_PER_VALUE
+        data = stats.sessions * stats.max_states ** 2 * 8
+    else:
+        # long-form rows for every pair of states of every session, filtered to `max_syl` after the fact
+        spool = stats.sessions * stats.num_syllables ** 2 * LONG_FORM_ROW_BYTES
+        data = stats.sessions * stats.max_states ** 2 * LONG_FORM_ROW_BYTES
+    return _json_estimate(stats, _map_runtime(stats, LABEL_SECONDS_PER_FRAME) + data * 1e-8, data, spool, workers=stats.workers)
+
+
+@cost_model("scalars")
+def _scalars(stats: RunStats, pconfig: Any) -> ProducerEstimate:
+    # one row per frame, all gathered before being split by syllable
+    data = stats.frames * SCALAR_COLUMNS * 8 * 2
+    spool = stats.frames * SCALAR_COLUMNS * JSON_BYTES_PER_VALUE
+    estimate = _json_estimate(stats, _map_runtime(stats, SCALAR_SECONDS_PER_FRAME) + spool * 5e-9, data, spool,
+                              workers=stats.workers, worker_bytes=stats.max_session_frames * SCALAR_COLUMNS * 8 * 3)
+    estimate.notes.append("one row per frame")
+    return estimate
+
+
+@cost_model("behavioral_distance")
+def _behavioral_distance(stats: RunStats, pconfig: Any) -> ProducerEstimate:
+    distances = list(getattr(pconfig, "distances", []))
+    pairs = stats.num_syllables ** 2
+    dtw = sum(1 for d in distances if d.endswith("[dtw]"))
+    workers = _resolve_processes(getattr(pconfig, "processes", "auto"))
+    runtime = dtw * pairs * DTW_SECONDS_PER_PAIR / workers + len(distances) * stats.frames * LABEL_SECONDS_PER_FRAME
+    spool = pairs * max(len(distances), 1) * LONG_FORM_ROW_BYTES
+    # PCA scores of the sessions are loaded to sample instances
+    data = stats.frames * SynthOptions.npcs * 8 if any(d.startswith("pca") for d in distances) else 0
+    estimate = _json_estimate(stats, runtime, data, spool, workers=workers if dtw > 0 else 0)
+    estimate.notes.append("cached distances are not computed again")
+    return estimate
+
+
+def _movie_frames(stats: RunStats, pconfig: Any) -> int:
+    max_dur = getattr(pconfig, "max_dur", None)
+    duration = max_dur if max_dur is not None else 3 * stats.mean_duration
+    return int(duration + 2 * getattr(pconfig, "pad", 0))
+
+
+@cost_model("crowd_movies")
+def _crowd_movies(stats: RunStats, pconfig: Any) -> ProducerEstimate:
+    workers = _resolve_processes(pconfig.processes)
+    frames = _movie_frames(stats, pconfig)
+    pixels = stats.raw_size[0] * stats.raw_size[1]
+    spool = stats.num_syllables * frames * pixels * MOVIE_BYTES_PER_PIXEL
+    runtime = stats.num_syllables * pconfig.max_examples * frames * CROWD_SECONDS_PER_FRAME / workers
+    # each worker composites a movie, as RGB frames
+    worker_bytes = frames * pixels * 3 * 2
+    return ProducerEstimate(
+        producer="",
+        runtime=runtime,
+        peak_memory=int(_model_rss(stats) + workers * (WORKER_RSS + worker_bytes)),
+        spool_bytes=int(spool),
+        bundle_bytes=int(spool),  # movies are already compressed
+    )
+
+
+@cost_model("spinograms")
+def _spinograms(stats: RunStats, pconfig: Any) -> ProducerEstimate:
+    examples = stats.num_syllables * pconfig.max_examples
+    workers = _resolve_processes(pconfig.processors)
+    return _json_estimate(stats, examples * SPINOGRAM_SECONDS_PER_EXAMPLE / workers, 0, examples * SPINOGRAM_BYTES_PER_EXAMPLE,
+                          workers=workers)
+
+
+@cost_model("syllable_clips")
+def _syllable_clips(stats: RunStats, pconfig: Any) -> ProducerEstimate:
+    streams = max(len(pconfig.streams), 1)
+    clips = stats.num_syllables * pconfig.max_examples * streams
+    frames = (pconfig.prepend + pconfig.append) * stats.fps + stats.mean_duration
+    workers = _resolve_processes(pconfig.processors)
+    spool = clips * frames * stats.raw_size[0] * stats.raw_size[1] * MOVIE_BYTES_PER_PIXEL
+    estimate = ProducerEstimate(
+        producer="",
+        runtime=clips * (CLIP_SECONDS_OVERHEAD + frames * CLIP_SECONDS_PER_FRAME) / workers,
+        peak_memory=int(BASE_RSS + workers * CLIP_WORKER_RSS),
+        spool_bytes=int(spool),
+        bundle_bytes=int(spool),
+    )
+    estimate.notes.append(f"{streams} stream(s) of {stats.raw_size[0]}x{stats.raw_size[1]} frames")
+    return estimate
+
+
+def enabled_producers(config: MoseqReportsConfig) -> List[Tuple[str, Any]]:
+    """List the producers a run executes, with their configuration, in order."""
+    producers = []
+    for name, pconfig in config.producers.items():
+        if isinstance(pconfig, BaseOptionalProducerArgs) and pconfig.enabled is False:
+            continue
+        if name not in PluginRegistry.specs and PluginRegistry.get(name) is None:
+            continue
+        producers.append((name, pconfig))
+    return producers
+
+
+def estimate_producers(stats: RunStats, config: MoseqReportsConfig) -> List[ProducerEstimate]:
+    """Estimate the cost of each enabled producer of a run (see `cost_model()`). Producers without a cost model are listed with no cost."""
+    estimates = []
+    for name, pconfig in enabled_producers(config):
+        model = _COST_MODELS.get(name)
+        if model is None:
+            estimates.append(ProducerEstimate(producer=name, notes=["no cost model"]))
+            continue
+        estimate = model(stats, pconfig)
+        estimate.producer = name
+        estimates.append(estimate)
+    return estimates
+
+
+def calibrate(estimates: List[ProducerEstimate], results: Dict[str, Any]) -> None:
+    """Rescale estimates by how the cost models compare to `msq-maker benchmark` results, measured on this machine.
+
+    The cost models are evaluated at the largest benchmarked size (a synthetic dataset, see `msq_maker.synth`), and the runtime and
+    peak memory (above `BASE_RSS`) of each producer are multiplied by the ratio of the measured to the estimated values there.
+    """
+    sizes = sorted(int(s) for s in results.get("sizes", {}).keys())
+    if len(sizes) == 0:
+        return
+    size = sizes[-1]
+    measured = results["sizes"][str(size)]
+    frames = int(results.get("meta", {}).get("frames", SynthOptions.frames))
+    bench_stats = RunStats(
+        sessions=size,
+        frames=size * frames,
+        max_session_frames=frames,
+        instances=int(size * frames / SynthOptions.mean_duration),
+        num_syllables=MoseqReportsConfig().model.max_syl,
+        max_states=SynthOptions.max_states,
+        raw_size=SynthOptions.raw_size,
+        workers=get_cpu_count(),
+        fps=SynthOptions.fps,
+    )
+    bench_config = MoseqReportsConfig()
+    for estimate in estimates:
+        m = measured.get(f"producer:{estimate.producer}")
+        model = _COST_MODELS.get(estimate.producer)
+        if m is None or model is None or not m.get("ok", True):
+            continue
+        predicted = model(bench_stats, bench_config.producers.get(estimate.producer))
+        if predicted.runtime > 0 and m["wall_time"] > 0:
+            estimate.runtime *= m["wall_time"] / predicted.runtime
+        # the measured increase of RSS over the start of the benchmark stands for the estimate above the base interpreter
+        measured_rss = m.get("peak_rss_increase", 0)
+        if measured_rss > 0 and predicted.peak_memory > BASE_RSS:
+            estimate.peak_memory = BASE_RSS + int((estimate.peak_memory - BASE_RSS) * measured_rss / (predicted.peak_memory - BASE_RSS))
+        estimate.notes.append(f"calibrated at {size} sessions")
+
+
+def _existing_ancestor(path: str) -> str:
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def check_resources(plan: RunPlan, config: MoseqReportsConfig, memory_budget: Optional[int] = None) -> List[str]:
+    """Check the estimates of a run against the workers, memory and free disk space available.
+
+    Args:
+        plan (RunPlan): the estimated run.
+        config (MoseqReportsConfig): configuration of the run.
+        memory_budget (int|None): memory the run may use, in bytes. Defaults to the memory available on this machine.
+
+    Returns:
+        List[str]: human readable descriptions of each problem.
+    """
+    problems = []
+    cpus = get_cpu_count()
+    if plan.stats.workers > cpus:
+        problems.append(f"`processes` is {plan.stats.workers}, but only {cpus} CPU core(s) are available.")
+
+    budget = memory_budget if memory_budget is not None else psutil.virtual_memory().available
+    overlapped = sum(e.peak_memory - BASE_RSS for e in plan.estimates if e.producer in ("spinograms", "syllable_clips")) if config.msq.overlap_subprocesses else 0
+    for e in plan.estimates:
+        # subprocess producers run in the background, alongside the other producers
+        peak = e.peak_memory + (overlapped if e.producer not in ("spinograms", "syllable_clips") else 0)
+        if peak > budget:
+            problems.append(f"{e.producer} may use {format_bytes(peak)} of memory, more than the {format_bytes(budget)} available"
+                            " (lower `processes`, or disable overlapping subprocesses).")
+
+    backend = config.msq.spool_backend
+    if backend == "memory":
+        if plan.peak_memory + plan.spool_bytes > budget:
+            problems.append(f"The spool may use {format_bytes(plan.spool_bytes)} of memory on top of the producers, more than the {format_bytes(budget)} available"
+                            " (use another `spool_backend`).")
+        needs: Dict[str, int] = {_existing_ancestor(config.msq.out_dir): plan.bundle_bytes}
+    else:
+        spool_dir = TMPFS_ROOT if backend == "tmpfs" and has_tmpfs() else _existing_ancestor(config.msq.tmp_dir)
+        out_dir = _existing_ancestor(config.msq.out_dir)
+        needs = {spool_dir: plan.spool_bytes}
+        # the spool is only removed once the report is bundled
+        if os.stat(spool_dir).st_dev == os.stat(out_dir).st_dev:
+            needs[spool_dir] += plan.bundle_bytes
+        else:
+            needs[out_dir] = plan.bundle_bytes
+    for path, needed in needs.items():
+        free = shutil.disk_usage(path).free
+        if needed > free:
+            problems.append(f"The run needs {format_bytes(needed)} of disk space on \"{path}\", but only {format_bytes(free)} is free.")
+    return problems
+
+
+def plan_run(config: MoseqReportsConfig, calibration: Optional[Dict[str, Any]] = None, memory_budget: Optional[int] = None) -> RunPlan:
+    """Estimate the runtime, peak memory, spool and bundle size of each enabled producer of a run, and check they fit the machine.
+
+    Args:
+        config (MoseqReportsConfig): configuration of the run.
+        calibration (Dict|None): results of `msq-maker benchmark` on this machine, see `calibrate()`.
+        memory_budget (int|None): memory the run may use, in bytes, see `check_resources()`.
+    """
+    stats = gather_stats(config)
+    plan = RunPlan(stats=stats, estimates=estimate_producers(stats, config))
+    if calibration is not None:
+        calibrate(plan.estimates, calibration)
+        plan.calibration = f"{max(int(s) for s in calibration['sizes'])} sessions" if calibration.get("sizes") else None
+    plan.problems = check_resources(plan, config, memory_budget=memory_budget)
+    return plan
+
+
+def choose_spool_backend(config: MoseqReportsConfig) -> SpoolBackend:
+    """Pick where a run spools its report, resolving the "auto" `spool_backend`, which must be opted into (see `msq_maker.spool`).
+
+    "auto" reopens the spool of a previous run, if any, so that it can be resumed. Otherwise it picks tmpfs when the
+    estimated spool of the run fits in free memory (see `tmpfs_capacity()`), unless the spool is kept after the run
+    (`cleanup` is false). Partial spools of shards are always on disk, to be merged by another process.
+    """
+    backend = config.msq.spool_backend
+    if config.shard is not None:
+        if backend not in ("auto", "disk"):
+            logging.warning(f"Ignoring `spool_backend` \"{backend}\", partial spools of shards are written to disk.")
+        return "disk"
+    if backend != "auto":
+        return backend
+
+    existing = existing_spool_backend(config.msq.tmp_dir)
+    if existing is not None:
+        return existing
+    if not config.msq.cleanup or not has_tmpfs():
+        return "disk"
+    try:
+        spool_bytes = sum(e.spool_bytes for e in estimate_producers(gather_stats(config), config))
+    except Exception:
+        logging.debug("Could not estimate the size of the spool, spooling to disk.", exc_info=True)
+        return "disk"
+    capacity = tmpfs_capacity()
+    if spool_bytes > capacity:
+        logging.info(f"The spool may take {format_bytes(spool_bytes)}, more than the {format_bytes(capacity)} tmpfs may hold, spooling to disk.")
+        return "disk"
+    return "tmpfs"
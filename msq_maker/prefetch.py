@@ -0,0 +1,80 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from msq_maker.core import BaseOptionalProducerArgs, MoseqReportsConfig, PluginRegistry
+from msq_maker.model import get_manifest
+from msq_maker.tracing import span
+from msq_maker.util import get_index, get_syllable_id_mapping, load_model
+
+
+# Number of threads loading inputs. Loads are mostly waiting on (network) storage, so this exceeds the number of cores.
+PREFETCH_THREADS = 8
+
+
+class Prefetcher:
+    """Load the inputs of a run concurrently in background threads, before producers need them.
+
+    Inputs are loaded through the memoized loaders (ex. `msq_maker.util.load_model()`, `msq_maker.util.get_index()`),
+    so producers get the prefetched results simply by calling them, waiting for loads still in flight. Loads are
+    futures in `futures`, keyed by name. Failed loads are only logged: producers run into the same error, where
+    it is reported as usual.
+    """
+
+    def __init__(self, config: MoseqReportsConfig, threads: int = PREFETCH_THREADS):
+        self.config = config
+        self.futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="msq-prefetch")
+
+    def start(self) -> None:
+        """Start loading the model, label map, index, manifest, and the inputs producers declare (see `BaseProducer.prefetch()`)."""
+        mconfig = self.config.model
+        if mconfig.model:
+            self.submit("model", lambda: load_model(mconfig.model, sort_labels_by_usage=False))
+            self.submit("label_map", lambda: get_syllable_id_mapping(mconfig.model))
+        if mconfig.index:
+            self.submit("index", lambda: get_index(mconfig.index))
+        if mconfig.manifest_path:
+            self.submit("manifest", lambda: get_manifest(mconfig.manifest_path, mconfig.manifest_uuid_column, mconfig.manifest_session_id_column,
+                                                         cache_dir=self.config.msq.cache_dir))
+        self.submit("producers", self._start_producer_loads)
+
+    def submit(self, name: str, load: Callable[[], Any]) -> Future:
+        """Start a load in the background."""
+        def run() -> Any:
+            with span(f"prefetch:{name}", "io"):
+                return load()
+        future = self._executor.submit(run)
+        future.add_done_callback(lambda f: self._log_failure(name, f))
+        with self._lock:
+            self.futures[name] = future
+        return future
+
+    def wait(self) -> None:
+        """Wait for all loads started so far."""
+        with self._lock:
+            futures = list(self.futures.values())
+        for future in futures:
+            if not future.cancelled():
+                future.exception()
+
+    def shutdown(self) -> None:
+        """Wait for loads in flight and stop the background threads."""
+        self._executor.shutdown(wait=True)
+
+    def _start_producer_loads(self) -> None:
+        for producer_name, producer_config in self.config.producers.items():
+            if isinstance(producer_config, BaseOptionalProducerArgs) and producer_config.enabled is False:
+                continue
+            producer_class = PluginRegistry.get(producer_name)
+            if producer_class is None:
+                continue
+            loads: List[Callable[[], Any]] = producer_class(self.config).prefetch()
+            for i, load in enumerate(loads):
+                self.submit(f"{producer_name}:{i}", load)
+
+    def _log_failure(self, name: str, future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logging.debug(f"Prefetching \"{name}\" failed: {future.exception()!r}")
@@ -0,0 +1,165 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Tuple
+
+from joblib import Parallel, delayed
+
+from msq_maker.core import BaseOptionalProducerArgs, BaseProducer, MoseqReportsConfig, PluginRegistry
+from msq_maker.tracing import span
+from msq_maker.util import format_list, get_cpu_count, get_index, load_model
+
+
+# Number of threads running the checks of producers. Checks mostly wait on (network) storage.
+PREFLIGHT_THREADS = 8
+
+
+@dataclass
+class PreflightReport:
+    """Problems found checking the inputs of a run, see `run_preflight()`.
+
+    Attributes:
+        errors (List[str]): problems which would make producers fail.
+        warnings (List[str]): problems which producers work around, ex. sessions left out of the report.
+    """
+    errors: List[str] = field(default_factory=list)
+    warnings: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return len(self.errors) == 0
+
+    def log(self) -> None:
+        """Write the problems found to the log."""
+        for warning in self.warnings:
+            logging.warning(f"Preflight: {warning}")
+        if self.ok:
+            logging.info("Preflight checks passed.")
+            return
+        logging.error(f"Preflight checks found {len(self.errors)} problem(s):")
+        for error in self.errors:
+            logging.error(f" - {error}")
+
+
+def check_extraction(h5_path: str, datasets: List[str]) -> Tuple[str, List[str]]:
+    """Check that an extraction opens and has some datasets.
+
+    Returns:
+        Tuple[str, List[str]]: why the extraction cannot be opened (empty if it opened), and the datasets it lacks.
+    """
+    import h5py
+
+    if not os.path.exists(h5_path):
+        return "not found", []
+    try:
+        with h5py.File(h5_path, "r") as h5:
+            return "", [d for d in datasets if d not in h5]
+    except OSError:
+        return "cannot be opened", []
+
+
+def check_extractions(h5_paths: Iterable[str], datasets: Dict[str, List[str]], processes: int) -> List[str]:
+    """Check, across processes, that extractions open and have the datasets producers need.
+
+    Args:
+        h5_paths (Iterable[str]): paths to the extractions.
+        datasets (Dict[str, List[str]]): datasets each extraction must have, with the producers needing them.
+        processes (int): number of processes checking extractions.
+
+    Returns:
+        List[str]: human readable descriptions of each problem, one per kind of problem.
+    """
+    paths = sorted(set(h5_paths))
+    names = list(datasets.keys())
+    # hdf5 serializes calls within a process, so extractions are checked in several processes
+    n_jobs = min(processes, len(paths))
+    if n_jobs <= 1:
+        results = [check_extraction(path, names) for path in paths]
+    else:
+        results = Parallel(n_jobs=n_jobs, batch_size=max(len(paths) // (n_jobs * 4), 1))(delayed(check_extraction)(path, names) for path in paths)
+
+    unopened: Dict[str, List[str]] = {}
+    lacking: Dict[str, List[str]] = {name: [] for name in names}
+    for path, (error, missing) in zip(paths, results):
+        if error:
+            unopened.setdefault(error, []).append(path)
+        for name in missing:
+            lacking[name].append(path)
+
+    problems = [f"{len(p)} extraction(s) {error}: {format_list(p)}." for error, p in unopened.items()]
+    for name, p in lacking.items():
+        if len(p) > 0:
+            problems.append(f"{len(p)} extraction(s) lack the dataset \"{name}\" (needed by {', '.join(datasets[name])}): {format_list(p)}.")
+    return problems
+
+
+def check_sessions(config: MoseqReportsConfig, report: PreflightReport) -> None:
+    """Check that the sessions of the index and the model match."""
+    mconfig = config.model
+    index = get_index(mconfig.index)
+    keys = set(load_model(mconfig.model, sort_labels_by_usage=False)["keys"])
+
+    unknown_groups = [g for g in mconfig.groups if g not in index.groups]
+    if len(unknown_groups) > 0:
+        report.warnings.append(f"{len(unknown_groups)} group(s) of the configuration are not in the index: {format_list(unknown_groups)}.")
+
+    not_indexed = sorted(keys - set(index.uuid_to_h5))
+    if len(not_indexed) > 0:
+        report.warnings.append(f"{len(not_indexed)} session(s) of the model are not in the index, and are left out: {format_list(not_indexed)}.")
+    unlabeled = sorted(set(index.uuid_to_h5) - keys)
+    if len(unlabeled) > 0:
+        report.warnings.append(f"{len(unlabeled)} session(s) of the index have no labels in the model, and are left out: {format_list(unlabeled)}.")
+
+
+def run_preflight(config: MoseqReportsConfig) -> PreflightReport:
+    """Check, before a run starts, that the inputs of its enabled producers are usable, so that problems surface in seconds rather than when a producer hits them.
+
+    Checks that the model and index exist and list the same sessions, that every extraction of the index opens and has
+    the datasets producers need (see `BaseProducer.required_datasets()`), and runs the checks of each producer (see
+    `BaseProducer.preflight()`), ex. that the raw sessions of syllable clips can be located.
+
+    Returns:
+        PreflightReport: problems found.
+    """
+    report = PreflightReport()
+    mconfig = config.model
+    for kind, path in [("Model", mconfig.model), ("Index", mconfig.index)]:
+        if not path or not os.path.exists(path):
+            report.errors.append(f"{kind} \"{path}\" not found.")
+    if not report.ok:
+        return report
+
+    with span("preflight", "io"):
+        try:
+            check_sessions(config, report)
+        except Exception as e:
+            report.errors.append(f"The model and index cannot be loaded: {e!r}")
+            return report
+
+        producers = []
+        for name, producer_config in config.producers.items():
+            if isinstance(producer_config, BaseOptionalProducerArgs) and producer_config.enabled is False:
+                continue
+            producer_class = PluginRegistry.get(name)
+            if producer_class is not None:
+                producers.append((name, producer_class(config)))
+
+        datasets: Dict[str, List[str]] = {}
+        for name, producer in producers:
+            for dataset in producer.required_datasets():
+                datasets.setdefault(dataset, []).append(name)
+
+        def check(name: str, producer: BaseProducer) -> List[str]:
+            try:
+                return [f"{name}: {problem}" for problem in producer.preflight()]
+            except Exception as e:
+                return [f"{name}: checks failed with {e!r}"]
+
+        with ThreadPoolExecutor(max_workers=PREFLIGHT_THREADS) as executor:
+            producer_checks = executor.map(check, *zip(*producers)) if len(producers) > 0 else []
+            processes = config.msq.processes if config.msq.processes != "auto" else get_cpu_count()
+            report.errors.extend(check_extractions(get_index(mconfig.index).uuid_to_h5.values(), datasets, processes))
+            for problems in producer_checks:
+                report.errors.extend(problems)
+    return report
@@ -1,11 +1,27 @@
-from .behavioral_distance import BehavioralDistanceProducer, BehavioralDistanceConfig
-from .crowd_movies import CrowdMoviesProducer, CrowdMoviesConfig
-from .entropy import EntropyProducer, EntropyConfig
-from .groups import GroupsProducer, GroupsConfig
-from .label_map import LabelMapProducer, LabelMapConfig
-from .sample_manifest import SampleManifestProducer, SampleManifestConfig
-from .scalars import ScalarsProducer, ScalarsConfig
-from .spinograms import SpinogramsProducer, SpinogramsConfig
-from .syllable_clips import SyllableClipsProducer, SyllableClipsConfig
-from .transitions import TransitionsProducer, TransitionsConfig
-from .usage import UsageProducer, UsageConfig
+import importlib
+from typing import Any
+
+from ..core import PluginRegistry
+
+
+# Built-in producers, in the order they run. Their modules (and heavy dependencies, ex. moseq2_viz, cv2, sklearn)
+# are only imported when a producer or its configuration is first needed, see `PluginRegistry`.
+PluginRegistry.declare("behavioral_distance", f"{__name__}.behavioral_distance", "BehavioralDistanceProducer", "BehavioralDistanceConfig")
+PluginRegistry.declare("crowd_movies", f"{__name__}.crowd_movies", "CrowdMoviesProducer", "CrowdMoviesConfig")
+PluginRegistry.declare("entropy", f"{__name__}.entropy", "EntropyProducer", "EntropyConfig")
+PluginRegistry.declare("groups", f"{__name__}.groups", "GroupsProducer", "GroupsConfig", optional=False)
+PluginRegistry.declare("label_map", f"{__name__}.label_map", "LabelMapProducer", "LabelMapConfig", optional=False)
+PluginRegistry.declare("sample_manifest", f"{__name__}.sample_manifest", "SampleManifestProducer", "SampleManifestConfig", optional=False)
+PluginRegistry.declare("scalars", f"{__name__}.scalars", "ScalarsProducer", "ScalarsConfig")
+PluginRegistry.declare("spinograms", f"{__name__}.spinograms", "SpinogramsProducer", "SpinogramsConfig")
+PluginRegistry.declare("syllable_clips", f"{__name__}.syllable_clips", "SyllableClipsProducer", "SyllableClipsConfig")
+PluginRegistry.declare("transitions", f"{__name__}.transitions", "TransitionsProducer", "TransitionsConfig")
+PluginRegistry.declare("usage", f"{__name__}.usage", "UsageProducer", "UsageConfig")
+
+
+def __getattr__(name: str) -> Any:
+    # producer and configuration classes remain importable from this package, ex. `from msq_maker.producers import UsageProducer`
+    for spec in PluginRegistry.specs.values():
+        if name in (spec.class_name, spec.config_name) and spec.module.startswith(f"{__name__}."):
+            return getattr(importlib.import_module(spec.module), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,12 +1,17 @@
+import contextlib
+import logging
+import os
 from dataclasses import dataclass, field
-from typing import List, Type
+from typing import Any, Dict, List, Optional, Type, Union
+from typing_extensions import Literal
 
-from moseq2_viz.model.dist import get_behavioral_distance
-from moseq2_viz.util import parse_index
 import numpy as np
 import pandas as pd
 
-from ..util import get_max_states, get_syllable_id_mapping, syllableMatricesToLongForm
+from ..cache import NpyCache, hash_file, hash_object, memoized
+from ..dtw import patch_moseq2_viz_dtw
+from ..tracing import span
+from ..util import get_cpu_count, get_syllable_id_mapping, load_index, reindex_label_map, syllableMatricesToLongForm
 from ..core import MSQ, BaseOptionalProducerArgs, BaseProducer, PluginRegistry
 
 
@@ -17,6 +22,16 @@ class BehavioralDistanceConfig(BaseOptionalProducerArgs):
     You should not need to modify this configuration.
     """
     distances: List[str] = field(default_factory=lambda: ["ar[init]", "ar[dtw]", "scalars", "pca[dtw]"], metadata={"doc": "List of distances to compute"})
+    dtw_engine: Literal["msq_maker", "moseq2_viz"] = field(default="msq_maker", metadata={"doc": "Engine computing the `ar[dtw]` and `pca[dtw]` distances. \"msq_maker\" uses the vectorized engine of this package, which matches \"moseq2_viz\" up to floating point rounding."})
+    dtw_window: Union[int, None] = field(default=None, metadata={"doc": "Sakoe-Chiba band for the `msq_maker` DTW engine, only allowing warping of less than this many frames. None for no constraint (exact distances)."})
+    dtw_max_dist: Union[float, None] = field(default=None, metadata={"doc": "Largest DTW distance the `msq_maker` DTW engine computes exactly: larger distances are reported as infinite, which lets the engine skip pairs (LB_Keogh lower bound) or abandon them early. None to compute every distance exactly."})
+    seed: int = field(default=0, metadata={"doc": "Random seed for sampling the syllable instances compared by `pca[dtw]`. Samples only depend on the seed and the instances of each syllable, not on the order syllables are processed in."})
+    clustering: Literal["kmeans", "minibatch"] = field(default="kmeans", metadata={"doc": "Clustering used to summarize the sampled instances of each syllable for `pca[dtw]`. \"minibatch\" is faster on large datasets, but its cluster centers differ slightly from \"kmeans\"."})
+    processes: Union[int, Literal["auto"]] = field(default="auto", metadata={"doc": "Number of processes to use for DTW distances with the `msq_maker` engine. If \"auto\", will use the number of available CPU cores (taking into account CPU affinity on systems that support it). Sampling the instances of each syllable for `pca[dtw]` does not use them: moseq2-viz samples one syllable at a time."})
+
+
+# key of the `dist_options` entry consumed by each distance in `get_behavioral_distance()`
+DISTANCE_OPTION_KEYS = {"ar[init]": "ar[init]", "ar[dtw]": "ar[dtw]", "scalars": "scalars", "pca[dtw]": "pca"}
 
 
 @PluginRegistry.register("behavioral_distance")
@@ -27,26 +42,100 @@ class BehavioralDistanceProducer(BaseProducer[BehavioralDistanceConfig]):
         return BehavioralDistanceConfig
 
     def run(self, msq: MSQ):
-        _, sorted_index = parse_index(self.mconfig.index)
-        dist_opts = {"ar[dtw]": {"parallel": True}, "pca": {"parallel": True}}
-        with np.errstate(invalid='ignore', divide='ignore'):
-            dist = get_behavioral_distance(
-                sorted_index,
-                self.mconfig.model,
-                max_syllable=get_max_states(self.mconfig.model),
-                sort_labels_by_usage=False,
-                count="usage",
-                dist_options=dist_opts,
-                distances=self.pconfig.distances,
-            )
-
         syllable_mapping = get_syllable_id_mapping(self.mconfig.model)
 
-        df_dict = syllableMatricesToLongForm(dist, syllable_mapping)
+        # Only syllables with a usage ID below max_syl are kept in the report. Labels are sorted by usage
+        # so that the distance engine only computes distances between the first `num_syllables` usage IDs,
+        # instead of computing the full matrix over all states and discarding most of it afterwards.
+        usage_mapping = reindex_label_map(syllable_mapping, by="usage")
+        num_syllables = len([uid for uid in usage_mapping.keys() if 0 <= uid < self.mconfig.max_syl])
+
+        dist_opts: Dict[str, Dict[str, Any]] = {"ar[dtw]": {"parallel": True}, "pca": {"parallel": True, "seed": self.pconfig.seed, "clustering": self.pconfig.clustering}}
+        cache_keys = {name: self._cache_key(name, num_syllables, dist_opts) for name in self.pconfig.distances}
+        dist = memoized("behavioral_distance", cache_keys, lambda: self._compute_distances(num_syllables, dist_opts, cache_keys))
+
+        # matrices are indexed by usage ID, so use the usage-indexed label map to recover raw and frames IDs
+        df_dict = syllableMatricesToLongForm(dist, usage_mapping)
 
         df = pd.DataFrame.from_dict(data=df_dict)
-        df = df[(df["row_id_usage"] < self.mconfig.max_syl) & (df["col_id_usage"] < self.mconfig.max_syl)]
 
         dest = "behaveDistances.ms{}.json".format(self.mconfig.max_syl)
         msq.write_dataframe(dest, df)
         msq.manifest["behave_dist"] = dest
+
+    def required_datasets(self) -> List[str]:
+        return ["scalars"] if "scalars" in self.pconfig.distances else []
+
+    def preflight(self) -> List[str]:
+        if not any(name.startswith("pca") for name in self.pconfig.distances):
+            return []
+        # PCA scores of the sessions are located by the index
+        _, sorted_index = load_index(self.mconfig.index)
+        pca_path = sorted_index.get("pca_path")
+        needed_by = ", ".join(n for n in self.pconfig.distances if n.startswith("pca"))
+        if not pca_path:
+            return [f"The index has no `pca_path`, needed for the {needed_by} distance(s)."]
+        if not os.path.exists(pca_path):
+            return [f"PCA scores \"{pca_path}\" not found, needed for the {needed_by} distance(s)."]
+        return []
+
+    def _compute_distances(self, num_syllables: int, dist_opts: Dict[str, Dict[str, Any]], cache_keys: Dict[str, str]) -> Dict[str, np.ndarray]:
+        cache = self._get_cache()
+
+        dist: Dict[str, np.ndarray] = {}
+        if cache is not None:
+            for name in self.pconfig.distances:
+                cached = cache.get(cache_keys[name])
+                if cached is not None:
+                    logging.info(f"Using cached \"{name}\" distances from {cache.path_for(cache_keys[name])}")
+                    dist[name] = cached
+
+        missing = [name for name in self.pconfig.distances if name not in dist]
+        if len(missing) > 0:
+            import msq_maker.monkey_patch  # noqa: F401, to ensure monkey patching is applied, before moseq2_viz modules using the patched functions are imported
+            from moseq2_viz.model.dist import get_behavioral_distance
+
+            _, sorted_index = load_index(self.mconfig.index)
+            with np.errstate(invalid='ignore', divide='ignore'), self._dtw_engine(), span("get_behavioral_distance", "distance", distances=missing):
+                computed = get_behavioral_distance(
+                    sorted_index,
+                    self.mconfig.model,
+                    max_syllable=num_syllables,
+                    sort_labels_by_usage=True,
+                    count="usage",
+                    dist_options=dist_opts,
+                    distances=missing,
+                )
+            for name in missing:
+                if name not in computed:
+                    continue
+                dist[name] = computed[name]
+                if cache is not None:
+                    cache.put(cache_keys[name], computed[name])
+
+        # keep the distances in the configured order
+        return {name: dist[name] for name in self.pconfig.distances if name in dist}
+
+    def _dtw_engine(self):
+        if self.pconfig.dtw_engine == "moseq2_viz":
+            return contextlib.nullcontext()
+        processes = self.pconfig.processes if self.pconfig.processes != "auto" else get_cpu_count()
+        return patch_moseq2_viz_dtw(window=self.pconfig.dtw_window, max_dist=self.pconfig.dtw_max_dist, processes=processes)
+
+    def _get_cache(self) -> Optional[NpyCache]:
+        if not self.config.msq.cache_dir:
+            return None
+        return NpyCache(os.path.join(self.config.msq.cache_dir, "behavioral_distance"))
+
+    def _cache_key(self, name: str, num_syllables: int, dist_opts: Dict[str, Dict[str, Any]]) -> str:
+        # distance matrices do not depend on groups, only on the model, the index and the distance specification
+        return hash_object({
+            "model": hash_file(self.mconfig.model),
+            "index": hash_file(self.mconfig.index),
+            "distance": name,
+            "options": dist_opts.get(DISTANCE_OPTION_KEYS.get(name, name), {}),
+            "dtw_window": self.pconfig.dtw_window if name.endswith("[dtw]") and self.pconfig.dtw_engine == "msq_maker" else None,
+            "dtw_max_dist": self.pconfig.dtw_max_dist if name.endswith("[dtw]") and self.pconfig.dtw_engine == "msq_maker" else None,
+            "num_syllables": num_syllables,
+            "count": "usage",
+        })
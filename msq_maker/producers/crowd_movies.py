@@ -1,17 +1,14 @@
-import glob
+import functools
 import logging
 import os
 from dataclasses import dataclass, field
-from typing import List, Tuple, Type, Union
+from typing import Any, Callable, List, Tuple, Type, Union
 from typing_extensions import Literal
 
-import h5py
-from moseq2_viz.util import parse_index
-from moseq2_viz.helpers.wrappers import make_crowd_movies_wrapper
-import numpy as np
 import pandas as pd
 
-from ..util import ensure_even, get_cpu_count
+from ..cache import file_identity, memoized
+from ..util import ensure_even, get_cpu_count, get_index, get_roi_size
 from ..core import BaseProducer, BaseOptionalProducerArgs, PluginRegistry, MSQ
 
 
@@ -47,22 +44,19 @@ class CrowdMoviesProducer(BaseProducer[CrowdMoviesConfig]):
         return CrowdMoviesConfig
 
     def run(self, msq: MSQ):
-        out_dir = os.path.join(self.config.msq.tmp_dir, "crowd_movies")
-        os.makedirs(out_dir, exist_ok=True)
-
         # check if movies already exist
         if ((self.config.model.sort and self.config.model.count == "usage") or not self.config.model.sort) and len(
-            glob.glob(os.path.join(out_dir, "*(usage)*.mp4"))
+            msq.glob("crowd_movies/*(usage)*.mp4")
         ) > 0:
             logging.info("It appears crowd movies already exist. Skipping. \n")
             return
         elif (self.config.model.sort and self.config.model.count == "frames") and len(
-            glob.glob(os.path.join(out_dir, "*(frames)*.mp4"))
+            msq.glob("crowd_movies/*(frames)*.mp4")
         ) > 0:
             logging.info("It appears crowd movies already exist. Skipping. \n")
             return
 
-        logging.info("Creating crowd movies at {}\n".format(out_dir))
+        logging.info("Creating crowd movies at {}\n".format(msq.spool))
         raw_size = self.estimate_crowd_movie_size()
         crowd_movies_config = {
             "max_syllable": self.config.model.max_syl,
@@ -90,30 +84,42 @@ class CrowdMoviesProducer(BaseProducer[CrowdMoviesConfig]):
 
         }
 
-        make_crowd_movies_wrapper(
-            self.config.model.index,
-            self.config.model.model,
-            out_dir,
-            crowd_movies_config
-        )
+        import msq_maker.monkey_patch  # noqa: F401, to ensure monkey patching is applied, before moseq2_viz modules using the patched functions are imported
+        from moseq2_viz.helpers.wrappers import make_crowd_movies_wrapper
+
+        with msq.directory("crowd_movies") as out_dir:
+            make_crowd_movies_wrapper(
+                self.config.model.index,
+                self.config.model.model,
+                out_dir,
+                crowd_movies_config
+            )
+
+        logging.info("Completed creating crowd movies at {}\n".format(msq.spool))
 
-        logging.info("Completed creating crowd movies at {}\n".format(out_dir))
+    def required_datasets(self) -> List[str]:
+        datasets = [self.pconfig.frame_path, "scalars/angle"]
+        if self.pconfig.raw_size == "auto":
+            datasets.append("metadata/extraction/roi")
+        return datasets
+
+    def prefetch(self) -> List[Callable[[], Any]]:
+        if self.pconfig.raw_size != "auto":
+            return []
+        # region of interest of each session, to estimate the crowd movie size
+        return [functools.partial(get_roi_size, h5_path) for h5_path in get_index(self.mconfig.index).uuid_to_h5.values()]
 
     def estimate_crowd_movie_size(self, padding=100):
         if self.pconfig.raw_size != "auto":
             return self.pconfig.raw_size
         else:
-            _, sortedIndex = parse_index(self.mconfig.index)
-            
-            bounds = []
-            for uuid in sortedIndex['files'].keys():
-                h5_path = sortedIndex['files'][uuid]['path'][0]
-                with h5py.File(h5_path, 'r') as h5:
-                    mask = h5['/metadata/extraction/roi'][()]
-                    mask_idx = np.nonzero(mask)
-                    bounds.append({
-                        'width': np.max(mask_idx[1]) - np.min(mask_idx[1]),
-                        'height': np.max(mask_idx[0]) - np.min(mask_idx[0]),
-                    })
-            bounds = pd.DataFrame(bounds).median()
-            return (ensure_even(int(bounds['width'] + padding)), ensure_even(int(bounds['height'] + padding)))
+            # the arena size does not depend on groups, so it is shared among reports of the same index
+            return memoized("crowd_movie_size", [file_identity(self.mconfig.index), padding], lambda: self._measure_arena_size(padding))
+
+    def _measure_arena_size(self, padding: int) -> Tuple[int, int]:
+        bounds = []
+        for h5_path in get_index(self.mconfig.index).uuid_to_h5.values():
+            width, height = get_roi_size(h5_path)
+            bounds.append({'width': width, 'height': height})
+        bounds = pd.DataFrame(bounds).median()
+        return (ensure_even(int(bounds['width'] + padding)), ensure_even(int(bounds['height'] + padding)))
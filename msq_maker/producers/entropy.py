@@ -1,16 +1,12 @@
 from dataclasses import dataclass
-from typing import Type
+from typing import Any, Dict, Type
 
-from moseq2_viz.util import parse_index
-from moseq2_viz.model.util import parse_model_results, get_syllable_statistics, relabel_by_usage
-from moseq2_viz.model.trans_graph import get_transition_matrix
 import numpy as np
 import pandas as pd
 
-from msq_maker.util import get_syllable_id_mapping, reindex_label_map
-
-
-from ..core import BaseProducer, BaseOptionalProducerArgs, PluginRegistry, MSQ
+from ..util import relabel, reindex_label_map
+from ..core import BaseOptionalProducerArgs, PluginRegistry, MSQ
+from ..mapreduce import MapReduceProducer, SessionContext
 
 
 @dataclass
@@ -23,57 +19,63 @@ class EntropyConfig(BaseOptionalProducerArgs):
 
 
 @PluginRegistry.register("entropy")
-class EntropyProducer(BaseProducer[EntropyConfig]):
+class EntropyProducer(MapReduceProducer[EntropyConfig]):
 
     @classmethod
     def get_args_type(cls) -> Type[EntropyConfig]:
         return EntropyConfig
 
-    def run(self, msq: MSQ):
-        _, sortedIndex = parse_index(self.mconfig.index)
-        model_dict = parse_model_results(self.mconfig.model, sort_labels_by_usage=True, map_uuid_to_keys=True)
-        syllable_mapping = get_syllable_id_mapping(self.mconfig.model)
-        syllable_mapping = reindex_label_map(syllable_mapping, by="usage")
+    def map_session(self, ctx: SessionContext) -> Dict[str, Any]:
+        # entropies are defined on labels relabeled by usage
+        labels = [relabel(ctx.labels, self.label_map, by="usage")]
 
         common_params = {
             "truncate_syllable": self.config.model.max_syl,
             "relabel_by": None, # labels are already relabeled by usage
         }
 
-        # Calculate entropy and entropy_rate for each label set\
-        # each yields a single value per label set
+        # Calculate entropy and entropy rates, each yields a single value per label set,
+        # and transition entropies, one value per syllable
+        return {
+            "entropy": entropy(labels, **common_params)[0],
+            "entropy_rate_bigram": entropy_rate(labels, normalize="bigram", **common_params)[0],
+            "entropy_rate_rows": entropy_rate(labels, normalize="rows", **common_params)[0],
+            "entropy_rate_columns": entropy_rate(labels, normalize="columns", **common_params)[0],
+            "te_incoming": transition_entropy(labels, tm_smoothing=1, transition_type="incoming", **common_params)[0],
+            "te_outgoing": transition_entropy(labels, tm_smoothing=1, transition_type="outgoing", **common_params)[0],
+        }
+
+    def reduce(self, partials: Dict[str, Any], msq: MSQ):
+        syllable_mapping = reindex_label_map(self.label_map, by="usage")
+
         entropy_data = []
         transition_entropy_data = []
-        for key in model_dict['labels'].keys():
-            labels = [np.array(model_dict['labels'][key])]
-
-            # Calculate entropy and entropy rates
+        for key, partial in partials.items():
+            group = self.context(key).group
             entropy_data.append({
                 "uuid": key,
-                "group": sortedIndex["files"][key]["group"],
-                "entropy": entropy(labels, **common_params)[0],
-                "entropy_rate_bigram": entropy_rate(labels, normalize="bigram", **common_params)[0],
-                "entropy_rate_rows": entropy_rate(labels, normalize="rows", **common_params)[0],
-                "entropy_rate_columns": entropy_rate(labels, normalize="columns", **common_params)[0],
+                "group": group,
+                "entropy": partial["entropy"],
+                "entropy_rate_bigram": partial["entropy_rate_bigram"],
+                "entropy_rate_rows": partial["entropy_rate_rows"],
+                "entropy_rate_columns": partial["entropy_rate_columns"],
             })
 
-            # Calculate transition entropy
-            te_incoming = transition_entropy(labels, tm_smoothing=1, transition_type="incoming", **common_params)[0]
-            te_outgoing = transition_entropy(labels, tm_smoothing=1, transition_type="outgoing", **common_params)[0]
             for i in range(self.mconfig.max_syl):
                 s_map = syllable_mapping[i]
                 transition_entropy_data.append({
                     "uuid": key,
-                    "group": sortedIndex["files"][key]["group"],
+                    "group": group,
                     "id_raw": s_map['raw'],
                     "id_frames": s_map['frames'],
                     "id_usage": s_map['usage'],
-                    "trans_entropy_incoming": te_incoming[i],
-                    "trans_entropy_outgoing": te_outgoing[i],
+                    "trans_entropy_incoming": partial["te_incoming"][i],
+                    "trans_entropy_outgoing": partial["te_outgoing"][i],
                 })
 
-        entropy_df = pd.DataFrame(entropy_data)
-        transition_entropy_df = pd.DataFrame(transition_entropy_data)
+        # explicit columns, since a shard may hold no sessions
+        entropy_df = pd.DataFrame(entropy_data, columns=["uuid", "group", "entropy", "entropy_rate_bigram", "entropy_rate_rows", "entropy_rate_columns"])
+        transition_entropy_df = pd.DataFrame(transition_entropy_data, columns=["uuid", "group", "id_raw", "id_frames", "id_usage", "trans_entropy_incoming", "trans_entropy_outgoing"])
 
         if self.mconfig.groups:
             entropy_df = entropy_df.loc[entropy_df["group"].isin(self.mconfig.groups)]
@@ -110,6 +112,7 @@ def entropy(labels, truncate_syllable=40, smoothing=1.0, relabel_by="usage"):
     Returns:
     ent (list): list of entropies for each session.
     """
+    from moseq2_viz.model.util import get_syllable_statistics, relabel_by_usage
 
     if relabel_by is not None:
         labels, _ = relabel_by_usage(labels, count=relabel_by)
@@ -157,6 +160,8 @@ def entropy_rate(
     Returns:
     ent (list): list of entropy rates per syllable label
     """
+    from moseq2_viz.model.trans_graph import get_transition_matrix
+    from moseq2_viz.model.util import get_syllable_statistics, relabel_by_usage
 
     if relabel_by is not None:
         labels, _ = relabel_by_usage(labels, count=relabel_by)
@@ -227,6 +232,8 @@ def transition_entropy(
     Returns:
     entropies (list of np.ndarray): a list of transition entropies (either incoming or outgoing) for each session and syllable.
     """
+    from moseq2_viz.model.trans_graph import get_transition_matrix
+    from moseq2_viz.model.util import get_syllable_statistics, relabel_by_usage
 
     if transition_type not in ("incoming", "outgoing"):
         raise ValueError("transition_type must be incoming or outgoing")
@@ -1,4 +1,3 @@
-import os
 from dataclasses import dataclass
 from typing import Type
 
@@ -29,5 +28,5 @@ class LabelMapProducer(BaseProducer[LabelMapConfig]):
         sm_df = pd.DataFrame(syllable_mapping.values())
         sm_df = sm_df[sm_df["usage"] < self.mconfig.max_syl]
         dest = "label_map.json"
-        sm_df.to_json(os.path.join(msq.spool_path, dest), orient="records")
+        msq.write_dataframe(dest, sm_df, orient="records")
         msq.manifest["label_map"] = dest
@@ -1,10 +1,10 @@
 from dataclasses import dataclass
-from typing import Type
+from typing import Any, Dict, Type
 
-from moseq2_viz.util import parse_index
 import pandas as pd
 
-from ..core import BaseProducer, BaseProducerArgs, PluginRegistry, MSQ
+from ..core import BaseProducerArgs, PluginRegistry, MSQ
+from ..mapreduce import MapReduceProducer, SessionContext
 
 
 @dataclass
@@ -17,26 +17,26 @@ class SampleManifestConfig(BaseProducerArgs):
 
 
 @PluginRegistry.register("sample_manifest")
-class SampleManifestProducer(BaseProducer[SampleManifestConfig]):
+class SampleManifestProducer(MapReduceProducer[SampleManifestConfig]):
+    session_source = "index"
+    cache_partials = False
+    # session metadata copied to the manifest of samples
+    meta_keys = ["ApparatusName", "SessionName", "StartTime", "SubjectName"]
 
     @classmethod
     def get_args_type(cls) -> Type[SampleManifestConfig]:
         return SampleManifestConfig
 
-    def run(self, msq: MSQ):
-        _, index_dict = parse_index(self.mconfig.index)
+    def map_session(self, ctx: SessionContext) -> Dict[str, Any]:
+        return {
+            "uuid": ctx.uuid,
+            "default_group": ctx.group,
+            **{k: ctx.metadata.get(k, "") for k in self.meta_keys}
+        }
 
-        meta_keys = ["ApparatusName", "SessionName", "StartTime", "SubjectName"]
-
-        data = []
-        for uuid in index_dict["files"]:
-            data.append({
-                "uuid": uuid,
-                "default_group": index_dict["files"][uuid]["group"],
-                **{k: index_dict["files"][uuid]["metadata"].get(k, "") for k in meta_keys}
-            })
-
-        df = pd.DataFrame(data)
+    def reduce(self, partials: Dict[str, Any], msq: MSQ):
+        # explicit columns, since a shard may hold no sessions
+        df = pd.DataFrame(list(partials.values()), columns=["uuid", "default_group", *self.meta_keys])
         dest = "samples.json"
         msq.write_dataframe(dest, df)
         msq.manifest["samples"] = dest
@@ -1,11 +1,12 @@
 import os
 from dataclasses import dataclass
-from typing import Type
+from typing import Any, Dict, List, Type
 
-from moseq2_viz.scalars.util import scalars_to_dataframe
-from moseq2_viz.util import parse_index
+import pandas as pd
 
-from ..core import BaseProducer, BaseOptionalProducerArgs, PluginRegistry, MSQ
+from ..util import load_index, patch_parse_model
+from ..core import BaseOptionalProducerArgs, PluginRegistry, MSQ
+from ..mapreduce import MapReduceProducer, SessionContext
 
 
 @dataclass
@@ -18,19 +19,42 @@ class ScalarsConfig(BaseOptionalProducerArgs):
 
 
 @PluginRegistry.register("scalars")
-class ScalarsProducer(BaseProducer[ScalarsConfig]):
+class ScalarsProducer(MapReduceProducer[ScalarsConfig]):
+    session_source = "index"
 
     @classmethod
     def get_args_type(cls) -> Type[ScalarsConfig]:
         return ScalarsConfig
 
     def run(self, msq: MSQ):
-        _, sortedIndex = parse_index(self.mconfig.index)
+        # index level entries (ex. the path to the PCA scores) accompany each session
+        _, sortedIndex = load_index(self.mconfig.index)
+        self._index_extras = {k: v for k, v in sortedIndex.items() if k != "files"}
+        super().run(msq)
 
-        df = scalars_to_dataframe(sortedIndex, model_path=self.mconfig.model)
+    def required_datasets(self) -> List[str]:
+        return ["scalars"]
+
+    def map_session(self, ctx: SessionContext) -> pd.DataFrame:
+        import moseq2_viz.scalars.util
+        from moseq2_viz.scalars.util import scalars_to_dataframe
+
+        session_index = {**self._index_extras, "files": {ctx.uuid: ctx.index_entry}}
+
+        # the model would otherwise be parsed anew for every session
+        with patch_parse_model(moseq2_viz.scalars.util):
+            df = scalars_to_dataframe(session_index, model_path=self.mconfig.model)
 
         # drop any scalars in units of px, keep only mm or other columns
-        df = df.drop(columns=[c for c in df.columns.values.tolist() if c.endswith("_px")])
+        return df.drop(columns=[c for c in df.columns.values.tolist() if c.endswith("_px")])
+
+    def reduce(self, partials: Dict[str, Any], msq: MSQ):
+        frames = []
+        for uuid, df in partials.items():
+            # groups come from the index, which may have changed since the partial result was cached
+            df["group"] = self.context(uuid).group
+            frames.append(df)
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame(columns=["group", "labels (original)"])
 
         if self.mconfig.groups:
             df = df.loc[df["group"].isin(self.mconfig.groups)]
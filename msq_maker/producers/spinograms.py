@@ -1,11 +1,9 @@
-import glob
 import logging
-import os
 from dataclasses import dataclass, field
 from typing import List, Type, Union
 from typing_extensions import Literal
 
-from ..util import run_and_log_subprocess
+from ..util import can_run_in_process, run_command
 from ..core import BaseProducer, BaseOptionalProducerArgs, PluginRegistry, MSQ
 
 
@@ -17,6 +15,8 @@ class SpinogramsConfig(BaseOptionalProducerArgs):
     """
     max_examples: int = field(default=10, metadata={"doc": "Maximum number of examples to generate for each syllable."})
     processors: Union[int, Literal["auto"]] = field(default="auto", metadata={"doc": "Number of processors to use for parallel processing. If \"auto\", will use the number of available CPU cores (taking into account CPU affinity on systems that support it)."})
+    in_process: bool = field(default=True, metadata={"doc": "Run `spinogram` within this process when its package is installed, reusing the model and index already loaded instead of loading them again in a subprocess. Falls back to a subprocess otherwise."})
+    timeout: float = field(default=0, metadata={"doc": "Maximum time, in seconds, `spinogram` may run as a subprocess before it is terminated. 0 for no limit."})
     extra_args: List[str] = field(default_factory=list, metadata={"doc": "Additional command line arguments to pass to the `spinograms` command, each token as an item in the list (à la subprocess style)."})
 
 
@@ -28,42 +28,46 @@ class SpinogramsProducer(BaseProducer[SpinogramsConfig]):
     def get_args_type(cls) -> Type[SpinogramsConfig]:
         return SpinogramsConfig
 
+    def runs_subprocess(self) -> bool:
+        return not (self.pconfig.in_process and can_run_in_process("spinogram"))
+
     def run(self, msq: MSQ):
         # check if spinograms already exist
         basename = "spinogram"
         out_name = f"{basename}.corpus-{'sorted' if self.mconfig.sort else 'unsorted'}-{self.mconfig.count}.json"
-        if len(glob.glob(os.path.join(msq.spool_path, out_name))) > 0:
+        if msq.exists(out_name):
             logging.info("It appears spinograms already exist. Skipping. \n")
             return
 
-        logging.info("Creating spinograms at {}\n".format(msq.spool_path))
-        spinogram_args = [
-            "spinogram",
-            "plot-corpus",
-            self.mconfig.index,
-            self.mconfig.model,
-            "--dir",
-            msq.spool_path,
-            "--save-data",
-            "--no-plot",
-            "--max-syllable",
-            str(self.mconfig.max_syl),
-            "--name",
-            basename,
-            "--count",
-            self.mconfig.count,
-            "--max-examples",
-            str(self.pconfig.max_examples),
-        ]
-        if self.pconfig.processors != "auto":
-            spinogram_args.extend(["--processors", str(self.pconfig.processors)])
+        logging.info("Creating spinograms at {}\n".format(msq.spool))
+        with msq.directory() as out_dir:
+            spinogram_args = [
+                "spinogram",
+                "plot-corpus",
+                self.mconfig.index,
+                self.mconfig.model,
+                "--dir",
+                out_dir,
+                "--save-data",
+                "--no-plot",
+                "--max-syllable",
+                str(self.mconfig.max_syl),
+                "--name",
+                basename,
+                "--count",
+                self.mconfig.count,
+                "--max-examples",
+                str(self.pconfig.max_examples),
+            ]
+            if self.pconfig.processors != "auto":
+                spinogram_args.extend(["--processors", str(self.pconfig.processors)])
 
-        if self.mconfig.sort:
-            spinogram_args.append("--sort")
+            if self.mconfig.sort:
+                spinogram_args.append("--sort")
 
-        if self.pconfig.extra_args:
-            spinogram_args.extend(self.pconfig.extra_args)
+            if self.pconfig.extra_args:
+                spinogram_args.extend(self.pconfig.extra_args)
 
-        run_and_log_subprocess(spinogram_args)
+            run_command(spinogram_args, in_process=self.pconfig.in_process, timeout=self.pconfig.timeout or None)
 
         msq.manifest["spinograms"] = out_name
@@ -1,13 +1,16 @@
 import json
 import logging
 import os
+import shutil
 from dataclasses import dataclass, field
-from typing import List, Tuple, Type, Union
+from typing import List, Optional, Tuple, Type, Union
 from typing_extensions import Literal
 
 import pandas as pd
 
-from ..util import run_and_log_subprocess
+from ..model import get_manifest
+from ..rawdata import check_raw_sessions, link_sessions, load_raw_index, session_ids
+from ..util import can_run_in_process, format_list, get_index, run_command
 from ..core import BaseProducer, BaseOptionalProducerArgs, PluginRegistry, MSQ
 
 
@@ -24,6 +27,9 @@ class SyllableClipsConfig(BaseOptionalProducerArgs):
     streams: List[str] = field(default_factory=list, metadata={"doc": "List of streams to include in the output. Available streams: depth, rgb, ir, composed, but may depend on the modalities used when acquiring the raw data."})
     rgb_crop: Union[Literal["none", "auto"], Tuple[int,int,int,int]] = field(default="auto", metadata={"doc": "Crop to apply to RGB clips. If 'none', no crop is applied. If 'auto', the crop is determined automatically based on the extracted data ROI (only works properly if depth and RGB are the same shape, typical for Kinect2 data). Otherwise, a tuple of (x1, y1, x2, y2) defining the crop region."})
     processors: Union[int, Literal["auto"]] = field(default="auto", metadata={"doc": "Number of processors to use for parallel processing. If \"auto\", will use the number of available CPU cores (taking into account CPU affinity on systems that support it)."})
+    in_process: bool = field(default=True, metadata={"doc": "Run `syllable-clips` within this process when its package is installed, reusing the model and index already loaded instead of loading them again in a subprocess. Falls back to a subprocess otherwise."})
+    use_raw_index: bool = field(default=True, metadata={"doc": "Locate raw sessions with the raw data index written by `msq-maker index-raw`, when it exists, instead of letting `syllable-clips` search `raw_data_path`."})
+    timeout: float = field(default=0, metadata={"doc": "Maximum time, in seconds, `syllable-clips` may run as a subprocess before it is terminated. 0 for no limit."})
     extra_args: List[str] = field(default_factory=list, metadata={"doc": "Additional command line arguments to pass to the `syllable-clips` command, each token as an item in the list (à la subprocess style)."})
 
     def __post_init__(self):
@@ -44,56 +50,111 @@ class SyllableClipsProducer(BaseProducer[SyllableClipsConfig]):
     def get_args_type(cls) -> Type[SyllableClipsConfig]:
         return SyllableClipsConfig
 
+    def runs_subprocess(self) -> bool:
+        return not (self.pconfig.in_process and can_run_in_process("syllable-clips"))
+
     def run(self, msq: MSQ):
         rel_out_dir = "syllable_clips"
-        abs_out_dir = os.path.join(msq.spool_path, rel_out_dir)
-        os.makedirs(abs_out_dir, exist_ok=True)
         basename = "syllable"
-        logging.info("Creating syllable clips at {}\n".format(abs_out_dir))
-        syl_clip_args = [
-            "syllable-clips",
-            "corpus-multiple",
-            self.mconfig.index,
-            self.mconfig.model,
-            "--dir",
-            abs_out_dir,
-            "--name",
-            basename,
-            "--count",
-            self.mconfig.count,
-            "--streams",
-            *self.pconfig.streams,
-            "--append",
-            str(self.pconfig.append),
-            "--prepend",
-            str(self.pconfig.prepend),
-            "--raw-path",
-            self.mconfig.raw_data_path,
-            "--num-examples",
-            str(self.pconfig.max_examples),
-            "--crop-rgb",
-            self.pconfig.get_rgb_crop(),
-        ]
-        if self.pconfig.processors != "auto":
-            syl_clip_args.extend(["--processors", str(self.pconfig.processors)])
-
-        if self.mconfig.manifest_path is not None:
-            syl_clip_args.extend(["--manifest", self.mconfig.manifest_path, "--man-uuid-col", self.mconfig.manifest_uuid_column, "--man-session-id-col", self.mconfig.manifest_session_id_column])
-
-        if self.mconfig.sort:
-            syl_clip_args.append("--sort")
-
-        if self.pconfig.extra_args:
-            syl_clip_args.extend(self.pconfig.extra_args)
-
-        run_and_log_subprocess(syl_clip_args)
-
-        args_path = os.path.join(abs_out_dir, "{}.args.json".format(basename))
-        with open(args_path) as args_file:
+        logging.info("Creating syllable clips at {}\n".format(msq.spool))
+        with msq.directory(rel_out_dir) as abs_out_dir:
+            syl_clip_args = [
+                "syllable-clips",
+                "corpus-multiple",
+                self.mconfig.index,
+                self.mconfig.model,
+                "--dir",
+                abs_out_dir,
+                "--name",
+                basename,
+                "--count",
+                self.mconfig.count,
+                "--streams",
+                *self.pconfig.streams,
+                "--append",
+                str(self.pconfig.append),
+                "--prepend",
+                str(self.pconfig.prepend),
+                "--num-examples",
+                str(self.pconfig.max_examples),
+                "--crop-rgb",
+                self.pconfig.get_rgb_crop(),
+            ]
+            if self.pconfig.processors != "auto":
+                syl_clip_args.extend(["--processors", str(self.pconfig.processors)])
+
+            sessions_dir = f"{os.path.normpath(self.config.msq.tmp_dir)}.raw-sessions"
+            linked_manifest = self._link_raw_sessions(sessions_dir)
+            if linked_manifest is not None:
+                syl_clip_args.extend(["--raw-path", sessions_dir, "--manifest", linked_manifest, "--man-uuid-col", "uuid", "--man-session-id-col", "session_id"])
+            else:
+                syl_clip_args.extend(["--raw-path", self.mconfig.raw_data_path])
+                if self.mconfig.manifest_path:
+                    # only the uuid and session ID columns are used, pass them without the rest of the (possibly large) manifest
+                    manifest = get_manifest(self.mconfig.manifest_path, self.mconfig.manifest_uuid_column, self.mconfig.manifest_session_id_column,
+                                            cache_dir=self.config.msq.cache_dir)
+                    os.makedirs(sessions_dir, exist_ok=True)
+                    projected_manifest = os.path.join(sessions_dir, "manifest.tsv")
+                    manifest.to_dataframe().to_csv(projected_manifest, sep="\t", index=False)
+                    syl_clip_args.extend(["--manifest", projected_manifest, "--man-uuid-col", self.mconfig.manifest_uuid_column, "--man-session-id-col", self.mconfig.manifest_session_id_column])
+
+            if self.mconfig.sort:
+                syl_clip_args.append("--sort")
+
+            if self.pconfig.extra_args:
+                syl_clip_args.extend(self.pconfig.extra_args)
+
+            try:
+                run_command(syl_clip_args, in_process=self.pconfig.in_process, timeout=self.pconfig.timeout or None)
+            finally:
+                shutil.rmtree(sessions_dir, ignore_errors=True)
+
+        with msq.open("{}/{}.args.json".format(rel_out_dir, basename)) as args_file:
             args_data = json.load(args_file)
 
-        man_path = os.path.join(abs_out_dir, "{}.sources.tsv".format(basename))
-        man_df = pd.read_csv(man_path, sep="\t")
+        with msq.open("{}/{}.sources.tsv".format(rel_out_dir, basename)) as man_file:
+            man_df = pd.read_csv(man_file, sep="\t")
         man_df["base_name"] = man_df["base_name"].apply(lambda x: os.path.join(rel_out_dir, x))
         out = {"args": args_data, "manifest": man_df.to_dict("records")}
         msq.manifest["syllable_clips"] = out
+
+    def preflight(self) -> List[str]:
+        if not self.mconfig.raw_data_path or not os.path.isdir(self.mconfig.raw_data_path):
+            return [f"Raw data directory \"{self.mconfig.raw_data_path}\" not found, syllable clips are cut from raw sessions."]
+
+        problems = []
+        if self.mconfig.manifest_path:
+            try:
+                get_manifest(self.mconfig.manifest_path, self.mconfig.manifest_uuid_column, self.mconfig.manifest_session_id_column,
+                             cache_dir=self.config.msq.cache_dir)
+            except (OSError, ValueError) as e:
+                problems.append(f"Manifest \"{self.mconfig.manifest_path}\" cannot be used: {e}")
+
+        ids = session_ids(self.mconfig, cache_dir=self.config.msq.cache_dir)
+        unmapped = [uuid for uuid in get_index(self.mconfig.index).uuid_to_h5 if uuid not in ids]
+        if len(unmapped) > 0:
+            problems.append(f"The raw session of {len(unmapped)} session(s) is neither in the manifest nor recorded in their extraction: {format_list(unmapped)}.")
+
+        table = load_raw_index(self.config.msq.cache_dir, self.mconfig.raw_data_path) if self.pconfig.use_raw_index else None
+        if table is None:
+            logging.info("Raw sessions were not checked, since the raw data is not indexed (see `msq-maker index-raw`).")
+        else:
+            problems.extend(check_raw_sessions(table, ids.values(), self.pconfig.streams))
+        return problems
+
+    def _link_raw_sessions(self, dest: str) -> Optional[str]:
+        """Gather the raw sessions of the index in `dest` using the raw data index, returning the manifest to pass to `syllable-clips`.
+
+        Returns None, to let `syllable-clips` search `raw_data_path` itself, when the raw data index is disabled,
+        was not created (see `msq-maker index-raw`), or misses sessions.
+        """
+        if not self.pconfig.use_raw_index:
+            return None
+        table = load_raw_index(self.config.msq.cache_dir, self.mconfig.raw_data_path)
+        if table is None:
+            return None
+        manifest_path, missing = link_sessions(self.mconfig, table, dest, cache_dir=self.config.msq.cache_dir)
+        if len(missing) > 0:
+            logging.info(f"Not using the raw data index, letting syllable-clips search \"{self.mconfig.raw_data_path}\".")
+            return None
+        return manifest_path
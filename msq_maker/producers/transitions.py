@@ -1,61 +1,90 @@
-from dataclasses import dataclass
-from typing import Type
+from dataclasses import dataclass, field
+from typing import Any, Dict, Type
 
 from joblib import Parallel, delayed
-from moseq2_viz.util import parse_index
-from moseq2_viz.model.trans_graph import get_transition_matrix
-from moseq2_viz.model.util import parse_model_results
 import pandas as pd
+from scipy import sparse
 
-from ..util import get_max_states, get_syllable_id_mapping, syllableMatricesToLongForm
-from ..core import BaseProducer, BaseOptionalProducerArgs, PluginRegistry, MSQ
+from ..util import (
+    get_sparse_transition_counts,
+    restrict_sparse_matrix,
+    sum_sparse_matrices,
+    syllableMatricesToLongForm,
+)
+from ..core import BaseOptionalProducerArgs, PluginRegistry, MSQ
+from ..mapreduce import MapReduceProducer, SessionContext
 
 
 @dataclass
 class TransitionsConfig(BaseOptionalProducerArgs):
     """Configuration for the `transitions` producer.
 
-    This has no additional parameters, as it simply writes the transition probability values.
+    By default, transition counts are written as long-form rows, one per cell of each session's transition matrix.
+    For large cohorts, set `sparse` to write only observed transitions, per session and aggregated per group.
     """
-    pass
+    sparse: bool = field(default=False, metadata={"doc": "Write transition counts as sparse (COO) matrices holding only observed transitions, per session and per group, instead of long-form rows."})
 
 
 @PluginRegistry.register("transitions")
-class TransitionsProducer(BaseProducer[TransitionsConfig]):
+class TransitionsProducer(MapReduceProducer[TransitionsConfig]):
+
+    # sparse counts were one row and column larger than dense counts in version 1
+    partial_version = 2
 
     @classmethod
     def get_args_type(cls) -> Type[TransitionsConfig]:
         return TransitionsConfig
 
-    def run(self, msq: MSQ):
-        _, sorted_index = parse_index(self.mconfig.index)
-        model = parse_model_results(self.mconfig.model, sort_labels_by_usage=False, count="usage")
-        max_syllable = get_max_states(model)
-        syllable_mapping = get_syllable_id_mapping(self.mconfig.model)
-
-        label_uuids = model["keys"]
-        labels = model["labels"]
+    def map_session(self, ctx: SessionContext) -> sparse.coo_matrix:
+        # transition counts are indexed by RAW ID
+        if self.pconfig.sparse:
+            return get_sparse_transition_counts(ctx.labels, ctx.max_states)
+        from moseq2_viz.model.trans_graph import get_transition_matrix
+        mat = get_transition_matrix([ctx.labels], combine=False, normalize=None, max_syllable=ctx.max_states)[0]
+        return sparse.coo_matrix(mat)
 
-        trans_mats = {}
-        trans_mats["raw"] = get_transition_matrix(labels, combine=False, normalize=None, max_syllable=max_syllable)
+    def reduce(self, partials: Dict[str, Any], msq: MSQ):
+        if self.pconfig.sparse:
+            self._reduce_sparse(partials, msq)
+            return
 
         transitions = Parallel(n_jobs=-1)(
-            delayed(self._prepTransitionsForIndividual)(trans_mats, i, uuid, sorted_index, syllable_mapping) for i, uuid in enumerate(label_uuids)
+            delayed(self._prepTransitionsForIndividual)(mat.toarray(), uuid, self.context(uuid).group, self.label_map) for uuid, mat in partials.items()
         )
 
-        df: pd.DataFrame = pd.concat(transitions, ignore_index=True)
-        df = df[(df["row_id_usage"] < self.mconfig.max_syl) & (df["col_id_usage"] < self.mconfig.max_syl)]
+        df: pd.DataFrame = pd.concat(transitions, ignore_index=True) if len(transitions) > 0 else pd.DataFrame()
+        if len(df) > 0:
+            df = df[(df["row_id_usage"] < self.mconfig.max_syl) & (df["col_id_usage"] < self.mconfig.max_syl)]
 
         dest = "individual_transitions.ms{}.json".format(self.mconfig.max_syl)
         msq.write_dataframe(dest, df)
         msq.manifest["transitions"] = dest
 
-    def _prepTransitionsForIndividual(self, trans_mats, idx, uuid, index, syllable_mapping):
-        mats = {}
-        for k, v in trans_mats.items():
-            mats[k] = v[idx]
+    def _prepTransitionsForIndividual(self, mat, uuid, group, syllable_mapping):
+        decorate = {"uuid": uuid, "default_group": group}
+
+        data = syllableMatricesToLongForm({"raw": mat}, syllable_mapping, decorate)
+        return pd.DataFrame.from_dict(data=data)
+
+    def _reduce_sparse(self, partials: Dict[str, Any], msq: MSQ):
+        session_groups = {uuid: self.context(uuid).group for uuid in partials.keys()}
+
+        # matrices are indexed by RAW ID, restricted to syllables with usage ID below max_syl
+        trans_mats = {
+            uuid: restrict_sparse_matrix(mat, self.label_map, self.mconfig.max_syl)
+            for uuid, mat in partials.items()
+        }
+
+        group_mats = {}
+        for group in self.mconfig.groups:
+            members = [mat for uuid, mat in trans_mats.items() if session_groups[uuid] == group]
+            if len(members) > 0:
+                group_mats[group] = sum_sparse_matrices(members)
+
+        individual_dest = "individual_transitions.ms{}.sparse.json".format(self.mconfig.max_syl)
+        msq.write_sparse(individual_dest, trans_mats, index="raw", groups=session_groups)
 
-        decorate = {"uuid": uuid, "default_group": index["files"][uuid]["group"]}
+        group_dest = "group_transitions.ms{}.sparse.json".format(self.mconfig.max_syl)
+        msq.write_sparse(group_dest, group_mats, index="raw")
 
-        data = syllableMatricesToLongForm(mats, syllable_mapping, decorate)
-        return pd.DataFrame.from_dict(data=data)
\ No newline at end of file
+        msq.manifest["transitions_sparse"] = {"individual": individual_dest, "groups": group_dest}
@@ -1,13 +1,11 @@
 from dataclasses import dataclass
-from typing import Type
+from typing import Any, Dict, Type
 
-from moseq2_viz.model.util import get_syllable_statistics, parse_model_results
-from moseq2_viz.util import parse_index
 import numpy as np
 import pandas as pd
 
-from ..util import get_max_states, get_syllable_id_mapping
-from ..core import BaseProducer, BaseOptionalProducerArgs, PluginRegistry, MSQ
+from ..core import BaseOptionalProducerArgs, PluginRegistry, MSQ
+from ..mapreduce import MapReduceProducer, SessionContext
 
 
 @dataclass
@@ -19,35 +17,31 @@ class UsageConfig(BaseOptionalProducerArgs):
     pass
 
 @PluginRegistry.register("usage")
-class UsageProducer(BaseProducer[UsageConfig]):
+class UsageProducer(MapReduceProducer[UsageConfig]):
 
     @classmethod
     def get_args_type(cls) -> Type[UsageConfig]:
         return UsageConfig
 
-    def run(self, msq: MSQ):
-        _, index_dict = parse_index(self.mconfig.index)
-        model_dict = parse_model_results(self.mconfig.model, sort_labels_by_usage=False)
-        max_syllable = get_max_states(model_dict)
+    def map_session(self, ctx: SessionContext) -> Dict[str, np.ndarray]:
+        from moseq2_viz.model.util import get_syllable_statistics
 
-        if "train_list" in model_dict.keys():
-            label_uuids = model_dict["train_list"]
-        else:
-            label_uuids = model_dict["keys"]
-
-        groups = [index_dict["files"][uuid]["group"] for uuid in label_uuids]
-        syllable_mapping = get_syllable_id_mapping(self.mconfig.model)
+        # counts are indexed by raw ID
+        tmp_usages, _ = get_syllable_statistics(ctx.labels, count="usage", max_syllable=ctx.max_states)
+        tmp_frames, _ = get_syllable_statistics(ctx.labels, count="frames", max_syllable=ctx.max_states)
+        return {
+            "usage": np.array(list(tmp_usages.values())),
+            "frames": np.array(list(tmp_frames.values())),
+        }
 
+    def reduce(self, partials: Dict[str, Any], msq: MSQ):
         data = []
-        for i, label_arr in enumerate(model_dict["labels"]):
-            tmp_usages, _ = get_syllable_statistics(label_arr, count="usage", max_syllable=max_syllable)
-            total_usage = np.sum(list(tmp_usages.values()))
-
-            tmp_frames, _ = get_syllable_statistics(label_arr, count="frames", max_syllable=max_syllable)
-            total_frames = np.sum(list(tmp_frames.values()))
+        for uuid, counts in partials.items():
+            total_usage = np.sum(counts["usage"])
+            total_frames = np.sum(counts["frames"])
 
-            for j, (usage, frames) in enumerate(zip(tmp_usages.values(), tmp_frames.values())):
-                syllable = syllable_mapping[j]
+            for j, (usage, frames) in enumerate(zip(counts["usage"], counts["frames"])):
+                syllable = self.label_map[j]
 
                 if syllable['usage'] > self.mconfig.max_syl:
                     continue
@@ -58,14 +52,15 @@ class UsageProducer(BaseProducer[UsageConfig]):
                     "id_frames": syllable["frames"],
                     "usage_usage": usage / total_usage,
                     "usage_frames": frames / total_frames,
-                    "uuid": label_uuids[i],
-                    "group": groups[i],
+                    "uuid": uuid,
+                    "group": self.context(uuid).group,
                 })
 
-        df = pd.DataFrame(data)
+        # explicit columns, since a shard may hold no sessions
+        df = pd.DataFrame(data, columns=["id_raw", "id_usage", "id_frames", "usage_usage", "usage_frames", "uuid", "group"])
 
-        if groups:
-            df = df.loc[df["group"].isin(groups)]
+        if self.mconfig.groups:
+            df = df.loc[df["group"].isin(self.mconfig.groups)]
 
         dest = "usage.ms{}.json".format(self.mconfig.max_syl)
         msq.write_dataframe(dest, df)
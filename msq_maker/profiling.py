@@ -0,0 +1,196 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import psutil
+
+from msq_maker.spool import Spool
+
+
+def get_dir_size(path: str) -> int:
+    """Get the total size, in bytes, of all files under a directory.
+
+    Args:
+        path (str): directory to measure. If it does not exist, the size is zero.
+
+    Returns:
+        int: total size of the files, in bytes.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
+
+
+def format_bytes(num: float) -> str:
+    """Format a number of bytes in human readable units."""
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if abs(num) < 1024 or unit == "TiB":
+            return f"{num:.1f} {unit}" if unit != "B" else f"{int(num)} {unit}"
+        num /= 1024
+    return f"{num:.1f} TiB"
+
+
+class ResourceSampler(threading.Thread):
+    """Background thread sampling the memory and CPU usage of this process and all of its descendants.
+
+    Descendants include subprocesses (ex. started by `run_and_log_subprocess()`) and worker processes
+    (ex. joblib workers), which are discovered anew at every sample.
+    """
+
+    def __init__(self, interval: float = 0.2):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_rss = 0
+        # memory already in use when sampling started, ex. left over by earlier work in this process
+        self.start_rss = 0
+        self._baseline_cpu: Dict[int, float] = {}
+        self._last_cpu: Dict[int, float] = {}
+        self._stop_event = threading.Event()
+
+        # descendants alive before sampling started only count for the CPU time they use from now on
+        for child in self._children():
+            cpu = self._cpu_time(child)
+            if cpu is not None:
+                self._baseline_cpu[child.pid] = cpu
+        self.sample()
+        self.start_rss = self.peak_rss
+
+    def _children(self) -> List[psutil.Process]:
+        try:
+            return self.process.children(recursive=True)
+        except psutil.Error:
+            return []
+
+    @staticmethod
+    def _cpu_time(proc: psutil.Process) -> Optional[float]:
+        try:
+            times = proc.cpu_times()
+            return times.user + times.system
+        except psutil.Error:
+            return None
+
+    def sample(self) -> None:
+        """Take a single sample of memory and CPU usage."""
+        rss = 0
+        try:
+            rss += self.process.memory_info().rss
+        except psutil.Error:
+            pass
+
+        alive = {}
+        for child in self._children():
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                continue
+            cpu = self._cpu_time(child)
+            if cpu is not None:
+                alive[child.pid] = cpu
+        self._last_cpu = alive
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self) -> None:
+        """Stop sampling, taking one last sample."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.sample()
+
+    def live_children_cpu_time(self) -> float:
+        """CPU time used, since sampling started, by descendants which were still alive at the last sample."""
+        return sum(cpu - self._baseline_cpu.get(pid, 0.0) for pid, cpu in self._last_cpu.items())
+
+
+class ProducerProfiler:
+    """Records wall time, CPU time, peak RSS and bytes written for each producer of a run."""
+
+    def __init__(self, spool: Spool, interval: float = 0.2):
+        self.spool = spool
+        self.interval = interval
+        self.records: List[Dict[str, Any]] = []
+
+    @contextlib.contextmanager
+    def profile(self, name: str) -> Iterator[None]:
+        """Context manager profiling the block it wraps, recording the results under `name`."""
+        process = psutil.Process()
+        start_cpu = process.cpu_times()
+        start_size = self.spool.total_size()
+        sampler = ResourceSampler(self.interval)
+        sampler.start()
+        start = time.perf_counter()
+
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            wall_time = time.perf_counter() - start
+            sampler.stop()
+            end_cpu = process.cpu_times()
+
+            # children_* only account for children which exited and were waited for, processes still alive
+            # (ex. reusable joblib workers) are accounted for from the samples
+            children_cpu = (end_cpu.children_user - start_cpu.children_user) + (end_cpu.children_system - start_cpu.children_system)
+            children_cpu += sampler.live_children_cpu_time()
+
+            self.records.append({
+                "producer": name,
+                "status": status,
+                "wall_time": wall_time,
+                "cpu_user": end_cpu.user - start_cpu.user,
+                "cpu_system": end_cpu.system - start_cpu.system,
+                "cpu_children": children_cpu,
+                "peak_rss": sampler.peak_rss,
+                "peak_rss_increase": max(0, sampler.peak_rss - sampler.start_rss),
+                "bytes_written": max(0, self.spool.total_size() - start_size),
+            })
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the recorded timings as a JSON serializable dictionary."""
+        return {
+            "host": {
+                "cpu_count": psutil.cpu_count(logical=True),
+                "total_memory": psutil.virtual_memory().total,
+            },
+            "producers": self.records,
+        }
+
+    def summary_table(self) -> str:
+        """Format the recorded timings as a human readable table."""
+        header = ["producer", "status", "wall (s)", "cpu (s)", "children cpu (s)", "peak rss", "written"]
+        rows = [header]
+        for r in self.records:
+            rows.append([
+                r["producer"],
+                r["status"],
+                f"{r['wall_time']:.2f}",
+                f"{r['cpu_user'] + r['cpu_system']:.2f}",
+                f"{r['cpu_children']:.2f}",
+                format_bytes(r["peak_rss"]),
+                format_bytes(r["bytes_written"]),
+            ])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        lines = ["  ".join(cell.ljust(w) for cell, w in zip(row, widths)) for row in rows]
+        lines.insert(1, "  ".join("-" * w for w in widths))
+        return "\n".join(lines)
+
+    def log_summary(self) -> None:
+        """Write the summary table to the log."""
+        logging.info("Producer performance summary:")
+        for line in self.summary_table().splitlines():
+            logging.info(line)
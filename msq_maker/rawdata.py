@@ -0,0 +1,302 @@
+import logging
+import os
+import shutil
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+from msq_maker.cache import hash_object, memoized_file
+from msq_maker.core import ModelConfig
+from msq_maker.model import get_manifest
+from msq_maker.tracing import span
+from msq_maker.util import format_list, get_index
+
+
+# Threads scanning the raw data directory. Scans mostly wait on (network) storage, so this exceeds the number of cores.
+SCAN_THREADS = 16
+
+# Files holding each stream of a raw session, by order of preference.
+STREAM_FILES: Dict[str, List[str]] = {
+    "depth": ["depth.dat", "depth.avi", "depth.mkv"],
+    "rgb": ["rgb.mp4", "rgb.avi", "rgb.mkv"],
+    "ir": ["ir.avi", "ir.mp4", "ir.mkv"],
+}
+
+# Columns of a raw data index. Stream columns hold paths relative to the session directory, empty if the stream is missing.
+RAW_INDEX_COLUMNS = ["uuid", "session_id", "session_dir", *STREAM_FILES.keys()]
+
+
+def is_session_dir(name: str) -> bool:
+    """Check if a directory name is that of a raw session, ex. `session_20200101120000`."""
+    return name.startswith("session_")
+
+
+def _describe_session(session_dir: str) -> Dict[str, str]:
+    try:
+        files = set(os.listdir(session_dir))
+    except OSError:
+        files = set()
+    row = {"uuid": "", "session_id": os.path.basename(session_dir), "session_dir": session_dir}
+    for stream, candidates in STREAM_FILES.items():
+        row[stream] = next((c for c in candidates if c in files), "")
+    return row
+
+
+def _scan_tree(top: str) -> List[Dict[str, str]]:
+    if is_session_dir(os.path.basename(top)):
+        return [_describe_session(top)]
+    rows = []
+    for root, dirs, _ in os.walk(top):
+        # session directories are not descended into, they hold the streams (and extractions) of a single session
+        sessions = [d for d in dirs if is_session_dir(d)]
+        rows.extend(_describe_session(os.path.join(root, d)) for d in sessions)
+        dirs[:] = [d for d in dirs if not is_session_dir(d) and not d.startswith(".")]
+    return rows
+
+
+def scan_raw_data(raw_data_path: str, threads: int = SCAN_THREADS) -> pd.DataFrame:
+    """Find the raw session directories under a directory, and the stream files they hold.
+
+    Subdirectories of `raw_data_path` are scanned in parallel.
+
+    Args:
+        raw_data_path (str): directory holding raw sessions, possibly nested in further directories.
+        threads (int): number of threads scanning subdirectories.
+
+    Returns:
+        pd.DataFrame: one row per session directory, with the columns of `RAW_INDEX_COLUMNS` (uuids are left empty).
+    """
+    entries = sorted(e.path for e in os.scandir(raw_data_path) if e.is_dir() and not e.name.startswith("."))
+    with span("scan_raw_data", "io", path=raw_data_path, dirs=len(entries)), ThreadPoolExecutor(max_workers=threads) as executor:
+        rows = [row for tree in executor.map(_scan_tree, entries) for row in tree]
+    return pd.DataFrame(rows, columns=RAW_INDEX_COLUMNS).sort_values("session_dir").reset_index(drop=True)
+
+
+def _read_input_file(h5_path: str) -> str:
+    def read() -> str:
+        import h5py
+        with h5py.File(h5_path, "r") as h5:
+            value = h5["metadata/extraction/parameters/input_file"][()]
+        return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+    return memoized_file("input_file", h5_path, read)
+
+
+def _session_id_from_extraction(h5_path: str) -> Optional[str]:
+    try:
+        input_file = _read_input_file(h5_path)
+    except (OSError, KeyError):
+        input_file = ""
+    if input_file:
+        return os.path.basename(os.path.dirname(input_file))
+    # extractions are usually written to a `proc` directory within the session directory
+    parent = os.path.dirname(os.path.abspath(h5_path))
+    if os.path.basename(parent) == "proc":
+        return os.path.basename(os.path.dirname(parent))
+    return None
+
+
+def session_ids(mconfig: ModelConfig, cache_dir: str = "", threads: int = SCAN_THREADS) -> Dict[str, str]:
+    """Get the raw session ID of each session of the index.
+
+    Session IDs come from the manifest (see `ModelConfig.manifest_path`) when it lists the session, otherwise from
+    the raw input file recorded in the extraction, otherwise from the location of the extraction.
+
+    Args:
+        mconfig (ModelConfig): model configuration, with the index and manifest.
+        cache_dir (str): cache directory, see `msq_maker.model.get_manifest()`.
+        threads (int): number of threads reading extractions.
+
+    Returns:
+        Dict[str, str]: session ID keyed by uuid, for the sessions whose ID could be determined.
+    """
+    index = get_index(mconfig.index)
+    ids: Dict[str, str] = {}
+    if mconfig.manifest_path:
+        try:
+            manifest = get_manifest(mconfig.manifest_path, mconfig.manifest_uuid_column, mconfig.manifest_session_id_column, cache_dir=cache_dir)
+            ids.update((uuid, manifest.uuid_to_session_id[uuid]) for uuid in index.uuid_to_h5 if uuid in manifest.uuid_to_session_id)
+        except ValueError as e:
+            logging.warning(f"{e} Session IDs are read from extractions instead.")
+
+    remaining = [uuid for uuid in index.uuid_to_h5 if uuid not in ids]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for uuid, sid in zip(remaining, executor.map(lambda u: _session_id_from_extraction(index.uuid_to_h5[u]), remaining)):
+            if sid is not None:
+                ids[uuid] = sid
+    return ids
+
+
+def stream_files_needed(streams: Iterable[str]) -> List[str]:
+    """Get the raw streams needed to cut clips of some streams (ex. "composed" clips combine depth and rgb)."""
+    needed = []
+    for stream in streams:
+        for s in (["depth", "rgb"] if stream == "composed" else [stream]):
+            if s in STREAM_FILES and s not in needed:
+                needed.append(s)
+    return needed
+
+
+def _is_readable(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            f.read(1)
+        return True
+    except OSError:
+        return False
+
+
+def check_raw_sessions(table: pd.DataFrame, session_ids: Iterable[str], streams: Iterable[str], threads: int = SCAN_THREADS) -> List[str]:
+    """Check that sessions are in a raw data index, with readable files for some streams.
+
+    Args:
+        table (pd.DataFrame): raw data index, see `index_raw_data()`.
+        session_ids (Iterable[str]): IDs of the sessions to check.
+        streams (Iterable[str]): streams the sessions must have, see `stream_files_needed()`.
+        threads (int): number of threads reading stream files.
+
+    Returns:
+        List[str]: human readable descriptions of each problem.
+    """
+    by_session_id = {row.session_id: row for row in table.itertuples()}
+    needed = stream_files_needed(streams)
+    missing_sessions = []
+    missing_streams: Dict[str, List[str]] = {s: [] for s in needed}
+    files = []
+    for sid in sorted(set(session_ids)):
+        row = by_session_id.get(sid)
+        if row is None:
+            missing_sessions.append(sid)
+            continue
+        for stream in needed:
+            name = getattr(row, stream)
+            if isinstance(name, str) and name:
+                files.append(os.path.join(row.session_dir, name))
+            else:
+                missing_streams[stream].append(sid)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        unreadable = [path for path, ok in zip(files, executor.map(_is_readable, files)) if not ok]
+
+    problems = []
+    if len(missing_sessions) > 0:
+        problems.append(f"{len(missing_sessions)} raw session(s) not found in the raw data index (re-run `msq-maker index-raw`): {format_list(missing_sessions)}.")
+    for stream, sids in missing_streams.items():
+        if len(sids) > 0:
+            problems.append(f"{len(sids)} raw session(s) have no {stream} stream: {format_list(sids)}.")
+    if len(unreadable) > 0:
+        problems.append(f"{len(unreadable)} raw stream file(s) cannot be read: {format_list(unreadable)}.")
+    return problems
+
+
+def raw_index_path(cache_dir: str, raw_data_path: str) -> str:
+    """Get the path of the raw data index of a raw data directory, see `index_raw_data()`."""
+    return os.path.join(cache_dir, "raw-index", f"{hash_object(os.path.abspath(raw_data_path))[:16]}.tsv")
+
+
+def index_raw_data(mconfig: ModelConfig, cache_dir: str, threads: int = SCAN_THREADS) -> Tuple[str, pd.DataFrame]:
+    """Scan the raw data directory of a model configuration, and save the sessions found as a raw data index.
+
+    Session directories are matched with the sessions of the index (see `session_ids()`) to fill the `uuid` column.
+    Session IDs held by several session directories, or by several sessions of the index, are ambiguous: their
+    directories are left unmatched, with a warning.
+
+    Returns:
+        Tuple[str, pd.DataFrame]: path of the raw data index, and its contents.
+    """
+    table = scan_raw_data(mconfig.raw_data_path, threads=threads)
+    if mconfig.index:
+        ids = session_ids(mconfig, cache_dir=cache_dir, threads=threads)
+        claims = Counter(ids.values())
+        uuids = {sid: uuid for uuid, sid in ids.items() if claims[sid] == 1}
+        duplicated = table["session_id"].duplicated(keep=False)
+        table["uuid"] = table["session_id"].map(uuids).where(~duplicated).fillna("")
+
+        shared = sorted((set(table["session_id"][duplicated]) & set(ids.values())) | {sid for sid, n in claims.items() if n > 1})
+        if len(shared) > 0:
+            logging.warning(f"{len(shared)} session ID(s) of the index are held by several raw session directories, or by several sessions"
+                            f" of the index, and are left unmatched: {format_list(shared)}.")
+
+    path = raw_index_path(cache_dir, mconfig.raw_data_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    table.to_csv(tmp_path, sep="\t", index=False)
+    os.replace(tmp_path, path)
+    return path, table
+
+
+def load_raw_index(cache_dir: str, raw_data_path: str) -> Optional[pd.DataFrame]:
+    """Load the raw data index of a raw data directory, None if `msq-maker index-raw` was not run for it."""
+    path = raw_index_path(cache_dir, raw_data_path)
+    if not cache_dir or not os.path.exists(path):
+        return None
+    def read() -> pd.DataFrame:
+        return pd.read_csv(path, sep="\t", dtype=str, keep_default_na=False)
+    return memoized_file("raw_index", path, read, latest_only=True).copy()
+
+
+def link_sessions(mconfig: ModelConfig, table: pd.DataFrame, dest: str, cache_dir: str = "") -> Tuple[str, List[str]]:
+    """Gather the raw sessions of the index into a directory of links, with a manifest mapping uuids to session IDs.
+
+    Tools locating raw sessions (ex. `syllable-clips --raw-path`) then only search through the sessions they need.
+
+    Links are named after session IDs, so sessions whose ID is shared, by several raw session directories or by several
+    sessions of the index, cannot be told apart: they are reported with the sessions which were not found, rather than
+    linked to the data of another session.
+
+    Args:
+        mconfig (ModelConfig): model configuration, whose index lists the sessions to gather.
+        table (pd.DataFrame): raw data index, see `index_raw_data()`.
+        dest (str): directory receiving the links, emptied first.
+        cache_dir (str): cache directory, see `msq_maker.model.get_manifest()`.
+
+    Returns:
+        Tuple[str, List[str]]: path of the manifest, with the columns "uuid" and "session_id", and the uuids of the sessions
+            which were not found, or whose session ID is ambiguous.
+    """
+    index = get_index(mconfig.index)
+    duplicated_ids = set(table["session_id"][table["session_id"].duplicated()])
+    # raw data indexes written before ambiguous session IDs were left unmatched may match duplicated IDs with a uuid
+    unique = [row for row in table.itertuples() if row.session_id not in duplicated_ids]
+    by_uuid = {row.uuid: row for row in unique if row.uuid}
+    by_session_id = {row.session_id: row for row in unique}
+    ids: Optional[Dict[str, str]] = None
+
+    found = {}
+    missing = []
+    ambiguous = []
+    for uuid in index.uuid_to_h5:
+        row = by_uuid.get(uuid)
+        if row is None:
+            # sessions added to the index since the raw data was indexed, or whose session ID is ambiguous
+            if ids is None:
+                ids = session_ids(mconfig, cache_dir=cache_dir)
+            session_id = ids.get(uuid, "")
+            if session_id in duplicated_ids:
+                ambiguous.append(uuid)
+                continue
+            row = by_session_id.get(session_id)
+        if row is None or not os.path.isdir(row.session_dir):
+            missing.append(uuid)
+            continue
+        found[uuid] = row
+
+    shutil.rmtree(dest, ignore_errors=True)
+    os.makedirs(dest)
+    rows = []
+    claims = Counter(row.session_id for row in found.values())
+    for uuid, row in found.items():
+        if claims[row.session_id] > 1:
+            ambiguous.append(uuid)
+            continue
+        os.symlink(row.session_dir, os.path.join(dest, row.session_id))
+        rows.append({"uuid": uuid, "session_id": row.session_id})
+
+    manifest_path = os.path.join(dest, "manifest.tsv")
+    pd.DataFrame(rows, columns=["uuid", "session_id"]).to_csv(manifest_path, sep="\t", index=False)
+    if len(missing) > 0:
+        logging.warning(f"{len(missing)} session(s) of the index were not found in the raw data index, re-run `msq-maker index-raw` if raw data was added.")
+    if len(ambiguous) > 0:
+        logging.warning(f"{len(ambiguous)} session(s) of the index share their session ID with other sessions, and cannot be located by session ID: {format_list(ambiguous)}.")
+    return manifest_path, missing + ambiguous
@@ -0,0 +1,444 @@
+import contextlib
+import errno
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from abc import ABC, abstractmethod
+from typing import IO, Callable, Dict, Iterator, Optional, Tuple
+
+import psutil
+from typing_extensions import Literal
+
+from msq_maker.cache import hash_object
+
+
+# Where the contents of a report are stored until they are bundled: a directory on disk (`tmp_dir`, the default), a
+# directory on a RAM backed filesystem (tmpfs), or the memory of the process. "auto" picks tmpfs when the report fits in
+# free memory.
+SpoolBackend = Literal["auto", "disk", "tmpfs", "memory"]
+
+# RAM backed filesystem holding tmpfs spools.
+TMPFS_ROOT = "/dev/shm"
+
+# Largest share of the available memory, and of the free space of `TMPFS_ROOT`, the estimated spool of a run may take
+# for the "auto" backend to pick tmpfs.
+TMPFS_MEMORY_FRACTION = 0.5
+
+# Identity of a spool file: a version which changes whenever the file is written (ex. modification time), and its size.
+SpoolSnapshot = Dict[str, Tuple[int, int]]
+
+
+class Spool(ABC):
+    """Storage of the files of a report until they are bundled, see `msq_maker.core.MSQ`.
+
+    Files are named by their path relative to the root of the spool, with "/" separators.
+    """
+
+    # Directory holding the files, None for spools which are not stored in a directory.
+    path: Optional[str] = None
+
+    @abstractmethod
+    def write_bytes(self, name: str, data: bytes) -> None:
+        """Write a file, replacing it if it exists."""
+        ...
+
+    @abstractmethod
+    def append_bytes(self, name: str, data: bytes, durable: bool = False) -> None:
+        """Append to a file, creating it if needed. With `durable`, the data survives the process being killed once this returns."""
+        ...
+
+    @abstractmethod
+    def read_bytes(self, name: str) -> bytes:
+        """Read a file.
+
+        Raises:
+            FileNotFoundError: if the file does not exist.
+        """
+        ...
+
+    @abstractmethod
+    def exists(self, name: str) -> bool:
+        ...
+
+    @abstractmethod
+    def remove(self, name: str) -> None:
+        """Remove a file, if it exists."""
+        ...
+
+    @abstractmethod
+    def snapshot(self) -> SpoolSnapshot:
+        """List the files of the spool, with their identity, keyed by name."""
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Remove all files of the spool."""
+        ...
+
+    @abstractmethod
+    def directory(self, name: str = "") -> "contextlib.AbstractContextManager[str]":
+        """Context manager providing a directory on disk whose contents end up under `name` in the spool.
+
+        For tools which write files themselves, ex. other packages' command line tools. Files written to the
+        directory are only guaranteed to be in the spool once the context exits.
+        """
+        ...
+
+    @abstractmethod
+    def staging(self, name: str) -> "Spool":
+        """Create an empty spool of the same kind, to stage the outputs of a producer running alongside others (see `move_from()`)."""
+        ...
+
+    @contextlib.contextmanager
+    def open(self, name: str, mode: str = "r") -> Iterator[IO]:
+        """Open a file for reading ("r", "rb"), writing ("w", "wb") or appending ("a", "ab"), as a context manager."""
+        binary = "b" in mode
+        if "r" in mode:
+            data = self.read_bytes(name)
+            yield io.BytesIO(data) if binary else io.StringIO(data.decode("utf-8"))
+            return
+        buffer: IO = io.BytesIO() if binary else io.StringIO()
+        yield buffer
+        data = buffer.getvalue()
+        data = data if binary else data.encode("utf-8")
+        if "a" in mode:
+            self.append_bytes(name, data)
+        else:
+            self.write_bytes(name, data)
+
+    def add_file(self, name: str, src_path: str, move: bool = False) -> None:
+        """Copy (or move) a file from disk into the spool."""
+        with open(src_path, "rb") as f:
+            self.write_bytes(name, f.read())
+        if move:
+            os.remove(src_path)
+
+    def move_from(self, other: "Spool") -> None:
+        """Move all files of another spool into this one, replacing files of the same name."""
+        for name in sorted(other.snapshot().keys()):
+            self.write_bytes(name, other.read_bytes(name))
+            other.remove(name)
+
+    def total_size(self) -> int:
+        """Get the total size, in bytes, of the files of the spool."""
+        return sum(size for _, size in self.snapshot().values())
+
+    def write_to_zip(self, zip: zipfile.ZipFile, name: str, arcname: str) -> None:
+        """Add a file of the spool to a zip archive."""
+        zip.writestr(arcname, self.read_bytes(name))
+
+
+class DiskSpool(Spool):
+    """Spool stored in a directory, ex. `tmp_dir` on disk, or a directory of a tmpfs (see `tmpfs_spool_path()`)."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __str__(self) -> str:
+        return self.path
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def write_bytes(self, name: str, data: bytes) -> None:
+        with self.open(name, "wb") as f:
+            f.write(data)
+
+    def append_bytes(self, name: str, data: bytes, durable: bool = False) -> None:
+        with self.open(name, "ab") as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read_bytes(self, name: str) -> bytes:
+        with open(self._path(name), "rb") as f:
+            return f.read()
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+    def remove(self, name: str) -> None:
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def snapshot(self) -> SpoolSnapshot:
+        snapshot: SpoolSnapshot = {}
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[os.path.relpath(path, self.path).replace(os.sep, "/")] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def clear(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def directory(self, name: str = "") -> Iterator[str]:
+        path = self._path(name)
+        os.makedirs(path, exist_ok=True)
+        yield path
+
+    def staging(self, name: str) -> "DiskSpool":
+        staged = DiskSpool(f"{os.path.normpath(self.path)}.{name}.staging")
+        staged.clear()
+        os.makedirs(staged.path)
+        return staged
+
+    @contextlib.contextmanager
+    def open(self, name: str, mode: str = "r") -> Iterator[IO]:
+        path = self._path(name)
+        if "r" not in mode:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, mode) as f:
+            yield f
+
+    def add_file(self, name: str, src_path: str, move: bool = False) -> None:
+        dest = self._path(name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if move:
+            shutil.move(src_path, dest)
+        else:
+            shutil.copy2(src_path, dest)
+
+    def move_from(self, other: Spool) -> None:
+        if not isinstance(other, DiskSpool):
+            super().move_from(other)
+            return
+        for name in sorted(other.snapshot().keys()):
+            self.add_file(name, other._path(name), move=True)
+
+    def write_to_zip(self, zip: zipfile.ZipFile, name: str, arcname: str) -> None:
+        zip.write(self._path(name), arcname=arcname)
+
+
+class TmpfsSpool(DiskSpool):
+    """Spool in a directory of a tmpfs (see `tmpfs_spool_path()`), which moves to a directory on disk if the tmpfs fills up.
+
+    Files are written whole, under a lock, so that a write failing for lack of space can be retried on disk once the
+    spool moved. Tools writing files themselves could not be retried, so `directory()` has them write on disk, next
+    to `fallback`, and moves their files into the spool afterwards.
+
+    The run journal is kept in `fallback` (see `msq_maker.journal.RunJournal.for_spool()`), which `clear()` removes too.
+    """
+
+    def __init__(self, path: str, fallback: str):
+        super().__init__(path)
+        self.fallback = fallback
+        self._lock = threading.Lock()
+
+    @property
+    def spilled(self) -> bool:
+        """Whether the spool moved to `fallback` on disk."""
+        return self.path == self.fallback
+
+    def _spill(self) -> None:
+        logging.warning(f"The tmpfs holding the spool \"{self.path}\" is full, moving the spool to \"{self.fallback}\" on disk.")
+        tmpfs_path = self.path
+        self.path = self.fallback
+        for root, _, files in os.walk(tmpfs_path):
+            for file in files:
+                path = os.path.join(root, file)
+                dest = self._path(os.path.relpath(path, tmpfs_path))
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.move(path, dest)
+        shutil.rmtree(tmpfs_path, ignore_errors=True)
+
+    def _write(self, write: Callable[[], None]) -> None:
+        with self._lock:
+            try:
+                write()
+            except OSError as e:
+                if e.errno != errno.ENOSPC or self.spilled:
+                    raise
+                self._spill()
+                write()
+
+    def write_bytes(self, name: str, data: bytes) -> None:
+        def write() -> None:
+            with DiskSpool.open(self, name, "wb") as f:
+                f.write(data)
+        self._write(write)
+
+    def append_bytes(self, name: str, data: bytes, durable: bool = False) -> None:
+        def append() -> None:
+            path = self._path(name)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            try:
+                with DiskSpool.open(self, name, "ab") as f:
+                    f.write(data)
+                    if durable:
+                        f.flush()
+                        os.fsync(f.fileno())
+            except OSError:
+                # drop the partial append, so that it is not repeated when retried
+                if os.path.exists(path):
+                    os.truncate(path, size)
+                raise
+        self._write(append)
+
+    def add_file(self, name: str, src_path: str, move: bool = False) -> None:
+        self._write(lambda: DiskSpool.add_file(self, name, src_path, move=move))
+
+    def clear(self) -> None:
+        super().clear()
+        shutil.rmtree(self.fallback, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def directory(self, name: str = "") -> Iterator[str]:
+        if self.spilled:
+            with DiskSpool.directory(self, name) as path:
+                yield path
+            return
+        parent = os.path.dirname(os.path.abspath(self.fallback))
+        os.makedirs(parent, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix=f"{os.path.basename(self.fallback)}.", dir=parent) as tmp:
+            try:
+                yield tmp
+            finally:
+                # whatever was written is kept, as a disk spool would
+                for root, _, files in os.walk(tmp):
+                    for file in files:
+                        path = os.path.join(root, file)
+                        self.add_file(os.path.join(name, os.path.relpath(path, tmp)), path, move=True)
+
+    def open(self, name: str, mode: str = "r") -> "contextlib.AbstractContextManager[IO]":
+        if "r" in mode:
+            return DiskSpool.open(self, name, mode)
+        # buffer writes, so that they go through `write_bytes()` and `append_bytes()`
+        return Spool.open(self, name, mode)
+
+    def staging(self, name: str) -> DiskSpool:
+        if self.spilled:
+            return DiskSpool.staging(self, name)
+        staged = TmpfsSpool(f"{os.path.normpath(self.path)}.{name}.staging", f"{os.path.normpath(self.fallback)}.{name}.staging")
+        staged.clear()
+        os.makedirs(staged.path)
+        return staged
+
+
+class MemorySpool(Spool):
+    """Spool held in the memory of the process, ex. to generate reports programmatically without touching the disk.
+
+    Its contents are lost when the process exits, so runs using it cannot be resumed or bundled from another process.
+    """
+
+    def __init__(self) -> None:
+        self._files: Dict[str, bytes] = {}
+        self._versions: Dict[str, int] = {}
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def __str__(self) -> str:
+        return "<memory>"
+
+    def _store(self, name: str, data: bytes) -> None:
+        name = os.path.normpath(name).replace(os.sep, "/")
+        with self._lock:
+            self._version += 1
+            self._files[name] = data
+            self._versions[name] = self._version
+
+    def write_bytes(self, name: str, data: bytes) -> None:
+        self._store(name, bytes(data))
+
+    def append_bytes(self, name: str, data: bytes, durable: bool = False) -> None:
+        with self._lock:
+            previous = self._files.get(os.path.normpath(name).replace(os.sep, "/"), b"")
+        self._store(name, previous + data)
+
+    def read_bytes(self, name: str) -> bytes:
+        try:
+            return self._files[os.path.normpath(name).replace(os.sep, "/")]
+        except KeyError:
+            raise FileNotFoundError(f"No file \"{name}\" in the spool.")
+
+    def exists(self, name: str) -> bool:
+        return os.path.normpath(name).replace(os.sep, "/") in self._files
+
+    def remove(self, name: str) -> None:
+        name = os.path.normpath(name).replace(os.sep, "/")
+        with self._lock:
+            self._files.pop(name, None)
+            self._versions.pop(name, None)
+
+    def snapshot(self) -> SpoolSnapshot:
+        with self._lock:
+            return {name: (self._versions[name], len(data)) for name, data in self._files.items()}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._files.clear()
+            self._versions.clear()
+
+    @contextlib.contextmanager
+    def directory(self, name: str = "") -> Iterator[str]:
+        with tempfile.TemporaryDirectory(prefix="msq-spool-") as tmp:
+            try:
+                yield tmp
+            finally:
+                # whatever was written is kept, as a disk spool would
+                for root, _, files in os.walk(tmp):
+                    for file in files:
+                        path = os.path.join(root, file)
+                        self.add_file(os.path.join(name, os.path.relpath(path, tmp)), path)
+
+    def staging(self, name: str) -> "MemorySpool":
+        return MemorySpool()
+
+
+def tmpfs_spool_path(tmp_dir: str) -> str:
+    """Get the directory of the tmpfs spool standing for `tmp_dir`, so that later commands (ex. `--resume`, `bundle`) find it."""
+    return os.path.join(TMPFS_ROOT, f"msq-maker-{hash_object(os.path.abspath(tmp_dir))[:16]}")
+
+
+def has_tmpfs() -> bool:
+    """Check if a RAM backed filesystem (`TMPFS_ROOT`) is available for spools."""
+    return os.path.isdir(TMPFS_ROOT) and os.access(TMPFS_ROOT, os.W_OK)
+
+
+def tmpfs_capacity() -> int:
+    """Get how many bytes a tmpfs spool may take: the free space of `TMPFS_ROOT`, bounded by the available memory, times `TMPFS_MEMORY_FRACTION`."""
+    if not has_tmpfs():
+        return 0
+    return int(min(shutil.disk_usage(TMPFS_ROOT).free, psutil.virtual_memory().available) * TMPFS_MEMORY_FRACTION)
+
+
+def existing_spool_backend(tmp_dir: str) -> Optional[SpoolBackend]:
+    """Find the backend of the spool a previous run left for `tmp_dir`, None if there is none."""
+    if os.path.isdir(tmpfs_spool_path(tmp_dir)):
+        return "tmpfs"
+    if os.path.isdir(tmp_dir) and len(os.listdir(tmp_dir)) > 0:
+        return "disk"
+    return None
+
+
+def open_spool(tmp_dir: str, backend: SpoolBackend = "auto") -> Spool:
+    """Open the spool of a report.
+
+    Args:
+        tmp_dir (str): temporary directory of the report, see `msq_maker.core.MSQConfig`.
+        backend (SpoolBackend): where the spool is stored. "auto" reopens the spool of a previous run, if any, and otherwise
+            uses the disk (see `msq_maker.plan.choose_spool_backend()` to pick tmpfs when a run fits in memory).
+    """
+    if backend == "auto":
+        backend = existing_spool_backend(tmp_dir) or "disk"
+    if backend == "tmpfs" and not has_tmpfs():
+        logging.warning(f"No tmpfs found at {TMPFS_ROOT}, spooling to \"{tmp_dir}\" on disk instead.")
+        backend = "disk"
+
+    if backend == "memory":
+        return MemorySpool()
+    if backend == "tmpfs":
+        return TmpfsSpool(tmpfs_spool_path(tmp_dir), fallback=tmp_dir)
+    return DiskSpool(tmp_dir)
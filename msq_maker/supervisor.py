@@ -0,0 +1,314 @@
+import asyncio
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import psutil
+
+from msq_maker.core import MSQ, BaseProducer
+from msq_maker.journal import RunJournal
+from msq_maker.profiling import format_bytes
+from msq_maker.tracing import record_process, span
+
+
+# Seconds between samples of the resource usage of supervised processes.
+SAMPLE_INTERVAL = 0.5
+
+# Minimum seconds between two logged updates of the same progress bar.
+PROGRESS_INTERVAL = 10.0
+
+# Seconds a process is given to exit after being terminated on timeout, before it is killed.
+TERMINATE_GRACE = 10.0
+
+# Lines drawn by progress bars (ex. tqdm "  42%|####      | 42/100 [00:10<00:14,  4.1it/s]").
+_PROGRESS_RE = re.compile(r"(^|\s)\d{1,3}%\||\d+/\d+ \[\d+:\d+")
+
+
+@dataclass
+class ProcessResult:
+    """Outcome and resource usage of a supervised process, including its descendants.
+
+    Resource usage is sampled every `SAMPLE_INTERVAL` seconds, so it misses what processes use in their last moments.
+    """
+    command: List[str]
+    pid: int
+    returncode: Optional[int] = None
+    timed_out: bool = False
+    wall_time: float = 0.0
+    cpu_user: float = 0.0
+    cpu_system: float = 0.0
+    max_rss: int = 0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    # last sample of each process, keyed by pid: (user, system, read_bytes, write_bytes)
+    _usage: Dict[int, Tuple[float, float, int, int]] = field(default_factory=dict, repr=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: v for k, v in asdict(self).items() if not k.startswith("_")}
+
+    def summary(self) -> str:
+        """Describe the resource usage in a single line."""
+        return (f"wall {self.wall_time:.1f}s, cpu {self.cpu_user:.1f}s user + {self.cpu_system:.1f}s system, max rss {format_bytes(self.max_rss)}, "
+                f"read {format_bytes(self.read_bytes)}, written {format_bytes(self.write_bytes)}")
+
+    def _sample(self, proc: psutil.Process) -> None:
+        try:
+            procs = [proc] + proc.children(recursive=True)
+        except psutil.Error:
+            return
+        rss = 0
+        for p in procs:
+            try:
+                with p.oneshot():
+                    cpu = p.cpu_times()
+                    rss += p.memory_info().rss
+                    try:
+                        io = p.io_counters()
+                        read, written = io.read_bytes, io.write_bytes
+                    except (psutil.Error, AttributeError):
+                        # not available on all platforms
+                        read, written = 0, 0
+            except psutil.Error:
+                continue
+            self._usage[p.pid] = (cpu.user, cpu.system, read, written)
+        self.max_rss = max(self.max_rss, rss)
+        self.cpu_user = sum(u[0] for u in self._usage.values())
+        self.cpu_system = sum(u[1] for u in self._usage.values())
+        self.read_bytes = sum(u[2] for u in self._usage.values())
+        self.write_bytes = sum(u[3] for u in self._usage.values())
+
+
+class _OutputLogger:
+    """Log the output of a process line by line, collapsing the redraws of progress bars.
+
+    Progress bars redraw their line many times a second. Only the latest state of a progress bar is kept, and
+    logged at most once every `interval` seconds, and when the output ends.
+    """
+
+    def __init__(self, prefix: str, interval: float = PROGRESS_INTERVAL):
+        self.prefix = prefix
+        self.interval = interval
+        self._buffer = ""
+        self._pending: Optional[str] = None
+        self._last_progress = 0.0
+
+    def feed(self, text: str) -> None:
+        lines = (self._buffer + text).replace("\r", "\n").split("\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            self._line(line.strip())
+
+    def close(self) -> None:
+        self._line(self._buffer.strip())
+        self._buffer = ""
+        if self._pending is not None:
+            self._log(self._pending)
+            self._pending = None
+
+    def _line(self, line: str) -> None:
+        if not line:
+            return
+        if _PROGRESS_RE.search(line) is None:
+            self._log(line)
+            return
+        now = time.monotonic()
+        if now - self._last_progress >= self.interval:
+            self._last_progress = now
+            self._pending = None
+            self._log(line)
+        else:
+            self._pending = line
+
+    def _log(self, line: str) -> None:
+        logging.info(f"{self.prefix}{line}")
+
+
+async def _pump(stream: asyncio.StreamReader, output: _OutputLogger) -> None:
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        output.feed(chunk.decode("utf-8", errors="replace"))
+    output.close()
+
+
+async def _sample(result: ProcessResult, proc: psutil.Process) -> None:
+    while True:
+        result._sample(proc)
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+def _terminate(proc: psutil.Process) -> None:
+    """Terminate a process and its descendants, killing those which do not exit within `TERMINATE_GRACE` seconds."""
+    try:
+        procs = proc.children(recursive=True) + [proc]
+    except psutil.Error:
+        procs = [proc]
+    for p in procs:
+        try:
+            p.terminate()
+        except psutil.Error:
+            pass
+    _, alive = psutil.wait_procs(procs, timeout=TERMINATE_GRACE)
+    for p in alive:
+        try:
+            p.kill()
+        except psutil.Error:
+            pass
+
+
+async def supervise(command: List[str], timeout: Optional[float] = None, prefix: str = "") -> ProcessResult:
+    """Run a process, logging its output and sampling its resource usage, and wait for it to exit.
+
+    Args:
+        command (List[str]): command to run.
+        timeout (float|None): wall-clock time limit, in seconds. The process and its descendants are terminated when it is exceeded.
+        prefix (str): prefix of the logged output lines, ex. to tell apart processes running at the same time.
+
+    Returns:
+        ProcessResult: outcome and resource usage of the process.
+    """
+    start = time.time()
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    result = ProcessResult(command=command, pid=process.pid)
+    try:
+        proc = psutil.Process(process.pid)
+    except psutil.Error:
+        proc = None
+
+    pumps = asyncio.gather(_pump(process.stdout, _OutputLogger(prefix)), _pump(process.stderr, _OutputLogger(prefix)))
+    sampler = asyncio.ensure_future(_sample(result, proc)) if proc is not None else None
+    try:
+        await asyncio.wait_for(process.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        result.timed_out = True
+        logging.error(f"{prefix}Timed out after {timeout}s, terminating \"{command[0]}\".")
+        if proc is not None:
+            await asyncio.get_event_loop().run_in_executor(None, _terminate, proc)
+        await process.wait()
+    finally:
+        if sampler is not None:
+            sampler.cancel()
+        await pumps
+
+    result.returncode = process.returncode
+    result.wall_time = time.time() - start
+    record_process(os.path.basename(command[0]), process.pid, start, time.time(), command=command, **{k: v for k, v in result.to_dict().items() if k not in ("command", "pid")})
+    return result
+
+
+class ProcessSupervisor:
+    """Supervise processes from an event loop running in a background thread.
+
+    Any thread can start processes with `submit()`, and several processes can be supervised at once.
+    """
+
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        if sys.version_info < (3, 8):
+            # before python 3.8, processes can only be waited for by an event loop attached from the main thread
+            watcher = asyncio.SafeChildWatcher()
+            watcher.attach_loop(self.loop)
+            asyncio.set_child_watcher(watcher)
+        self._thread = threading.Thread(target=self.loop.run_forever, name="msq-supervisor", daemon=True)
+        self._thread.start()
+
+    def submit(self, command: List[str], timeout: Optional[float] = None, prefix: str = "") -> "Future[ProcessResult]":
+        """Start a process, see `supervise()`."""
+        return asyncio.run_coroutine_threadsafe(supervise(command, timeout=timeout, prefix=prefix), self.loop)
+
+    def close(self) -> None:
+        """Stop the event loop. Processes still running are no longer supervised."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+_supervisor: Optional[ProcessSupervisor] = None
+_supervisor_lock = threading.Lock()
+
+
+def get_supervisor() -> ProcessSupervisor:
+    """Get the process supervisor of this process, starting it on first use.
+
+    With python 3.7, it must first be used from the main thread.
+    """
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = ProcessSupervisor()
+        return _supervisor
+
+
+def run_supervised(command: List[str], timeout: Optional[float] = None, prefix: str = "") -> ProcessResult:
+    """Run a process with the process supervisor, waiting for it to exit.
+
+    Raises:
+        FileNotFoundError: if the command does not exist.
+        subprocess.TimeoutExpired: if the process exceeded its `timeout`.
+        subprocess.CalledProcessError: if the process exited with a non-zero code.
+    """
+    result = get_supervisor().submit(command, timeout=timeout, prefix=prefix).result()
+    logging.info(f"{prefix}\"{command[0]}\" exited with code {result.returncode}: {result.summary()}.")
+    if result.timed_out:
+        raise subprocess.TimeoutExpired(command, timeout)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, command)
+    return result
+
+
+class BackgroundProducers:
+    """Run producers which mostly wait on subprocesses (see `BaseProducer.runs_subprocess()`) in background threads.
+
+    Each background producer writes to its own staging spool, next to the spool of the report, so that its outputs
+    can be told apart from those of producers running at the same time. `finish()` waits for the producers and moves
+    their outputs into the report, recording them in the run journal as if the producers had run one after the other.
+    """
+
+    def __init__(self, msq: MSQ, journal: RunJournal, threads: int = 4):
+        self.msq = msq
+        self.journal = journal
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="msq-background")
+        self._pending: List[Tuple[str, str, MSQ, Future]] = []
+
+    def submit(self, name: str, config_hash: str, producer: BaseProducer) -> None:
+        """Start running a producer in the background."""
+        staged = MSQ(self.msq.config, spool=self.msq.spool.staging(name))
+
+        # processes must first be supervised from the main thread, see `get_supervisor()`
+        get_supervisor()
+
+        def run() -> None:
+            with span(name, "producer"):
+                producer.run(staged)
+        logging.info(f"Running producer \"{name}\" in the background...")
+        self._pending.append((name, config_hash, staged, self._executor.submit(run)))
+
+    def finish(self) -> List[str]:
+        """Wait for the producers running in the background and move their outputs into the report.
+
+        Returns:
+            List[str]: names of the producers which failed.
+        """
+        errors = []
+        for name, config_hash, staged, future in self._pending:
+            try:
+                with self.journal.record(name, config_hash, self.msq):
+                    future.result()
+                    self.msq.spool.move_from(staged.spool)
+                    self.msq.manifest.update(staged.manifest)
+            except Exception:
+                errors.append(name)
+                logging.exception(f"Error generating {name}, but continuing onward.")
+            staged.spool.clear()
+            logging.info(f"Finished running {name}.")
+        self._pending = []
+        self._executor.shutdown(wait=True)
+        return errors
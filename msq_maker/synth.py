@@ -0,0 +1,289 @@
+import datetime
+import json
+import logging
+import os
+import uuid as uuidlib
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+import joblib
+import numpy as np
+import yaml
+
+
+@dataclass
+class SynthOptions:
+    """Options controlling the size and shape of a synthetic moseq dataset."""
+    sessions: int = field(default=10, metadata={"doc": "Number of sessions (extractions) to generate."})
+    frames: int = field(default=18000, metadata={"doc": "Number of frames per session."})
+    syllables: int = field(default=50, metadata={"doc": "Number of syllables with nonzero usage."})
+    max_states: int = field(default=100, metadata={"doc": "Value of the `max_states` model training parameter."})
+    groups: int = field(default=2, metadata={"doc": "Number of groups the sessions are split into."})
+    frame_size: int = field(default=80, metadata={"doc": "Width and height of the cropped depth frames."})
+    raw_size: Tuple[int, int] = field(default=(512, 424), metadata={"doc": "Width and height of the raw depth frames."})
+    npcs: int = field(default=10, metadata={"doc": "Number of principal components."})
+    nlags: int = field(default=3, metadata={"doc": "Number of autoregressive lags of the model."})
+    mean_duration: float = field(default=10.0, metadata={"doc": "Mean syllable duration, in frames."})
+    fps: float = field(default=30.0, metadata={"doc": "Frame rate of the sessions."})
+    detectron: bool = field(default=False, metadata={"doc": "Mark extractions as produced by moseq2-detectron-extract."})
+    raw: bool = field(default=False, metadata={"doc": "Also write raw session directories (depth stream only)."})
+    seed: int = field(default=0, metadata={"doc": "Random seed."})
+
+
+@dataclass
+class SynthDataset:
+    """Paths of a generated synthetic dataset."""
+    index: str
+    model: str
+    pca: str
+    raw_data_path: str
+    uuids: List[str]
+
+
+def syllable_usage_probabilities(num_syllables: int, decay: float = 0.08) -> np.ndarray:
+    """Heavy tailed syllable usage distribution, similar to the usage curves of real models."""
+    probs = np.exp(-decay * np.arange(num_syllables))
+    return probs / probs.sum()
+
+
+def generate_labels(rng: np.random.Generator, options: SynthOptions, usage: np.ndarray) -> np.ndarray:
+    """Generate the label sequence of a single session.
+
+    Syllable identities follow `usage`, without self transitions, and durations follow a negative binomial
+    distribution (overdispersed, with a mode of a few frames) with the configured mean duration.
+
+    Args:
+        rng (np.random.Generator): random generator.
+        options (SynthOptions): dataset options.
+        usage (np.ndarray): syllable usage probabilities, indexed by raw syllable ID.
+
+    Returns:
+        np.ndarray: int16 labels with `options.nlags` leading "unknown" (-5) labels, of length `options.frames`.
+    """
+    num_frames = options.frames - options.nlags
+    # over-provision instances, trimming the excess once durations are known
+    num_instances = max(2, int(2 * num_frames / max(options.mean_duration, 1)) + 10)
+
+    syllables = rng.choice(len(usage), size=num_instances, p=usage)
+    # remove self transitions by shifting repeated syllables to another syllable
+    repeats = np.where(syllables[1:] == syllables[:-1])[0] + 1
+    while len(repeats) > 0:
+        syllables[repeats] = (syllables[repeats] + rng.integers(1, len(usage), size=len(repeats))) % len(usage)
+        repeats = np.where(syllables[1:] == syllables[:-1])[0] + 1
+
+    shape = 2.0
+    durations = 1 + rng.negative_binomial(shape, shape / (shape + options.mean_duration - 1), size=num_instances)
+    labels = np.repeat(syllables, durations)[:num_frames]
+    return np.concatenate([np.full(options.nlags, -5), labels]).astype("int16")
+
+
+def generate_scalars(rng: np.random.Generator, options: SynthOptions) -> Dict[str, np.ndarray]:
+    """Generate smooth random-walk scalars of a mouse moving in a circular arena."""
+    n = options.frames
+    width, height = options.raw_size
+    radius = 0.4 * min(width, height)
+    px_per_mm = 2.0
+
+    # random walk of the centroid, pulled back inside the arena when it wanders out
+    steps = rng.normal(scale=1.5, size=(n, 2)).cumsum(axis=0)
+    steps -= steps.mean(axis=0)
+    norm = np.linalg.norm(steps, axis=1, keepdims=True)
+    scale = np.where(norm > radius, radius / np.maximum(norm, 1e-9), 1)
+    centroid = steps * scale + np.array([width / 2, height / 2])
+
+    angle = np.cumsum(rng.normal(scale=0.05, size=n))
+    angle = (angle + np.pi) % (2 * np.pi) - np.pi
+    velocity_px = np.concatenate([[0], np.linalg.norm(np.diff(centroid, axis=0), axis=1)])
+    length_px = 60 + rng.normal(scale=2, size=n)
+    width_px = 30 + rng.normal(scale=1, size=n)
+    height_ave = 30 + rng.normal(scale=2, size=n)
+
+    scalars = {
+        "angle": angle,
+        "centroid_x_px": centroid[:, 0],
+        "centroid_y_px": centroid[:, 1],
+        "centroid_x_mm": centroid[:, 0] / px_per_mm,
+        "centroid_y_mm": centroid[:, 1] / px_per_mm,
+        "velocity_2d_px": velocity_px,
+        "velocity_2d_mm": velocity_px / px_per_mm,
+        "velocity_3d_px": velocity_px,
+        "velocity_3d_mm": velocity_px / px_per_mm,
+        "velocity_theta": np.concatenate([[0], np.arctan2(*np.diff(centroid, axis=0).T[::-1])]),
+        "height_ave_mm": height_ave,
+        "length_px": length_px,
+        "length_mm": length_px / px_per_mm,
+        "width_px": width_px,
+        "width_mm": width_px / px_per_mm,
+        "area_px": np.pi * length_px * width_px / 4,
+        "area_mm": np.pi * length_px * width_px / 4 / px_per_mm ** 2,
+    }
+    return {k: v.astype("float32") for k, v in scalars.items()}
+
+
+def mouse_template(frame_size: int) -> np.ndarray:
+    """A smooth elliptical height map resembling a cropped, rotated mouse."""
+    yy, xx = np.mgrid[0:frame_size, 0:frame_size].astype("float32")
+    c = (frame_size - 1) / 2
+    dist = ((xx - c) / (0.35 * frame_size)) ** 2 + ((yy - c) / (0.18 * frame_size)) ** 2
+    return np.clip(40 * (1 - dist), 0, None)
+
+
+def write_extraction(path: str, session_uuid: str, metadata: Dict[str, str], raw_input: str,
+                     rng: np.random.Generator, options: SynthOptions, chunk: int = 1000) -> None:
+    """Write a synthetic extraction h5 file, with the layout produced by moseq2-extract."""
+    import h5py
+
+    scalars = generate_scalars(rng, options)
+    template = mouse_template(options.frame_size)
+    width, height = options.raw_size
+
+    with h5py.File(path, "w") as h5:
+        frames = h5.create_dataset("frames", shape=(options.frames, options.frame_size, options.frame_size), dtype="uint8",
+                                   chunks=(min(chunk, options.frames), options.frame_size, options.frame_size), compression="gzip")
+        for start in range(0, options.frames, chunk):
+            stop = min(options.frames, start + chunk)
+            noise = rng.normal(scale=1.0, size=(stop - start, 1, 1)).astype("float32")
+            frames[start:stop] = np.clip(template[None] + noise * (template[None] > 0), 0, 255).astype("uint8")
+
+        for name, values in scalars.items():
+            h5.create_dataset(f"scalars/{name}", data=values)
+        h5.create_dataset("timestamps", data=(np.arange(options.frames) * 1000 / options.fps).astype("float64"))
+
+        h5.create_dataset("metadata/uuid", data=session_uuid)
+        for key, value in metadata.items():
+            h5.create_dataset(f"metadata/acquisition/{key}", data=value)
+
+        yy, xx = np.mgrid[0:height, 0:width]
+        roi = ((xx - width / 2) ** 2 + (yy - height / 2) ** 2) <= (0.45 * min(width, height)) ** 2
+        h5.create_dataset("metadata/extraction/roi", data=roi)
+        h5.create_dataset("metadata/extraction/true_depth", data=673.0)
+        h5.create_dataset("metadata/extraction/flips", data=rng.random(options.frames) < 0.01)
+        version = "moseq2-detectron-extract 0.0.0" if options.detectron else "moseq2-extract 0.0.0"
+        h5.create_dataset("metadata/extraction/extract_version", data=version)
+        h5.create_dataset("metadata/extraction/parameters/input_file", data=raw_input)
+
+
+def write_raw_session(session_dir: str, rng: np.random.Generator, metadata: Dict[str, str], options: SynthOptions, chunk: int = 500) -> str:
+    """Write a synthetic raw session directory, with the depth stream and its timestamps."""
+    os.makedirs(session_dir, exist_ok=True)
+    width, height = options.raw_size
+    depth_path = os.path.join(session_dir, "depth.dat")
+    with open(depth_path, "wb") as f:
+        for start in range(0, options.frames, chunk):
+            stop = min(options.frames, start + chunk)
+            block = (673 + rng.normal(scale=2, size=(stop - start, height, width))).astype("uint16")
+            f.write(block.tobytes())
+
+    with open(os.path.join(session_dir, "depth_ts.txt"), "w") as f:
+        for i in range(options.frames):
+            f.write(f"{i * 1000 / options.fps:.3f} 0\n")
+
+    with open(os.path.join(session_dir, "metadata.json"), "w") as f:
+        json.dump(metadata, f, indent=4)
+
+    return depth_path
+
+
+def generate_dataset(out_dir: str, options: SynthOptions) -> SynthDataset:
+    """Generate a synthetic moseq dataset: extractions, PCA scores, a model and an index.
+
+    Args:
+        out_dir (str): directory where the dataset is written.
+        options (SynthOptions): dataset options.
+
+    Returns:
+        SynthDataset: paths of the generated files.
+    """
+    import h5py
+
+    if options.syllables > options.max_states:
+        raise ValueError(f"syllables ({options.syllables}) cannot exceed max_states ({options.max_states})")
+
+    rng = np.random.default_rng(options.seed)
+    out_dir = os.path.abspath(out_dir)
+    extract_dir = os.path.join(out_dir, "extractions")
+    raw_dir = os.path.join(out_dir, "raw")
+    pca_dir = os.path.join(out_dir, "_pca")
+    for d in [extract_dir, raw_dir, pca_dir]:
+        os.makedirs(d, exist_ok=True)
+
+    # raw IDs are shuffled, so that usage order and raw order differ, as in real models
+    usage = np.zeros(options.max_states)
+    usage[rng.permutation(options.max_states)[:options.syllables]] = syllable_usage_probabilities(options.syllables)
+
+    group_names = [f"group{g + 1}" for g in range(options.groups)]
+    start_time = datetime.datetime(2020, 1, 1, 9, 0, 0)
+
+    index_files = []
+    labels = []
+    uuids = []
+    groups = {}
+    with h5py.File(os.path.join(pca_dir, "pca_scores.h5"), "w") as pca_h5:
+        for i in range(options.sessions):
+            session_uuid = str(uuidlib.UUID(int=int(rng.integers(0, 2**63)) << 64 | int(rng.integers(0, 2**63)), version=4))
+            session_name = f"session_{i:05d}"
+            group = group_names[i % len(group_names)]
+            metadata = {
+                "SessionName": session_name,
+                "SubjectName": f"subject_{i:05d}",
+                "StartTime": (start_time + datetime.timedelta(hours=i)).isoformat(),
+                "ApparatusName": "synth",
+            }
+            logging.info(f"Generating session {i + 1}/{options.sessions} ({session_uuid})")
+
+            session_dir = os.path.join(raw_dir, session_name)
+            raw_input = os.path.join(session_dir, "depth.dat")
+            if options.raw:
+                write_raw_session(session_dir, rng, metadata, options)
+
+            h5_path = os.path.join(extract_dir, f"{session_name}.h5")
+            yaml_path = os.path.join(extract_dir, f"{session_name}.yaml")
+            write_extraction(h5_path, session_uuid, metadata, raw_input, rng, options)
+            with open(yaml_path, "w") as f:
+                yaml.safe_dump({"uuid": session_uuid, "metadata": metadata, "parameters": {"input_file": raw_input}}, f)
+
+            session_labels = generate_labels(rng, options, usage)
+            scores = rng.normal(size=(options.frames, options.npcs)).astype("float32")
+            scores[:options.nlags] = np.nan
+            pca_h5.create_dataset(f"scores/{session_uuid}", data=scores)
+            pca_h5.create_dataset(f"scores_idx/{session_uuid}", data=np.arange(options.frames, dtype="float64"))
+
+            index_files.append({"path": [h5_path, yaml_path], "uuid": session_uuid, "group": group, "metadata": metadata})
+            labels.append(session_labels)
+            uuids.append(session_uuid)
+            groups[session_uuid] = group
+
+    index_path = os.path.join(out_dir, "moseq2-index.yaml")
+    with open(index_path, "w") as f:
+        yaml.safe_dump({"files": index_files, "pca_path": os.path.join(pca_dir, "pca_scores.h5")}, f)
+
+    # stable autoregressive dynamics, one set of parameters per state
+    ar_mat = []
+    for _ in range(options.max_states):
+        a = rng.normal(scale=0.1 / options.nlags, size=(options.npcs, options.npcs * options.nlags))
+        a[:, -options.npcs:] += 0.9 * np.eye(options.npcs) / options.nlags
+        ar_mat.append(np.concatenate([a, rng.normal(scale=0.01, size=(options.npcs, 1))], axis=1))
+
+    model = {
+        "labels": labels,
+        "keys": uuids,
+        "train_list": uuids,
+        "metadata": {"uuids": uuids, "groups": groups},
+        "model_parameters": {
+            "ar_mat": ar_mat,
+            "sig": [np.eye(options.npcs) * 0.1 for _ in range(options.max_states)],
+            "nu": [options.npcs + 2.0 for _ in range(options.max_states)],
+        },
+        "run_parameters": {
+            "max_states": options.max_states,
+            "npcs": options.npcs,
+            "nlags": options.nlags,
+            "index": index_path,
+            "pca_file_scores": os.path.join(pca_dir, "pca_scores.h5"),
+        },
+        "pc_score_path": os.path.join(pca_dir, "pca_scores.h5"),
+    }
+    model_path = os.path.join(out_dir, "model.p")
+    joblib.dump(model, model_path, compress=0)
+
+    return SynthDataset(index=index_path, model=model_path, pca=os.path.join(pca_dir, "pca_scores.h5"), raw_data_path=raw_dir, uuids=uuids)
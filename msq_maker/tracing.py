@@ -0,0 +1,214 @@
+import functools
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, TypeVar, cast
+
+
+# Environment variable pointing worker processes and subprocesses to the directory collecting trace events.
+TRACE_DIR_ENV = "MSQ_MAKER_TRACE_DIR"
+
+
+def _now_us() -> float:
+    # wall clock time, so that events from different processes share the same time base
+    return time.time() * 1e6
+
+
+class _Tracer:
+    """Appends trace events of the current process, one JSON object per line, to a file in the trace directory."""
+
+    def __init__(self, trace_dir: str):
+        self.trace_dir = trace_dir
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._file = open(os.path.join(trace_dir, f"{self.pid}.jsonl"), "a", buffering=1)
+        self.emit({"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0, "args": {"name": self._process_name()}})
+
+    @staticmethod
+    def _process_name() -> str:
+        if os.environ.get(TRACE_DIR_ENV + "_MAIN") == str(os.getpid()):
+            return "msq-maker"
+        return f"worker ({os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else 'python'})"
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+_tracer: Optional[_Tracer] = None
+_tracer_checked = False
+
+
+def _get_tracer() -> Optional[_Tracer]:
+    """Get the tracer of this process, creating it on first use if tracing was enabled by a parent process."""
+    global _tracer, _tracer_checked
+    if not _tracer_checked or (_tracer is not None and _tracer.pid != os.getpid()):
+        # also re-check after a fork, the child must not share the parent's file
+        _tracer_checked = True
+        trace_dir = os.environ.get(TRACE_DIR_ENV)
+        _tracer = _Tracer(trace_dir) if trace_dir and os.path.isdir(trace_dir) else None
+    return _tracer
+
+
+class _NullSpan:
+    """Span used when tracing is disabled, doing nothing."""
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer: _Tracer, name: str, category: str, args: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self) -> "_Span":
+        self.start = _now_us()
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        args = dict(self.args)
+        if exc_type is not None:
+            args["error"] = exc_type.__name__
+        self.tracer.emit({
+            "name": self.name,
+            "cat": self.category,
+            "ph": "X",
+            "ts": self.start,
+            "dur": _now_us() - self.start,
+            "pid": self.tracer.pid,
+            "tid": threading.get_ident(),
+            "args": args,
+        })
+
+
+def span(name: str, category: str = "msq_maker", **args: Any):
+    """Context manager recording the block it wraps as a span of the trace.
+
+    When tracing is disabled, this returns a shared no-op context manager, so spans cost a function call.
+
+    Args:
+        name (str): name of the span.
+        category (str): category of the span, used for filtering in trace viewers.
+        **args: additional JSON serializable values to attach to the span.
+    """
+    tracer = _tracer if _tracer_checked else _get_tracer()
+    if tracer is None:
+        return _NULL_SPAN
+    if tracer.pid != os.getpid():
+        tracer = _get_tracer()
+        if tracer is None:
+            return _NULL_SPAN
+    return _Span(tracer, name, category, args)
+
+
+TFunc = TypeVar("TFunc", bound=Callable[..., Any])
+def traced(name: Optional[str] = None, category: str = "msq_maker") -> Callable[[TFunc], TFunc]:
+    """Decorator recording each call of the decorated function as a span of the trace.
+
+    Args:
+        name (str|None): name of the span, defaults to the qualified name of the function.
+        category (str): category of the span.
+    """
+    def decorator(func: TFunc) -> TFunc:
+        span_name = name if name is not None else func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, category):
+                return func(*args, **kwargs)
+        return cast(TFunc, wrapper)
+    return decorator
+
+
+def record_process(name: str, pid: int, start: float, end: float, **args: Any) -> None:
+    """Record the lifetime of an external process (ex. a subprocess producer) on its own track of the trace.
+
+    Args:
+        name (str): name of the process, ex. the command that was run.
+        pid (int): process ID of the external process.
+        start (float): start time, as given by `time.time()`.
+        end (float): end time, as given by `time.time()`.
+        **args: additional JSON serializable values to attach to the span.
+    """
+    tracer = _get_tracer()
+    if tracer is None:
+        return
+    tracer.emit({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": f"subprocess ({name})"}})
+    tracer.emit({"name": name, "cat": "subprocess", "ph": "X", "ts": start * 1e6, "dur": (end - start) * 1e6, "pid": pid, "tid": 0, "args": args})
+
+
+def is_tracing() -> bool:
+    """Check if tracing is enabled in this process."""
+    return _get_tracer() is not None
+
+
+_output_path: Optional[str] = None
+def start_tracing(output_path: str) -> None:
+    """Enable tracing for this process and the worker processes and subprocesses it starts from now on.
+
+    Args:
+        output_path (str): path where the Chrome trace-event file is written by `stop_tracing()`.
+    """
+    global _tracer, _tracer_checked, _output_path
+    trace_dir = tempfile.mkdtemp(prefix="msq-maker-trace-")
+    os.environ[TRACE_DIR_ENV] = trace_dir
+    os.environ[TRACE_DIR_ENV + "_MAIN"] = str(os.getpid())
+    _tracer = _Tracer(trace_dir)
+    _tracer_checked = True
+    _output_path = output_path
+
+
+def stop_tracing() -> Optional[str]:
+    """Disable tracing and merge the events of all processes into a Chrome trace-event / Perfetto compatible file.
+
+    Returns:
+        str|None: path of the written trace file, or None if tracing was not started in this process.
+    """
+    global _tracer, _output_path
+    if _tracer is None or _output_path is None:
+        return None
+
+    trace_dir = _tracer.trace_dir
+    _tracer.close()
+    _tracer = None
+    os.environ.pop(TRACE_DIR_ENV, None)
+    os.environ.pop(TRACE_DIR_ENV + "_MAIN", None)
+
+    events: List[Dict[str, Any]] = []
+    for part in sorted(glob.glob(os.path.join(trace_dir, "*.jsonl"))):
+        with open(part, "r") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # a worker may have been interrupted mid-write
+                    continue
+
+    output_path = _output_path
+    _output_path = None
+    with open(output_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    shutil.rmtree(trace_dir, ignore_errors=True)
+    logging.info(f"Wrote trace with {len(events)} events to {output_path}")
+    return output_path
@@ -0,0 +1,229 @@
+import copy
+import json
+import logging
+import os
+import shutil
+import zipfile
+from typing import Any, Dict, List, Optional, Set
+
+import numpy as np
+from typing_extensions import Literal
+
+from msq_maker.cache import file_identity, hash_file, hash_object
+from msq_maker.core import MSQ, BaseProducer, ModelConfig
+from msq_maker.journal import RunJournal, snapshot_spool
+from msq_maker.mapreduce import MapReduceProducer, hash_label_map, labels_digest
+from msq_maker.merge import concat_split_dataframes, is_sparse_payload, is_split_dataframe, merge_manifests, merge_sparse
+from msq_maker.util import get_index, get_syllable_id_mapping, load_model
+
+
+# Name of the file, relative to the spool, recording what a report was generated from.
+PROVENANCE_NAME = "provenance.json"
+
+# What to do with a producer when updating a report: run it from scratch, copy its outputs from the
+# existing report, or only process new and changed sessions and splice them into its existing outputs.
+UpdateAction = Literal["run", "copy", "splice"]
+
+
+def session_identities(mconfig: ModelConfig) -> Dict[str, str]:
+    """Identify the state of each session of the index: its extraction, its group and its labels.
+
+    Returns:
+        Dict[str, str]: hash of the state of each session, keyed by uuid.
+    """
+    index = get_index(mconfig.index)
+    model = load_model(mconfig.model, sort_labels_by_usage=False)
+    labels = dict(zip(model["keys"], model["labels"]))
+
+    identities = {}
+    for uuid, h5_path in index.uuid_to_h5.items():
+        identities[uuid] = hash_object({
+            "h5": file_identity(h5_path) if os.path.exists(h5_path) else None,
+            "group": index.uuid_to_group[uuid],
+            "labels": labels_digest(np.asarray(labels[uuid])) if uuid in labels else None,
+        })
+    return identities
+
+
+def current_provenance(mconfig: ModelConfig) -> Dict[str, Any]:
+    """Describe the model, label map and sessions a report is generated from."""
+    return {
+        "model": hash_file(mconfig.model),
+        "label_map": hash_label_map(get_syllable_id_mapping(mconfig.model)),
+        "sessions": session_identities(mconfig),
+    }
+
+
+def producer_records(journals: List[RunJournal]) -> Dict[str, Dict[str, Any]]:
+    """Combine the producers which completed according to the run journals of a report, or of the shards of a report.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: configuration hash, outputs and manifest fragment, keyed by producer name.
+    """
+    records: Dict[str, Dict[str, Any]] = {}
+    for journal in journals:
+        for name, entry in journal.completed().items():
+            record = records.setdefault(name, {"config_hash": entry["config_hash"], "outputs": [], "manifest": {}})
+            record["outputs"] = sorted(set(record["outputs"]) | set(entry["outputs"]))
+            record["manifest"] = merge_manifests([record["manifest"], entry["manifest"]])
+    return records
+
+
+def write_provenance(msq: MSQ, mconfig: ModelConfig, journals: List[RunJournal]) -> None:
+    """Record what the report was generated from, and the outputs of each producer, so it can later be updated."""
+    provenance = current_provenance(mconfig)
+    provenance["producers"] = producer_records(journals)
+    msq.write_unstructured(PROVENANCE_NAME, provenance)
+    msq.manifest["provenance"] = PROVENANCE_NAME
+
+
+def filter_sessions(payload: Any, sessions: Set[str]) -> Any:
+    """Remove the data of some sessions from a dataframe (rows with a `uuid` column) or sparse matrix collection (keyed by uuid).
+
+    Raises:
+        ValueError: if the payload does not hold data keyed by session.
+    """
+    if is_split_dataframe(payload) and "uuid" in payload["columns"]:
+        col = payload["columns"].index("uuid")
+        filtered = dict(payload, data=[row for row in payload["data"] if row[col] not in sessions])
+        filtered["index"] = list(range(len(filtered["data"])))
+        return filtered
+    if is_sparse_payload(payload) and isinstance(payload.get("groups"), dict):
+        filtered = dict(payload)
+        filtered["matrices"] = {k: v for k, v in payload["matrices"].items() if k not in sessions}
+        filtered["groups"] = {k: v for k, v in payload["groups"].items() if k not in sessions}
+        return filtered
+    raise ValueError("Data is not keyed by session.")
+
+
+class PreviousReport:
+    """Read access to the contents of an existing report."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._zip = zipfile.ZipFile(path, "r")
+        # members are stored relative to the spool, ex. "./manifest.json"
+        self._members = {os.path.normpath(n): n for n in self._zip.namelist()}
+        self.provenance: Optional[Dict[str, Any]] = self.read_json(PROVENANCE_NAME) if self.has(PROVENANCE_NAME) else None
+
+    def close(self) -> None:
+        self._zip.close()
+
+    def has(self, name: str) -> bool:
+        return os.path.normpath(name) in self._members
+
+    def read_json(self, name: str) -> Any:
+        with self._zip.open(self._members[os.path.normpath(name)]) as f:
+            return json.load(f)
+
+    def extract(self, name: str, msq: MSQ) -> None:
+        """Copy a member of the report to the same place in the spool of a report."""
+        with self._zip.open(self._members[os.path.normpath(name)]) as src, msq.open(name, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+
+
+class ReportUpdate:
+    """Plan and carry out the update of an existing report, when sessions were added, changed or removed.
+
+    Per-session producers only process new and changed sessions, and their results are spliced into the
+    outputs of the existing report, from which removed and changed sessions are dropped. The outputs of
+    other producers are copied as long as the model and the sessions did not change. Producers whose
+    configuration changed run from scratch.
+    """
+
+    def __init__(self, previous: PreviousReport, mconfig: ModelConfig):
+        self.previous = previous
+        self.current = current_provenance(mconfig)
+
+        if previous.provenance is None:
+            logging.warning(f"\"{previous.path}\" has no {PROVENANCE_NAME} (it predates report updates), all producers will run from scratch.")
+            previous_sessions: Dict[str, str] = {}
+        else:
+            previous_sessions = previous.provenance["sessions"]
+        sessions = self.current["sessions"]
+        self.new: List[str] = sorted(set(sessions) - set(previous_sessions))
+        self.changed: List[str] = sorted(u for u in sessions if u in previous_sessions and previous_sessions[u] != sessions[u])
+        self.removed: List[str] = sorted(set(previous_sessions) - set(sessions))
+        self.model_changed = previous.provenance is None or previous.provenance["model"] != self.current["model"]
+        self.label_map_changed = previous.provenance is None or previous.provenance["label_map"] != self.current["label_map"]
+
+        logging.info(f"Updating \"{previous.path}\": {len(self.new)} new, {len(self.changed)} changed and {len(self.removed)} removed session(s), "
+                     f"model {'changed' if self.model_changed else 'unchanged'}.")
+
+    @property
+    def fresh(self) -> Set[str]:
+        """Sessions which need processing: new and changed sessions."""
+        return set(self.new) | set(self.changed)
+
+    @property
+    def stale(self) -> Set[str]:
+        """Sessions whose data must be dropped from the existing report: changed and removed sessions."""
+        return set(self.changed) | set(self.removed)
+
+    def action(self, name: str, producer_class: type, config_hash: str) -> UpdateAction:
+        """Decide how to update the outputs of a producer, see `UpdateAction`."""
+        entry = self._previous_entry(name)
+        if entry is None or entry["config_hash"] != config_hash:
+            return "run"
+
+        if not issubclass(producer_class, MapReduceProducer):
+            # global outputs, which depend on the model and the labels of all sessions (ex. the groups they hold)
+            return "run" if self.model_changed or len(self.fresh | self.stale) > 0 else "copy"
+
+        # outputs of per-session producers refer to syllables by their usage and frames IDs
+        if self.label_map_changed:
+            return "run"
+        for output in entry["outputs"]:
+            try:
+                filter_sessions(self.previous.read_json(output), set())
+            except ValueError:
+                logging.info(f"Output \"{output}\" of producer \"{name}\" cannot be updated per session, the producer will run from scratch.")
+                return "run"
+        return "splice"
+
+    def copy(self, name: str, msq: MSQ) -> None:
+        """Copy the outputs of a producer from the existing report."""
+        entry = self._previous_entry(name)
+        for output in entry["outputs"]:
+            self.previous.extract(output, msq)
+        msq.manifest.update(entry["manifest"])
+
+    def splice(self, name: str, producer: BaseProducer, msq: MSQ) -> None:
+        """Process new and changed sessions with a per-session producer, and splice the results into its existing outputs."""
+        entry = self._previous_entry(name)
+        stale = self.stale
+
+        new_outputs: Set[str] = set()
+        fragment: Dict[str, Any] = {}
+        producer.only_sessions = self.fresh
+        if isinstance(producer, MapReduceProducer) and len(producer.sessions()) > 0:
+            before_files = snapshot_spool(msq.spool)
+            before_manifest = copy.deepcopy(msq.manifest)
+            producer.run(msq)
+            new_outputs = {f for f, ident in snapshot_spool(msq.spool).items() if before_files.get(f) != ident}
+            fragment = {k: v for k, v in msq.manifest.items() if k not in before_manifest or before_manifest[k] != v}
+        logging.info(f"Splicing {len(new_outputs)} updated output(s) of producer \"{name}\" into {len(entry['outputs'])} existing output(s).")
+
+        for output in sorted(set(entry["outputs"]) | new_outputs):
+            payloads = []
+            if output in entry["outputs"]:
+                payloads.append(filter_sessions(self.previous.read_json(output), stale))
+            if output in new_outputs:
+                with msq.open(output, "r") as f:
+                    payloads.append(json.load(f))
+
+            if len(payloads) == 1:
+                merged = payloads[0]
+            elif all(is_split_dataframe(p) for p in payloads):
+                merged = concat_split_dataframes(payloads)
+            else:
+                merged = merge_sparse(payloads)
+            with msq.open(output, "w") as f:
+                json.dump(merged, f)
+
+        msq.manifest.update(merge_manifests([fragment, entry["manifest"]]))
+
+    def _previous_entry(self, name: str) -> Optional[Dict[str, Any]]:
+        if self.previous.provenance is None:
+            return None
+        return self.previous.provenance["producers"].get(name)
@@ -1,12 +1,142 @@
+import contextlib
+import copy
+import importlib
+import io
 import logging
+import os
 import subprocess
 import sys
 import threading
-from typing import IO, Dict, List, Union
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Callable, ContextManager, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+import numpy as np
 import psutil
+from scipy import sparse
 from typing_extensions import TypedDict, Literal
-from moseq2_viz.model.util import parse_model_results, relabel_by_usage, get_syllable_statistics
-from moseq2_viz.util import parse_index
+
+from msq_maker.cache import file_identity, hash_object, memoized_file
+from msq_maker.tracing import span
+
+
+# functions of `moseq2_viz` as imported before any patching, see `moseq2_viz_function()`
+_unpatched: Dict[Tuple[str, str], Callable] = {}
+_unpatched_lock = threading.Lock()
+
+
+def moseq2_viz_function(module_name: str, name: str) -> Callable:
+    """Import a function of `moseq2_viz`, as it was before `run_in_process()` replaced it with one of ours.
+
+    Used by the replacements themselves (ex. `load_model()`), so that they do not end up calling themselves.
+    """
+    key = (module_name, name)
+    with _unpatched_lock:
+        if key not in _unpatched:
+            function = getattr(importlib.import_module(module_name), name)
+            _unpatched[key] = function.original if isinstance(function, _ThreadPatch) else function
+        return _unpatched[key]
+
+
+def read_only_copy(obj: Any) -> Any:
+    """Copy the dicts, lists and tuples of a nested structure, sharing its numpy arrays once made read-only.
+
+    Much cheaper than a deep copy for structures holding large arrays, ex. a parsed model. Callers may add, remove
+    or replace entries of the copy, while modifying a shared array in place raises a `ValueError`.
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.flags.writeable:
+            obj.setflags(write=False)
+        return obj
+    if isinstance(obj, dict):
+        return type(obj)((k, read_only_copy(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(read_only_copy(v) for v in obj)
+    return obj
+
+
+def load_model(model_file: str, **kwargs: Any) -> dict:
+    """Parse a model with `moseq2_viz.model.util.parse_model_results()`.
+
+    The latest model is parsed once per process for each set of arguments, and again only when the file
+    changes (see `msq_maker.cache.memoized_file()`). The arrays of the parsed model (ex. labels, parameters)
+    are shared by all callers, and read-only.
+
+    Args:
+        model_file (str): path to the model.
+        **kwargs: arguments passed to `parse_model_results()`.
+
+    Returns:
+        dict: a copy of the parsed model, see `read_only_copy()`.
+    """
+    def parse() -> dict:
+        parse_model_results = moseq2_viz_function("moseq2_viz.model.util", "parse_model_results")
+        with span("parse_model", "io", path=model_file):
+            return parse_model_results(model_file, **kwargs)
+    # a deep copy would cost more than parsing, ex. when `parse_model_once()` stands in for every session of scalars
+    return read_only_copy(memoized_file(f"parse_model:{hash_object(kwargs)}", model_file, parse, latest_only=True))
+
+
+def _parse_index(index_file: str) -> Tuple[dict, dict]:
+    def parse() -> Tuple[dict, dict]:
+        parse_index = moseq2_viz_function("moseq2_viz.util", "parse_index")
+        with span("parse_index", "io", path=index_file):
+            return parse_index(index_file)
+    return memoized_file("parse_index", index_file, parse)
+
+
+def load_index(index_file: str) -> Tuple[dict, dict]:
+    """Parse an index with `moseq2_viz.util.parse_index()`.
+
+    An index is parsed once per process, and again only when the file changes (see `msq_maker.cache.memoized_file()`).
+    For groups, session groups or extraction paths, prefer the cheaper `get_index()`.
+
+    Args:
+        index_file (str): path to the index.
+
+    Returns:
+        Tuple[dict, dict]: copies of the index, and of the index with files keyed by uuid.
+    """
+    return copy.deepcopy(_parse_index(index_file))
+
+
+@dataclass(frozen=True)
+class IndexInfo:
+    """Lookups derived from an index, see `get_index()`.
+
+    Attributes:
+        path (str): absolute path to the index.
+        groups (Tuple[str, ...]): sorted groups of the index.
+        uuid_to_group (Mapping[str, str]): group of each session.
+        uuid_to_h5 (Mapping[str, str]): path to the extraction of each session.
+    """
+    path: str
+    groups: Tuple[str, ...]
+    uuid_to_group: Mapping[str, str]
+    uuid_to_h5: Mapping[str, str]
+
+
+def get_index(index_file: str) -> IndexInfo:
+    """Get the groups, session groups and extraction paths of an index.
+
+    Computed once per process, and again only when the file changes (see `msq_maker.cache.memoized_file()`).
+
+    Args:
+        index_file (str): path to the index.
+
+    Returns:
+        IndexInfo: read-only lookups of the index.
+    """
+    def build() -> IndexInfo:
+        index, sorted_index = _parse_index(index_file)
+        files = sorted_index["files"]
+        return IndexInfo(
+            path=os.path.abspath(index_file),
+            groups=tuple(sorted(set(f["group"] for f in index["files"]))),
+            uuid_to_group=MappingProxyType({uuid: f["group"] for uuid, f in files.items()}),
+            uuid_to_h5=MappingProxyType({uuid: f["path"][0] for uuid, f in files.items()}),
+        )
+    return memoized_file("index_info", index_file, build)
 
 
 LabelMapping = TypedDict('LabelMapping', {
@@ -24,7 +154,13 @@ def get_syllable_id_mapping(model_file: str) -> LabelMap:
     Returns:
         dict of dicts, indexed by raw id, with each sub-dict contains raw, usage, and frame ID assignments
     '''
-    mdl = parse_model_results(model_file, sort_labels_by_usage=False)
+    return copy.deepcopy(memoized_file("label_map", model_file, lambda: _build_syllable_id_mapping(model_file), latest_only=True))
+
+
+def _build_syllable_id_mapping(model_file: str) -> LabelMap:
+    from moseq2_viz.model.util import relabel_by_usage
+
+    mdl = load_model(model_file, sort_labels_by_usage=False)
     labels_usage = relabel_by_usage(mdl['labels'], count='usage')[1]
     labels_frames = relabel_by_usage(mdl['labels'], count='frames')[1]
 
@@ -41,6 +177,27 @@ def get_syllable_id_mapping(model_file: str) -> LabelMap:
     return label_map
 
 
+def relabel(labels: np.ndarray, label_map: LabelMap, by: Literal['usage', 'frames']) -> np.ndarray:
+    """Convert a sequence of raw syllable IDs to usage or frames IDs.
+
+    This gives the same labels as parsing the model with `sort_labels_by_usage=True` (and the corresponding `count`).
+
+    Args:
+        labels (np.ndarray): raw syllable IDs. Negative labels (ex. -5, "unknown") are kept as is.
+        label_map (LabelMap): label map of the model, see `get_syllable_id_mapping()`.
+        by (str): ID to convert to, one of {'usage', 'frames'}.
+
+    Returns:
+        np.ndarray: relabeled sequence.
+    """
+    labels = np.asarray(labels)
+    raw_ids = [raw for raw in label_map.keys() if raw >= 0]
+    lookup = np.arange(max(raw_ids + [int(labels.max(initial=0))]) + 1)
+    for raw in raw_ids:
+        lookup[raw] = label_map[raw][by]
+    return np.where(labels >= 0, lookup[np.clip(labels, 0, None).astype(int)], labels)
+
+
 def reindex_label_map(label_map: LabelMap, by: Literal['usage', 'frames', 'raw']) -> LabelMap:
     ''' Reindex a label map by usage, frames, or raw ID
 
@@ -57,6 +214,85 @@ def reindex_label_map(label_map: LabelMap, by: Literal['usage', 'frames', 'raw']
     return {itm[by]: itm for itm in label_map.values()}
 
 
+_parsed_model: Dict[Any, dict] = {}
+def parse_model_once(model_file: str, *args: Any, **kwargs: Any) -> dict:
+    """Drop-in replacement of `parse_model_results()`, remembering the last model parsed by this process.
+
+    Used to avoid re-parsing the model when calling `moseq2_viz` functions once per session, see `patch_parse_model()`.
+    Called with keyword arguments only, the model is shared with `load_model()`. Like there, the arrays of the
+    returned model are shared and read-only, see `read_only_copy()`.
+    """
+    if len(args) == 0:
+        return load_model(model_file, **kwargs)
+    parse_model_results = moseq2_viz_function("moseq2_viz.model.util", "parse_model_results")
+    key = (file_identity(model_file), args, tuple(sorted(kwargs.items())))
+    if key not in _parsed_model:
+        _parsed_model.clear()
+        _parsed_model[key] = parse_model_results(model_file, *args, **kwargs)
+    return read_only_copy(_parsed_model[key])
+
+
+class _ThreadPatch:
+    """Stand-in for a patched function, calling the replacement of the calling thread, if it patched the function, and
+    the original function otherwise, so that threads running other producers are not affected by a patch.
+    """
+
+    def __init__(self, original: Callable):
+        self.original = original
+        # stack of replacements of each patching thread, keyed by thread identifier
+        self.replacements: Dict[int, List[Callable]] = {}
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        stack = self.replacements.get(threading.get_ident())
+        return (stack[-1] if stack else self.original)(*args, **kwargs)
+
+
+_patches_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _patch_function(modules: Iterable[Any], name: str, replacement: Callable) -> Iterator[None]:
+    thread = threading.get_ident()
+    patches = []
+    with _patches_lock:
+        for m in modules:
+            if not hasattr(m, name):
+                continue
+            patch = getattr(m, name)
+            if not isinstance(patch, _ThreadPatch):
+                patch = _ThreadPatch(patch)
+                setattr(m, name, patch)
+            patch.replacements.setdefault(thread, []).append(replacement)
+            patches.append((m, patch))
+    try:
+        yield
+    finally:
+        with _patches_lock:
+            for m, patch in patches:
+                stack = patch.replacements[thread]
+                stack.pop()
+                if len(stack) == 0:
+                    del patch.replacements[thread]
+                if len(patch.replacements) == 0 and getattr(m, name, None) is patch:
+                    setattr(m, name, patch.original)
+
+
+def patch_parse_model(*modules: Any) -> ContextManager[None]:
+    """Context manager replacing `parse_model_results` in the given `moseq2_viz` modules with `parse_model_once()`.
+
+    Only calls made by the thread entering the context are replaced, other threads keep calling `parse_model_results`.
+    """
+    return _patch_function(modules, "parse_model_results", parse_model_once)
+
+
+def patch_parse_index(*modules: Any) -> ContextManager[None]:
+    """Context manager replacing `parse_index` in the given modules with `load_index()`, which parses each index once per process.
+
+    Only calls made by the thread entering the context are replaced, see `patch_parse_model()`.
+    """
+    return _patch_function(modules, "parse_index", load_index)
+
+
 def get_max_syllable(model: dict) -> int:
     """Retrieves the maximum syllable from the model.
     
@@ -66,6 +302,8 @@ def get_max_syllable(model: dict) -> int:
     Returns:
         int: The maximum syllable value.
     """
+    from moseq2_viz.model.util import get_syllable_statistics
+
     syllable_stats = get_syllable_statistics(model["labels"])[0]
     for sid, use_count in syllable_stats.items():
         if use_count == 0:
@@ -82,8 +320,7 @@ def get_groups_index(index_file: str) -> list:
     Returns:
         list: The groups in the index.
     """
-    index, _ = parse_index(index_file)
-    return list(sorted(set([f["group"] for f in index["files"]])))
+    return list(get_index(index_file).groups)
 
 
 def get_max_states(model: Union[str, dict]) -> int:
@@ -97,7 +334,7 @@ def get_max_states(model: Union[str, dict]) -> int:
             int: max number of states parameter from model training
     '''
     if isinstance(model, str):
-        model_dict = parse_model_results(model)
+        model_dict = load_model(model)
     elif isinstance(model, dict):
         model_dict = model
     else:
@@ -110,7 +347,7 @@ def get_max_states(model: Union[str, dict]) -> int:
 
 
 def syllableMatricesToLongForm(mats_dict, mapping: LabelMap, decorate=None):
-    # assumes mats are indexed by RAW ID!!!
+    # assumes mats are indexed by the same ID as `mapping` (usually RAW ID, see `reindex_label_map()`)!!!
 
     shape = mats_dict[list(mats_dict.keys())[0]].shape
     data = []
@@ -133,6 +370,97 @@ def syllableMatricesToLongForm(mats_dict, mapping: LabelMap, decorate=None):
 
     return data
 
+def get_sparse_transition_counts(labels: np.ndarray, max_syllable: int = 100) -> sparse.coo_matrix:
+    """Count the syllable transitions of a single label sequence directly into a sparse matrix.
+
+    Counting follows `moseq2_viz.model.trans_graph.get_transition_matrix()` (repeated labels are collapsed
+    before counting bigrams, and syllables from `max_syllable` on are ignored), but only observed transitions
+    are stored, so a dense max_syllable x max_syllable matrix is never allocated. Transitions from or to the
+    "unknown" label (-5) are not counted.
+
+    Args:
+        labels (np.ndarray): label sequence of a single session, indexed by RAW ID.
+        max_syllable (int): exclusive upper bound on the syllable IDs to count transitions for.
+
+    Returns:
+        sparse.coo_matrix: transition counts of shape (max_syllable, max_syllable), rows are the outgoing and
+            columns the incoming syllable.
+    """
+    arr = np.asarray(labels)
+    size = max_syllable
+
+    # collapse runs of the same label, keeping only the label at each change point
+    seq = arr[np.where(arr[1:] != arr[:-1])[0] + 1].astype("int64")
+    src, dst = seq[:-1], seq[1:]
+
+    # drop the "unknown" label (-5) and anything from max_syllable on
+    keep = (src >= 0) & (dst >= 0) & (src < max_syllable) & (dst < max_syllable)
+    codes, counts = np.unique(src[keep] * size + dst[keep], return_counts=True)
+
+    return sparse.coo_matrix((counts.astype("float64"), (codes // size, codes % size)), shape=(size, size))
+
+
+def sum_sparse_matrices(mats: Iterable[sparse.spmatrix]) -> sparse.coo_matrix:
+    """Sum several sparse matrices of the same shape, for example to aggregate transitions per group.
+
+    Args:
+        mats (Iterable[sparse.spmatrix]): matrices to sum, must contain at least one matrix.
+
+    Returns:
+        sparse.coo_matrix: the elementwise sum, with duplicate entries merged.
+    """
+    total = None
+    for mat in mats:
+        total = mat.tocsr() if total is None else total + mat.tocsr()
+    if total is None:
+        raise ValueError("At least one matrix is required")
+    total = total.tocoo()
+    total.eliminate_zeros()
+    return total
+
+
+def restrict_sparse_matrix(mat: sparse.spmatrix, mapping: LabelMap, max_syl: int) -> sparse.coo_matrix:
+    """Keep only entries whose row and column syllables have a usage ID below `max_syl`.
+
+    Args:
+        mat (sparse.spmatrix): matrix indexed by RAW ID.
+        mapping (LabelMap): label map, indexed by raw ID.
+        max_syl (int): exclusive upper bound on the usage ID of syllables to keep.
+
+    Returns:
+        sparse.coo_matrix: the restricted matrix, with the same shape as `mat`.
+    """
+    mat = mat.tocoo()
+    keep = np.zeros(mat.shape[0], dtype=bool)
+    for raw_id, lm in mapping.items():
+        if 0 <= raw_id < mat.shape[0]:
+            keep[raw_id] = 0 <= lm["usage"] < max_syl
+
+    mask = keep[mat.row] & keep[mat.col]
+    return sparse.coo_matrix((mat.data[mask], (mat.row[mask], mat.col[mask])), shape=mat.shape)
+
+
+def get_roi_size(h5_path: str) -> Tuple[int, int]:
+    """Get the size of the region of interest (arena) of an extraction, from its metadata.
+
+    Read once per process, and again only when the file changes (see `msq_maker.cache.memoized_file()`).
+
+    Args:
+        h5_path (str): path to the extraction.
+
+    Returns:
+        Tuple[int, int]: width and height of the region of interest, in pixels.
+    """
+    def read() -> Tuple[int, int]:
+        import h5py
+
+        with span("read_roi", "io", path=h5_path), h5py.File(h5_path, "r") as h5:
+            mask = h5["/metadata/extraction/roi"][()]
+        mask_idx = np.nonzero(mask)
+        return (int(np.max(mask_idx[1]) - np.min(mask_idx[1])), int(np.max(mask_idx[0]) - np.min(mask_idx[0])))
+    return memoized_file("roi_size", h5_path, read)
+
+
 def ensure_even(num: int):
     """Ensure that number is even. If odd, add 1.
     
@@ -148,6 +476,14 @@ def ensure_even(num: int):
         return num
 
 
+def format_list(items: Iterable[Any], limit: int = 5) -> str:
+    """Format items as a comma separated list, eliding all but the first `limit` items."""
+    items = [str(i) for i in items]
+    if len(items) <= limit:
+        return ", ".join(items)
+    return ", ".join(items[:limit]) + f" and {len(items) - limit} more"
+
+
 def get_cpu_count() -> int:
     """Get the number of available CPUs cores.
 
@@ -177,51 +513,239 @@ def setup_logging() -> None:
     console.setFormatter(console_formatter)
     logger.addHandler(console)
 
-def add_file_logging(log_file: str) -> None:
+def add_file_logging(log_file: str) -> logging.Handler:
     # file handler
     handler = logging.FileHandler(log_file, mode="w")
     handler.setLevel(logging.INFO)
     file_formatter = logging.Formatter("{asctime} {levelname:8s} {message}", style="{")
     handler.setFormatter(file_formatter)
     logger.addHandler(handler)
+    return handler
 
 
-def log_subprocess_output(pipe: IO[str], log_level=logging.INFO):
-    """Reads lines from a pipe and logs them."""
-    for line in iter(pipe.readline, ''):
-        logger.log(log_level, line.strip())
-    pipe.close()
-
-def run_and_log_subprocess(command: List[str]):
-    """Runs a subprocess and logs its stdout and stderr."""
-    try:
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,  # Decodes stdout/stderr as text
-            bufsize=1  # Line-buffered output
-        )
-
-        # Start threads to read and log stdout and stderr concurrently
-        stdout_thread = threading.Thread(target=log_subprocess_output, args=(process.stdout, logging.INFO))
-        stderr_thread = threading.Thread(target=log_subprocess_output, args=(process.stderr, logging.INFO))
+def remove_file_logging(handler: logging.Handler) -> None:
+    """Stop logging to a file added with `add_file_logging()`."""
+    logger.removeHandler(handler)
+    handler.close()
 
-        stdout_thread.start()
-        stderr_thread.start()
 
-        # Wait for the process to complete and threads to finish
-        process.wait()
-        stdout_thread.join()
-        stderr_thread.join()
+def run_and_log_subprocess(command: List[str], timeout: Optional[float] = None, prefix: str = "") -> None:
+    """Runs a subprocess, logging its output and resource usage, see `msq_maker.supervisor.run_supervised()`.
 
-        if process.returncode != 0:
-            logger.error(f"Subprocess exited with code {process.returncode}")
-            raise subprocess.CalledProcessError(process.returncode, command)
+    Args:
+        command (List[str]): command to run.
+        timeout (float|None): wall-clock time limit, in seconds, after which the subprocess is terminated.
+        prefix (str): prefix of the logged output lines.
+    """
+    from msq_maker.supervisor import run_supervised
 
+    try:
+        run_supervised(command, timeout=timeout, prefix=prefix)
     except FileNotFoundError:
         logger.error(f"Command not found: {command[0]}")
         raise
-    except Exception as e:
-        logger.exception(f"An error occurred while running the subprocess: {e}")
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Subprocess exited with code {e.returncode}")
+        raise
+    except subprocess.TimeoutExpired as e:
+        logger.error(f"Subprocess timed out after {e.timeout}s")
         raise
+
+
+class _LogWriter(io.TextIOBase):
+    """Text stream logging each line written to it, used to capture the output of commands run in-process."""
+
+    def __init__(self, log_level: int = logging.INFO):
+        self.log_level = log_level
+        self._buffer = ""
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        # progress bars redraw their line with carriage returns
+        lines = (self._buffer + text).replace("\r", "\n").split("\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            if line.strip():
+                logger.log(self.log_level, line.strip())
+        return len(text)
+
+    def flush(self) -> None:
+        if self._buffer.strip():
+            logger.log(self.log_level, self._buffer.strip())
+        self._buffer = ""
+
+
+# streams capturing the output of threads running commands in-process, keyed by thread, see `_capture_output()`
+_captures: Dict[int, Any] = {}
+_captures_lock = threading.Lock()
+
+
+class _ThreadOutput:
+    """Stands in for `sys.stdout` or `sys.stderr`, sending what each thread writes to the stream capturing its output, if any.
+
+    Unlike `contextlib.redirect_stdout()`, which swaps the stream of the whole process, other threads (ex. prefetching,
+    background producers) keep writing to the original stream.
+    """
+
+    def __init__(self, default: Any):
+        self.default = default
+
+    def _target(self) -> Any:
+        return _captures.get(threading.get_ident(), self.default)
+
+    def write(self, text: str) -> int:
+        return self._target().write(text)
+
+    def flush(self) -> None:
+        self._target().flush()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.default, name)
+
+
+@contextlib.contextmanager
+def _capture_output(stream: Any) -> Iterator[None]:
+    """Context manager sending what the current thread writes to stdout and stderr to `stream`."""
+    ident = threading.get_ident()
+    with _captures_lock:
+        if not isinstance(sys.stdout, _ThreadOutput):
+            sys.stdout = _ThreadOutput(sys.stdout)  # type: ignore
+        if not isinstance(sys.stderr, _ThreadOutput):
+            sys.stderr = _ThreadOutput(sys.stderr)  # type: ignore
+        _captures[ident] = stream
+    try:
+        yield
+    finally:
+        with _captures_lock:
+            _captures.pop(ident, None)
+            if len(_captures) == 0:
+                for attr in ("stdout", "stderr"):
+                    current = getattr(sys, attr)
+                    if isinstance(current, _ThreadOutput):
+                        setattr(sys, attr, current.default)
+
+
+def _find_console_script(name: str) -> Optional[Any]:
+    """Find the entry point of a console script installed by a package, ex. "spinogram"."""
+    if sys.version_info >= (3, 8):
+        from importlib.metadata import entry_points
+    else:
+        from importlib_metadata import entry_points
+
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        matches = list(eps.select(group="console_scripts", name=name))
+    else:
+        # before python 3.10, entry points are grouped in a dict
+        matches = [ep for ep in eps.get("console_scripts", []) if ep.name == name]
+    return matches[0] if len(matches) > 0 else None
+
+
+def _load_click_command(name: str) -> Optional[Tuple[Any, str]]:
+    """Load the click command behind a console script, returning it with the name of its top-level package."""
+    import click
+
+    entry_point = _find_console_script(name)
+    if entry_point is None:
+        return None
+    try:
+        main = entry_point.load()
+    except Exception as e:
+        logger.debug(f"Failed to load the entry point of \"{name}\": {e!r}")
+        return None
+    if not isinstance(main, click.BaseCommand):
+        return None
+    # the value of an entry point is "package.module:attribute"
+    return main, entry_point.value.split(":")[0].split(".")[0]
+
+
+def can_run_in_process(name: str) -> bool:
+    """Check if a command line tool can run in this process, see `run_in_process()`."""
+    return _load_click_command(name) is not None
+
+
+# commands run in-process may rely on the global state of their package, so they run one at a time
+_in_process_lock = threading.Lock()
+
+
+def _patched_modules(package: str, name: str, original: Callable) -> List[Any]:
+    """List the loaded modules in which `run_in_process()` replaces a `moseq2_viz` function: the modules of the
+    package of the command, and the modules holding the function (ex. where it is defined, or imported with `from ... import`).
+
+    Patching the module defining the function also covers modules the command only imports once it runs.
+    """
+    modules = []
+    for module_name, module in list(sys.modules.items()):
+        if module is None:
+            continue
+        in_package = module_name == package or module_name.startswith(f"{package}.")
+        held = getattr(module, "__dict__", {}).get(name)
+        if isinstance(held, _ThreadPatch):
+            held = held.original
+        if (in_package and hasattr(module, name)) or held is original:
+            modules.append(module)
+    return modules
+
+
+def run_in_process(command: List[str]) -> bool:
+    """Run a command line tool implemented with click in this process, instead of in a subprocess.
+
+    Saves the subprocess from importing its dependencies again, and from parsing the model and index again:
+    `parse_model_results` and `parse_index` are replaced with `parse_model_once()` and `load_index()`, which reuse
+    what this process already parsed, see `_patched_modules()`. Output of the thread running the command is logged,
+    as with `run_and_log_subprocess()`. Both only apply to the thread running the command: other threads (ex. other
+    producers running meanwhile) keep calling the original functions and writing to the console. Commands run
+    in-process one at a time.
+
+    Args:
+        command (List[str]): name of the console script followed by its arguments.
+
+    Returns:
+        bool: True if the command ran, False if it is not available in-process, in which case nothing was run.
+
+    Raises:
+        subprocess.CalledProcessError: if the command failed.
+    """
+    import click
+
+    loaded = _load_click_command(command[0])
+    if loaded is None:
+        return False
+    main, package = loaded
+
+    out = _LogWriter()
+    start = time.time()
+    try:
+        with _in_process_lock:
+            model_modules = _patched_modules(package, "parse_model_results", moseq2_viz_function("moseq2_viz.model.util", "parse_model_results"))
+            index_modules = _patched_modules(package, "parse_index", moseq2_viz_function("moseq2_viz.util", "parse_index"))
+            with span(f"in_process:{command[0]}", "process", command=command), patch_parse_model(*model_modules), patch_parse_index(*index_modules), \
+                    _capture_output(out):
+                returncode = main.main(args=command[1:], prog_name=command[0], standalone_mode=False)
+    except SystemExit as e:
+        returncode = e.code if e.code is None or isinstance(e.code, int) else 1
+    except click.ClickException as e:
+        logger.error(f"{command[0]}: {e.format_message()}")
+        returncode = e.exit_code
+    finally:
+        out.flush()
+
+    if isinstance(returncode, int) and returncode != 0:
+        logger.error(f"Command exited with code {returncode}")
+        raise subprocess.CalledProcessError(returncode, command)
+    logger.info(f"Ran \"{command[0]}\" in-process in {time.time() - start:.1f}s.")
+    return True
+
+
+def run_command(command: List[str], in_process: bool = True, timeout: Optional[float] = None) -> None:
+    """Run a command line tool, in-process when possible (see `run_in_process()`), otherwise in a subprocess (see `run_and_log_subprocess()`).
+
+    The `timeout` only applies to subprocesses.
+    """
+    if in_process and run_in_process(command):
+        return
+    if in_process:
+        logger.info(f"\"{command[0]}\" cannot run in-process, running it in a subprocess.")
+    run_and_log_subprocess(command, timeout=timeout, prefix=f"[{os.path.basename(command[0])}] ")
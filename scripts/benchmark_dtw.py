@@ -0,0 +1,59 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+from dtaidistance import dtw_ndim
+
+from msq_maker.dtw import distance_matrix
+
+
+def make_trajectories(num_series: int, length: int, ndim: int, seed: int) -> np.ndarray:
+    """Random-walk trajectories, shaped like the PC trajectories compared by `pca[dtw]`."""
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=(num_series, length, ndim)).cumsum(axis=1)
+
+
+def timeit(fn, repeats: int):
+    best = np.inf
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num-series', type=int, default=40, help='Number of trajectories (ex. syllables x samples).')
+    parser.add_argument('--length', type=int, default=30, help='Length of each trajectory (ex. `max_dur`).')
+    parser.add_argument('--ndim', type=int, default=10, help='Dimensions of each trajectory (ex. `npcs`).')
+    parser.add_argument('--window', type=int, default=None, help='Sakoe-Chiba band passed to both engines.')
+    parser.add_argument('--processes', type=int, default=1, help='Processes used by the msq_maker engine.')
+    parser.add_argument('--parallel', action='store_true', help='Request a parallel computation from dtaidistance.')
+    parser.add_argument('--repeats', type=int, default=1, help='Number of timed repeats, the best time is reported.')
+    parser.add_argument('--rtol', type=float, default=1e-6, help='Relative tolerance when comparing the engines.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the trajectories.')
+
+    args = parser.parse_args()
+
+    series = make_trajectories(args.num_series, args.length, args.ndim, args.seed)
+
+    # moseq2_viz computes DTW distance matrices with dtaidistance.dtw_ndim
+    ref_time, ref = timeit(lambda: dtw_ndim.distance_matrix(series, window=args.window, parallel=args.parallel), args.repeats)
+    new_time, new = timeit(lambda: distance_matrix(series, window=args.window, processes=args.processes), args.repeats)
+
+    rel_err = np.max(np.abs(ref - new) / np.maximum(np.abs(ref), np.finfo(float).tiny))
+    print(f"series: {args.num_series} x {args.length} x {args.ndim}, window: {args.window}")
+    print(f"moseq2_viz (dtaidistance): {ref_time:.3f}s")
+    print(f"msq_maker:                 {new_time:.3f}s ({ref_time / new_time:.1f}x)")
+    print(f"max relative difference:   {rel_err:.3g} (rtol {args.rtol:g})")
+
+    if not rel_err <= args.rtol:
+        print("Engines disagree beyond the tolerance!")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+import subprocess
+import sys
+
+from msq_maker.benchmark import HEAVY_MODULES
+
+
+def test_cli_does_not_import_heavy_modules():
+    # in a fresh interpreter, since other tests may have imported them already
+    code = f"import sys, msq_maker.cli; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    proc = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.split() == []
+
+
+def test_list_producers():
+    proc = subprocess.run([sys.executable, "-m", "msq_maker.cli", "list-producers"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    assert proc.returncode == 0, proc.stderr
+    assert "behavioral_distance (Optional)" in proc.stdout
+    assert "label_map (Required)" in proc.stdout
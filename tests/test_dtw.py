@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from msq_maker.dtw import distance_matrix, dtw_batch
+
+
+def naive_dtw(a, b, window=None):
+    """Textbook DTW: square root of the least sum of squared euclidean distances along a warping path, in a Sakoe-Chiba band."""
+    n = len(a)
+    window = n if window is None else window
+    acc = np.full((n + 1, n + 1), np.inf)
+    acc[0, 0] = 0
+    for i in range(1, n + 1):
+        for j in range(1, n + 1):
+            if abs(i - j) >= window:
+                continue
+            cost = np.sum((a[i - 1] - b[j - 1]) ** 2)
+            acc[i, j] = cost + min(acc[i - 1, j], acc[i, j - 1], acc[i - 1, j - 1])
+    return np.sqrt(acc[n, n])
+
+
+def naive_distance_matrix(series, window=None):
+    out = np.zeros((len(series), len(series)))
+    for i in range(len(series)):
+        for j in range(len(series)):
+            if i != j:
+                out[i, j] = naive_dtw(series[i], series[j], window)
+    return out
+
+
+@pytest.fixture
+def series():
+    rng = np.random.default_rng(0)
+    return np.cumsum(rng.normal(size=(8, 15, 2)), axis=1)
+
+
+@pytest.mark.parametrize("window", [None, 1, 3, 100])
+def test_dtw_batch_matches_naive(series, window):
+    a, b = series[:4], series[4:]
+
+    dists = dtw_batch(a, b, window=window)
+
+    np.testing.assert_allclose(dists, [naive_dtw(x, y, window) for x, y in zip(a, b)])
+
+
+@pytest.mark.parametrize("window", [None, 4])
+def test_distance_matrix_matches_naive(series, window):
+    np.testing.assert_allclose(distance_matrix(series, window=window), naive_distance_matrix(series, window))
+
+
+def test_distance_matrix_of_univariate_series(series):
+    univariate = series[:, :, 0]
+    np.testing.assert_allclose(distance_matrix(univariate), naive_distance_matrix(univariate[:, :, None]))
+
+
+@pytest.mark.parametrize("window", [None, 4])
+def test_max_dist_only_drops_distances_above_it(series, window):
+    reference = naive_distance_matrix(series, window)
+    max_dist = np.median(reference[np.triu_indices(len(series), k=1)])
+
+    dists = distance_matrix(series, window=window, max_dist=max_dist)
+
+    below = reference <= max_dist
+    np.testing.assert_allclose(dists[below], reference[below])
+    assert np.isinf(dists[~below]).all()
+    np.testing.assert_array_equal(np.diag(dists), 0)
+
+
+def test_distance_matrix_across_processes(series):
+    np.testing.assert_allclose(distance_matrix(series, window=4, processes=2), distance_matrix(series, window=4))
@@ -0,0 +1,76 @@
+import pytest
+
+from msq_maker.core import JOURNAL_NAME, MSQ, MSQConfig
+from msq_maker.journal import RunJournal
+from msq_maker.spool import DiskSpool, MemorySpool
+
+
+@pytest.fixture(params=["disk", "memory"])
+def msq(request, tmp_path):
+    spool = DiskSpool(str(tmp_path / "tmp")) if request.param == "disk" else MemorySpool()
+    return MSQ(MSQConfig(tmp_dir=str(tmp_path / "tmp")), spool=spool)
+
+
+def test_record_round_trip(msq):
+    msq.write_bytes("existing.json", b"{}")
+    msq.manifest["existing"] = "existing.json"
+    journal = RunJournal(msq.spool)
+    journal.reset()
+
+    with journal.record("usage", "hash-1", msq):
+        msq.write_bytes("usage.json", b"[]")
+        msq.manifest["usage"] = "usage.json"
+    with pytest.raises(RuntimeError):
+        with journal.record("transitions", "hash-2", msq):
+            msq.write_bytes("transitions.json", b"[")
+            raise RuntimeError("out of memory")
+
+    entries = RunJournal(msq.spool).entries()
+    assert [(e["producer"], e["status"]) for e in entries] == [("usage", "completed"), ("transitions", "failed")]
+    assert entries[0]["outputs"] == ["usage.json"]
+    assert entries[0]["manifest"] == {"usage": "usage.json"}
+    assert list(journal.completed()) == ["usage"]
+    assert journal.resumable("usage", "hash-1") is not None
+    assert journal.resumable("usage", "hash-changed") is None
+    assert journal.resumable("transitions", "hash-2") is None
+
+
+def test_latest_entry_wins(msq):
+    journal = RunJournal(msq.spool)
+    journal.reset()
+    msq.write_bytes("usage.json", b"[]")
+    journal.append({"producer": "usage", "status": "completed", "config_hash": "h", "outputs": ["usage.json"], "manifest": {}})
+    journal.append({"producer": "usage", "status": "failed", "config_hash": "h", "outputs": [], "manifest": {}})
+
+    assert journal.completed() == {}
+
+
+def test_completed_requires_outputs(msq):
+    journal = RunJournal(msq.spool)
+    journal.reset()
+    journal.append({"producer": "usage", "status": "completed", "config_hash": "h", "outputs": ["usage.json"], "manifest": {}})
+
+    assert journal.completed() == {}
+    msq.write_bytes("usage.json", b"[]")
+    assert list(journal.completed()) == ["usage"]
+
+
+def test_truncated_entries_are_ignored(msq):
+    journal = RunJournal(msq.spool)
+    assert not journal.exists() and journal.entries() == []
+
+    journal.reset()
+    journal.append({"producer": "usage", "status": "completed", "config_hash": "h", "outputs": [], "manifest": {}})
+    msq.spool.append_bytes(JOURNAL_NAME, b'{"producer": "transi')
+
+    assert [e["producer"] for e in RunJournal(msq.spool).entries()] == ["usage"]
+
+
+def test_journal_is_not_an_output(msq):
+    journal = RunJournal(msq.spool)
+    journal.reset()
+
+    with journal.record("usage", "h", msq):
+        msq.write_bytes("usage.json", b"[]")
+
+    assert journal.entries()[0]["outputs"] == ["usage.json"]
@@ -0,0 +1,106 @@
+import types
+from dataclasses import dataclass, field
+from typing import Type
+
+import numpy as np
+import pytest
+
+from msq_maker.core import BaseOptionalProducerArgs, MSQConfig, ModelConfig, PluginRegistry
+from msq_maker.mapreduce import MapReduceProducer, SessionContext, hash_label_map
+
+
+@dataclass
+class CountingConfig(BaseOptionalProducerArgs):
+    scale: int = field(default=1, metadata={"doc": "Factor applied to the number of frames."})
+
+
+class CountingProducer(MapReduceProducer[CountingConfig]):
+    """Counts the frames of each session, recording which sessions it mapped."""
+
+    @classmethod
+    def get_args_type(cls) -> Type[CountingConfig]:
+        return CountingConfig
+
+    def map_session(self, ctx: SessionContext):
+        self.mapped.append(ctx.uuid)
+        return len(ctx.labels) * self.pconfig.scale
+
+    def reduce(self, partials, msq):
+        pass
+
+
+@pytest.fixture
+def make_producer(monkeypatch, tmp_path):
+    monkeypatch.setitem(PluginRegistry.registry, "counting", CountingProducer)
+
+    def make(**args):
+        config = types.SimpleNamespace(
+            msq=MSQConfig(cache_dir=str(tmp_path / "cache"), processes=1),
+            model=ModelConfig(),
+            producers={"counting": CountingConfig(**args)},
+            shard=None,
+        )
+        producer = CountingProducer(config)
+        producer.mapped = []
+        producer._label_map = {0: 0, 1: 1}
+        return producer
+
+    return make
+
+
+@pytest.fixture
+def contexts(tmp_path):
+    contexts = []
+    for i, uuid in enumerate(["a", "b", "c"]):
+        h5_path = tmp_path / f"{uuid}.h5"
+        h5_path.write_bytes(b"extraction")
+        contexts.append(SessionContext(uuid=uuid, group="g", index_entry={"path": [str(h5_path)]}, labels=np.zeros(10 + i, dtype=int), max_states=100))
+    return contexts
+
+
+def test_partials_are_cached(make_producer, contexts):
+    first = make_producer()
+    assert first.map_sessions(contexts) == {"a": 10, "b": 11, "c": 12}
+    assert first.mapped == ["a", "b", "c"]
+
+    second = make_producer()
+    assert second.map_sessions(contexts) == {"a": 10, "b": 11, "c": 12}
+    assert second.mapped == []
+
+
+def test_partials_follow_their_inputs(make_producer, contexts):
+    make_producer().map_sessions(contexts)
+
+    contexts[1].labels = np.ones(11, dtype=int)
+    producer = make_producer()
+    producer.map_sessions(contexts)
+    assert producer.mapped == ["b"]
+
+    producer = make_producer(scale=2)
+    assert producer.map_sessions(contexts) == {"a": 20, "b": 22, "c": 24}
+    assert producer.mapped == ["a", "b", "c"]
+
+
+def test_partial_keys(make_producer, contexts, monkeypatch):
+    producer = make_producer()
+    label_map_hash = hash_label_map(producer.label_map)
+    key = producer._partial_key("counting", contexts[0], label_map_hash)
+
+    assert producer._partial_key("counting", contexts[0], label_map_hash) == key
+    assert producer._partial_key("counting", contexts[1], label_map_hash) != key
+    assert producer._partial_key("counting", contexts[0], hash_label_map({0: 1, 1: 0})) != key
+    assert make_producer(enabled=False)._partial_key("counting", contexts[0], label_map_hash) == key
+
+    monkeypatch.setattr(CountingProducer, "partial_version", 2)
+    assert producer._partial_key("counting", contexts[0], label_map_hash) != key
+
+
+def test_partials_are_not_cached_without_cache_dir(make_producer, contexts):
+    producer = make_producer()
+    producer.config.msq.cache_dir = ""
+    producer.map_sessions(contexts)
+
+    again = make_producer()
+    again.config.msq.cache_dir = ""
+    again.map_sessions(contexts)
+    assert again.mapped == ["a", "b", "c"]
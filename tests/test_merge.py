@@ -0,0 +1,149 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from msq_maker.core import MSQ, MSQConfig, Shard
+from msq_maker.merge import (
+    concat_split_dataframes,
+    find_shard_spools,
+    merge_manifests,
+    merge_sparse,
+    merge_spools,
+    write_shard_info,
+)
+from msq_maker.spool import DiskSpool, MemorySpool
+
+
+def split(df):
+    return json.loads(df.to_json(orient="split"))
+
+
+def test_shard_parse_and_validation():
+    assert Shard.parse("1/4") == Shard(1, 4)
+    for spec in ["4/4", "-1/2", "0/0", "1", "a/b"]:
+        with pytest.raises(ValueError):
+            Shard.parse(spec)
+
+
+def test_shards_partition_sessions():
+    uuids = [f"session-{i}" for i in range(200)]
+    shards = [Shard(i, 3) for i in range(3)]
+
+    owners = [[s.index for s in shards if s.owns(u)] for u in uuids]
+
+    assert all(len(o) == 1 for o in owners)
+    assert set(o[0] for o in owners) == {0, 1, 2}
+    assert all(Shard(0, 1).owns(u) for u in uuids)
+
+
+def test_shard_spool_path(tmp_path):
+    tmp_dir = str(tmp_path / "tmp")
+    paths = [Shard(i, 2).spool_path(tmp_dir + "/") for i in range(2)]
+    for path in paths:
+        os.makedirs(path)
+
+    assert paths == [f"{tmp_dir}.shard-0-of-2", f"{tmp_dir}.shard-1-of-2"]
+    assert find_shard_spools(tmp_dir) == paths
+
+
+def test_concat_split_dataframes_aligns_columns():
+    a = split(pd.DataFrame({"uuid": ["a", "b"], "usage": [1, 2]}, index=[5, 6]))
+    b = split(pd.DataFrame({"usage": [3], "uuid": ["c"], "group": ["g"]}))
+
+    merged = concat_split_dataframes([a, b])
+
+    assert merged == {
+        "columns": ["uuid", "usage", "group"],
+        "index": [0, 1, 2],
+        "data": [["a", 1, None], ["b", 2, None], ["c", 3, "g"]],
+    }
+
+
+def test_merge_sparse_sums_shared_matrices():
+    a = {"format": "coo", "shape": [3, 3], "groups": {"u1": "g"}, "matrices": {
+        "u1": {"row": [0], "col": [1], "data": [2.0]},
+        "g": {"row": [0, 1], "col": [1, 2], "data": [2.0, 1.0]},
+    }}
+    b = {"format": "coo", "shape": [3, 3], "groups": {"u2": "g"}, "matrices": {
+        "u2": {"row": [0], "col": [1], "data": [4.0]},
+        "g": {"row": [0], "col": [1], "data": [4.0]},
+    }}
+
+    merged = merge_sparse([a, b])
+
+    assert merged["groups"] == {"u1": "g", "u2": "g"}
+    assert sorted(merged["matrices"]) == ["g", "u1", "u2"]
+    g = merged["matrices"]["g"]
+    dense = sparse.coo_matrix((g["data"], (g["row"], g["col"])), shape=tuple(merged["shape"])).toarray()
+    assert dense[0, 1] == 6.0 and dense[1, 2] == 1.0 and dense.sum() == 7.0
+    # the inputs are left untouched
+    assert a["matrices"]["g"]["data"] == [2.0, 1.0]
+
+
+def test_merge_sparse_shapes():
+    empty = {"format": "coo", "shape": [0, 0], "matrices": {}}
+    a = {"format": "coo", "shape": [2, 2], "matrices": {"x": {"row": [0], "col": [0], "data": [1.0]}}}
+    b = {"format": "coo", "shape": [3, 3], "matrices": {"y": {"row": [0], "col": [0], "data": [1.0]}}}
+
+    assert merge_sparse([empty, a])["shape"] == [2, 2]
+    with pytest.raises(ValueError):
+        merge_sparse([a, b])
+
+
+def test_merge_manifests():
+    merged = merge_manifests([
+        {"usage": "usage.json", "scalars": {"0": "scalars/0.json"}},
+        {"usage": "other.json", "scalars": {"1": "scalars/1.json"}, "transitions": "transitions.json"},
+    ])
+
+    assert merged == {
+        "usage": "usage.json",
+        "scalars": {"0": "scalars/0.json", "1": "scalars/1.json"},
+        "transitions": "transitions.json",
+    }
+
+
+def write_partial_spool(tmp_dir, shard, uuids, manifest):
+    msq = MSQ(MSQConfig(tmp_dir=tmp_dir), spool=DiskSpool(shard.spool_path(tmp_dir)))
+    msq.write_dataframe("usage.json", pd.DataFrame({"uuid": uuids, "usage": [len(u) for u in uuids]}))
+    msq.write_sparse("transitions.json", {u: sparse.coo_matrix([[0, 1], [1, 0]]) for u in uuids}, groups={u: "g" for u in uuids})
+    msq.write_unstructured("label_map.json", {"shard": shard.index})
+    msq.write_bytes(f"clips/{uuids[0]}.mp4", b"video")
+    msq.manifest.update(manifest)
+    write_shard_info(msq, shard)
+
+
+def test_merge_spools(tmp_path):
+    tmp_dir = str(tmp_path / "tmp")
+    write_partial_spool(tmp_dir, Shard(1, 2), ["c"], {"usage": "usage.json", "clips": {"c": "clips/c.mp4"}})
+    write_partial_spool(tmp_dir, Shard(0, 2), ["a", "b"], {"usage": "usage.json", "clips": {"a": "clips/a.mp4"}})
+    msq = MSQ(MSQConfig(tmp_dir=tmp_dir), spool=MemorySpool())
+
+    merge_spools(find_shard_spools(tmp_dir), msq)
+
+    with msq.open("usage.json") as f:
+        usage = json.load(f)
+    assert [row[0] for row in usage["data"]] == ["a", "b", "c"]
+    assert sorted(msq.read_sparse("transitions.json")) == ["a", "b", "c"]
+    with msq.open("label_map.json") as f:
+        assert json.load(f) == {"shard": 0}
+    assert msq.glob("clips/*") == ["clips/a.mp4", "clips/c.mp4"]
+    assert not msq.exists("shard.json")
+    assert msq.manifest == {"usage": "usage.json", "clips": {"a": "clips/a.mp4", "c": "clips/c.mp4"}}
+
+
+def test_merge_spools_requires_every_shard(tmp_path):
+    tmp_dir = str(tmp_path / "tmp")
+    write_partial_spool(tmp_dir, Shard(0, 3), ["a"], {})
+    write_partial_spool(tmp_dir, Shard(2, 3), ["b"], {})
+    msq = MSQ(MSQConfig(tmp_dir=tmp_dir), spool=MemorySpool())
+
+    with pytest.raises(ValueError, match="1/3"):
+        merge_spools(find_shard_spools(tmp_dir), msq)
+
+    os.makedirs(Shard(1, 3).spool_path(tmp_dir))
+    with pytest.raises(ValueError, match="not a finished partial spool"):
+        merge_spools(find_shard_spools(tmp_dir), msq)
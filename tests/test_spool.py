@@ -0,0 +1,131 @@
+import contextlib
+import errno
+import os
+
+import pytest
+
+from msq_maker import spool as spool_module
+from msq_maker.core import JOURNAL_NAME
+from msq_maker.journal import RunJournal
+from msq_maker.spool import DiskSpool, MemorySpool, TmpfsSpool
+
+
+@pytest.fixture
+def full_tmpfs(monkeypatch):
+    """Make writes to spools under `full_tmpfs["path"]` fail for lack of space (after writing part of the data, for `open()`)."""
+    root = {"path": None}
+    open_file = DiskSpool.open
+
+    def open_or_fail(self, name, mode="r"):
+        if "r" in mode or root["path"] is None or not self.path.startswith(root["path"]):
+            return open_file(self, name, mode)
+
+        @contextlib.contextmanager
+        def failing():
+            with open_file(self, name, mode) as f:
+                f.write(b"partial")
+                raise OSError(errno.ENOSPC, "No space left on device")
+            yield  # pragma: no cover
+
+        return failing()
+
+    add_file = DiskSpool.add_file
+
+    def add_file_or_fail(self, name, src_path, move=False):
+        if root["path"] is not None and self.path.startswith(root["path"]):
+            raise OSError(errno.ENOSPC, "No space left on device")
+        return add_file(self, name, src_path, move=move)
+
+    monkeypatch.setattr(DiskSpool, "open", open_or_fail)
+    monkeypatch.setattr(DiskSpool, "add_file", add_file_or_fail)
+    return root
+
+
+@pytest.mark.parametrize("make_spool", [
+    lambda tmp_path: DiskSpool(str(tmp_path / "spool")),
+    lambda tmp_path: TmpfsSpool(str(tmp_path / "shm"), fallback=str(tmp_path / "spool")),
+    lambda tmp_path: MemorySpool(),
+])
+def test_spool_round_trip(tmp_path, make_spool):
+    spool = make_spool(tmp_path)
+    spool.write_bytes("a/b.json", b"{}")
+    spool.append_bytes("log.txt", b"one\n")
+    spool.append_bytes("log.txt", b"two\n")
+    with spool.open("c.txt", "w") as f:
+        f.write("text")
+    with spool.directory("clips") as path:
+        with open(os.path.join(path, "clip.mp4"), "wb") as f:
+            f.write(b"video")
+
+    assert sorted(spool.snapshot()) == ["a/b.json", "c.txt", "clips/clip.mp4", "log.txt"]
+    assert spool.read_bytes("log.txt") == b"one\ntwo\n"
+    with spool.open("c.txt") as f:
+        assert f.read() == "text"
+    assert spool.read_bytes("clips/clip.mp4") == b"video"
+    spool.remove("c.txt")
+    assert not spool.exists("c.txt")
+
+    staged = spool.staging("producer")
+    staged.write_bytes("staged.json", b"[]")
+    spool.move_from(staged)
+    assert spool.read_bytes("staged.json") == b"[]"
+    assert staged.snapshot() == {}
+
+
+def test_tmpfs_spool_moves_to_disk_when_full(tmp_path, full_tmpfs):
+    shm, disk = str(tmp_path / "shm"), str(tmp_path / "tmp")
+    spool = TmpfsSpool(shm, fallback=disk)
+    spool.write_bytes("a.json", b"before")
+    spool.append_bytes("log.txt", b"one\n")
+
+    full_tmpfs["path"] = shm
+    spool.append_bytes("log.txt", b"two\n")
+    with spool.open("b.json", "w") as f:
+        f.write("after")
+
+    assert spool.spilled and spool.path == disk
+    assert not os.path.exists(shm)
+    assert spool.read_bytes("a.json") == b"before"
+    assert spool.read_bytes("b.json") == b"after"
+    # the partial append was dropped before retrying on disk
+    assert spool.read_bytes("log.txt") == b"one\ntwo\n"
+
+
+def test_tmpfs_spool_directory_writers_do_not_write_to_tmpfs(tmp_path, full_tmpfs):
+    shm, disk = str(tmp_path / "shm"), str(tmp_path / "tmp")
+    spool = TmpfsSpool(shm, fallback=disk)
+    with spool.directory("movies") as path:
+        assert not path.startswith(shm)
+        with open(os.path.join(path, "movie.mp4"), "wb") as f:
+            f.write(b"video")
+        full_tmpfs["path"] = shm
+
+    assert spool.spilled
+    assert spool.read_bytes("movies/movie.mp4") == b"video"
+    assert not os.path.exists(path)
+
+
+def test_tmpfs_spool_keeps_journal_on_disk_and_clears_everything(tmp_path):
+    shm, disk = str(tmp_path / "shm"), str(tmp_path / "tmp")
+    spool = TmpfsSpool(shm, fallback=disk)
+    journal = RunJournal.for_spool(spool)
+    journal.reset()
+    journal.append({"producer": "usage", "status": "completed", "config_hash": "h", "outputs": [], "manifest": {}})
+
+    assert os.path.exists(os.path.join(disk, JOURNAL_NAME))
+    assert not spool.exists(JOURNAL_NAME)
+    assert list(journal.completed()) == ["usage"]
+
+    spool.clear()
+    assert not os.path.exists(shm) and not os.path.exists(disk)
+
+
+def test_open_spool_uses_tmpfs_only_when_asked(tmp_path, monkeypatch):
+    monkeypatch.setattr(spool_module, "TMPFS_ROOT", str(tmp_path / "shm"))
+    os.makedirs(spool_module.TMPFS_ROOT)
+    tmp_dir = str(tmp_path / "tmp")
+
+    assert type(spool_module.open_spool(tmp_dir, "disk")) is DiskSpool
+    assert type(spool_module.open_spool(tmp_dir, "auto")) is DiskSpool
+    tmpfs = spool_module.open_spool(tmp_dir, "tmpfs")
+    assert isinstance(tmpfs, TmpfsSpool) and tmpfs.fallback == tmp_dir
@@ -0,0 +1,107 @@
+import json
+import zipfile
+
+import pandas as pd
+import pytest
+
+from msq_maker import update
+from msq_maker.core import MSQ, BaseProducer, MSQConfig, ModelConfig
+from msq_maker.mapreduce import MapReduceProducer
+from msq_maker.spool import MemorySpool
+from msq_maker.update import PROVENANCE_NAME, PreviousReport, ReportUpdate, filter_sessions
+
+
+USAGE = json.loads(pd.DataFrame({"uuid": ["a", "b", "c"], "usage": [1, 2, 3]}).to_json(orient="split"))
+TRANSITIONS = {"format": "coo", "shape": [2, 2], "groups": {"a": "g", "b": "g"}, "matrices": {
+    "a": {"row": [0], "col": [1], "data": [1.0]},
+    "b": {"row": [1], "col": [0], "data": [1.0]},
+}}
+
+
+def provenance(sessions, model="model-hash", label_map="label-map-hash"):
+    return {"model": model, "label_map": label_map, "sessions": sessions}
+
+
+@pytest.fixture
+def previous(tmp_path):
+    record = provenance({"a": "a1", "b": "b1", "c": "c1"})
+    record["producers"] = {
+        "usage": {"config_hash": "usage-hash", "outputs": ["usage.json"], "manifest": {"usage": "usage.json"}},
+        "groups": {"config_hash": "groups-hash", "outputs": ["groups.json"], "manifest": {"groups": "groups.json"}},
+        "label-map": {"config_hash": "label-map-hash", "outputs": ["label_map.json"], "manifest": {}},
+    }
+    path = str(tmp_path / "report.msq")
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr(f"./{PROVENANCE_NAME}", json.dumps(record))
+        zf.writestr("./usage.json", json.dumps(USAGE))
+        zf.writestr("./groups.json", json.dumps({"g": ["a", "b", "c"]}))
+        zf.writestr("./label_map.json", json.dumps({"0": 0}))
+    report = PreviousReport(path)
+    yield report
+    report.close()
+
+
+def make_update(monkeypatch, previous, current):
+    monkeypatch.setattr(update, "current_provenance", lambda mconfig: current)
+    return ReportUpdate(previous, ModelConfig())
+
+
+def test_sessions_diff(monkeypatch, previous):
+    plan = make_update(monkeypatch, previous, provenance({"a": "a1", "b": "b2", "d": "d1"}))
+
+    assert plan.new == ["d"]
+    assert plan.changed == ["b"]
+    assert plan.removed == ["c"]
+    assert plan.fresh == {"b", "d"}
+    assert plan.stale == {"b", "c"}
+    assert not plan.model_changed and not plan.label_map_changed
+
+
+def test_actions_when_nothing_changed(monkeypatch, previous):
+    plan = make_update(monkeypatch, previous, provenance({"a": "a1", "b": "b1", "c": "c1"}))
+
+    assert plan.action("groups", BaseProducer, "groups-hash") == "copy"
+    assert plan.action("groups", BaseProducer, "other-hash") == "run"
+    assert plan.action("spinograms", BaseProducer, "spinograms-hash") == "run"
+    assert plan.action("usage", MapReduceProducer, "usage-hash") == "splice"
+
+
+def test_actions_when_sessions_changed(monkeypatch, previous):
+    plan = make_update(monkeypatch, previous, provenance({"a": "a1", "b": "b1"}))
+
+    assert plan.action("groups", BaseProducer, "groups-hash") == "run"
+    assert plan.action("usage", MapReduceProducer, "usage-hash") == "splice"
+    # per-session producers can only splice outputs keyed by session
+    assert plan.action("label-map", MapReduceProducer, "label-map-hash") == "run"
+
+
+def test_actions_when_model_changed(monkeypatch, previous):
+    plan = make_update(monkeypatch, previous, provenance({"a": "a1", "b": "b1", "c": "c1"}, model="other", label_map="other"))
+
+    assert plan.model_changed and plan.label_map_changed
+    assert plan.action("groups", BaseProducer, "groups-hash") == "run"
+    assert plan.action("usage", MapReduceProducer, "usage-hash") == "run"
+
+
+def test_copy(monkeypatch, previous):
+    plan = make_update(monkeypatch, previous, provenance({"a": "a1", "b": "b1", "c": "c1"}))
+    msq = MSQ(MSQConfig(), spool=MemorySpool())
+
+    plan.copy("groups", msq)
+
+    with msq.open("groups.json") as f:
+        assert json.load(f) == {"g": ["a", "b", "c"]}
+    assert msq.manifest == {"groups": "groups.json"}
+
+
+def test_filter_sessions():
+    usage = filter_sessions(USAGE, {"b"})
+    assert usage["data"] == [["a", 1], ["c", 3]]
+    assert usage["index"] == [0, 1]
+
+    transitions = filter_sessions(TRANSITIONS, {"a"})
+    assert list(transitions["matrices"]) == ["b"]
+    assert transitions["groups"] == {"b": "g"}
+
+    with pytest.raises(ValueError):
+        filter_sessions({"0": 0}, {"a"})
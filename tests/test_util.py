@@ -0,0 +1,94 @@
+import threading
+import types
+
+import numpy as np
+import pytest
+
+from msq_maker.util import get_sparse_transition_counts, patch_parse_index, read_only_copy, restrict_sparse_matrix, sum_sparse_matrices
+
+
+def dense_transition_counts(labels, max_syllable):
+    """Reference counting of `moseq2_viz.model.trans_graph.get_transition_matrix(normalize=None)` for one session."""
+    labels = np.asarray(labels)
+    transitions = labels[np.where(labels[1:] != labels[:-1])[0] + 1]
+    mat = np.zeros((max_syllable, max_syllable))
+    for i, j in zip(transitions, transitions[1:]):
+        if 0 <= i < max_syllable and 0 <= j < max_syllable:
+            mat[i, j] += 1
+    return mat
+
+
+@pytest.mark.parametrize("max_syllable", [1, 5, 10, 20])
+def test_sparse_transition_counts_match_dense(max_syllable):
+    rng = np.random.default_rng(0)
+    labels = np.concatenate([np.full(3, -5), np.repeat(rng.integers(0, 12, size=200), rng.integers(1, 6, size=200))])
+
+    counts = get_sparse_transition_counts(labels, max_syllable)
+
+    assert counts.shape == (max_syllable, max_syllable)
+    np.testing.assert_array_equal(counts.toarray(), dense_transition_counts(labels, max_syllable))
+
+
+def test_sparse_transition_counts_of_short_sequences():
+    assert get_sparse_transition_counts(np.array([], dtype=int), 4).nnz == 0
+    assert get_sparse_transition_counts(np.array([2, 2, 2]), 4).nnz == 0
+
+
+def test_sum_and_restrict_sparse_matrices():
+    a = get_sparse_transition_counts(np.array([0, 1, 2, 1, 0]), 3)
+    b = get_sparse_transition_counts(np.array([0, 1, 0, 2]), 3)
+    total = sum_sparse_matrices([a, b])
+    np.testing.assert_array_equal(total.toarray(), a.toarray() + b.toarray())
+
+    # raw ID 2 has a usage ID beyond max_syl, its row and column are dropped
+    mapping = {i: {"raw": i, "usage": u, "frames": u} for i, u in enumerate([0, 1, 5])}
+    restricted = restrict_sparse_matrix(total, mapping, max_syl=2).toarray()
+    assert restricted[2].sum() == 0 and restricted[:, 2].sum() == 0
+    np.testing.assert_array_equal(restricted[:2, :2], total.toarray()[:2, :2])
+
+    with pytest.raises(ValueError):
+        sum_sparse_matrices([])
+
+
+def test_read_only_copy_shares_read_only_arrays():
+    model = {"keys": ["a", "b"], "labels": [np.arange(4), np.arange(3)], "model_parameters": {"ar_mat": (np.eye(2),)}}
+    copy = read_only_copy(model)
+
+    copy["keys"].append("c")
+    copy["labels"][0] = np.zeros(2)
+    assert model["keys"] == ["a", "b"]
+    np.testing.assert_array_equal(model["labels"][0], np.arange(4))
+
+    assert copy["labels"][1] is model["labels"][1]
+    with pytest.raises(ValueError):
+        copy["labels"][1][0] = 10
+    with pytest.raises(ValueError):
+        copy["model_parameters"]["ar_mat"][0] += 1
+
+
+def test_patches_only_apply_to_the_patching_thread():
+    def original(path):
+        return "original"
+
+    module = types.ModuleType("fake_moseq2_viz")
+    module.parse_index = original
+    seen = {}
+    patched = threading.Event()
+    called = threading.Event()
+
+    def other_thread():
+        patched.wait()
+        seen["other"] = module.parse_index("index.yaml")
+        called.set()
+
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    with patch_parse_index(module):
+        seen["patched"] = module.parse_index
+        patched.set()
+        called.wait()
+    thread.join()
+
+    assert seen["other"] == "original"
+    assert seen["patched"] is not original
+    assert module.parse_index is original